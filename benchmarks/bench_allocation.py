@@ -0,0 +1,101 @@
+"""
+Compare the assignment of queued rows to clusters row by row in python with
+the vectorized allocation, and check that no row is assigned twice and no
+cluster gets more rows than its free slots.
+
+usage: python benchmarks/bench_allocation.py [--rows 100000] [--clusters 50]
+                                             [--experiments 10 100 1000]
+"""
+import argparse
+import time
+
+import numpy
+
+from cumulus.cluster.allocation import allocate
+
+
+def make_backlog(n_rows, n_experiments, n_clusters, seed=1):
+    rng = numpy.random.RandomState(seed)
+    counts = rng.multinomial(
+        n_rows, rng.dirichlet(numpy.ones(n_experiments)))
+    row_ids = [numpy.arange(count) + index * n_rows
+               for index, count in enumerate(counts)]
+    # Slightly less slots than rows, so that the experiments compete
+    free_slots = rng.multinomial(
+        int(n_rows * 0.9), rng.dirichlet(numpy.ones(n_clusters)))
+    return free_slots, row_ids
+
+
+def allocate_loop(free_slots, row_ids):
+    """Give each slot to the experiment furthest behind its fair share"""
+    counts = [len(ids) for ids in row_ids]
+    total = float(sum(counts))
+    taken = [0] * len(counts)
+    assigned = []
+    for free in free_slots:
+        cluster_ids = {}
+        for _ in xrange(free):
+            candidates = [index for index in xrange(len(counts))
+                          if taken[index] < counts[index]]
+            if not candidates:
+                break
+            index = min(candidates,
+                        key=lambda i: taken[i] / (counts[i] / total))
+            cluster_ids.setdefault(index, []).append(
+                row_ids[index][taken[index]])
+            taken[index] += 1
+        assigned.append(cluster_ids)
+
+    return assigned
+
+
+def allocate_vectorized(free_slots, row_ids):
+    assignment = allocate(free_slots, [len(ids) for ids in row_ids])
+    return assignment.split(row_ids)
+
+
+def check(assigned, free_slots, row_ids):
+    all_ids = [row_id for cluster_ids in assigned
+               for ids in cluster_ids.itervalues() for row_id in ids]
+    assert len(all_ids) == len(set(all_ids)), "Rows assigned twice"
+    assert len(all_ids) == min(sum(free_slots),
+                               sum(len(ids) for ids in row_ids))
+    for cluster_ids, free in zip(assigned, free_slots):
+        assert sum(len(ids) for ids in cluster_ids.itervalues()) <= free
+
+    return len(all_ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--experiments", type=int, nargs="+",
+                        default=[10, 100, 1000])
+    parser.add_argument("--skip-loop", action="store_true",
+                        help="Do not run the python loop, which is slow with "
+                             "many experiments")
+    options = parser.parse_args(argv)
+
+    print "%8s %8s %11s %-12s %10s %10s" % (
+        "rows", "clusters", "experiments", "allocation", "time (s)",
+        "assigned")
+    for n_experiments in options.experiments:
+        free_slots, row_ids = make_backlog(options.rows, n_experiments,
+                                           options.clusters)
+        methods = [("vectorized", allocate_vectorized)]
+        if not options.skip_loop:
+            methods.insert(0, ("loop", allocate_loop))
+
+        for name, fct in methods:
+            start = time.time()
+            assigned = fct(free_slots, row_ids)
+            elapsed = time.time() - start
+            n_assigned = check(assigned, free_slots, row_ids)
+            print "%8d %8d %11d %-12s %10.3f %10d" % (
+                options.rows, options.clusters, n_experiments, name,
+                elapsed, n_assigned)
+
+
+if __name__ == "__main__":
+    main()
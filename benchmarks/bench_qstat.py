@@ -0,0 +1,185 @@
+"""
+Compare the parser of qstat -f loading the whole output in memory with the
+streaming parser and the parser of qstat -x on synthetic dumps.
+
+usage: python benchmarks/bench_qstat.py [--jobs 10000 100000]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from cumulus.parsers.qstat import (
+    parse_qstat, parse_qstat_stream, parse_qstat_xml)
+
+
+JOB_TEMPLATE = """Job Id: %(id)s
+    Job_Name = experiment-%(index)d
+    Job_Owner = bouthilx@login1.cluster
+    resources_used.cput = 01:12:43
+    resources_used.mem = 1843200kb
+    resources_used.vmem = 4407040kb
+    resources_used.walltime = 01:13:02
+    job_state = %(state)s
+    queue = gpu_1
+    server = server.cluster
+    Checkpoint = u
+    ctime = Mon Jul 17 12:12:03 2017
+    Error_Path = login1.cluster:/home/bouthilx/logs/experiment-%(index)d.e
+    exec_host = node%(node)d/0-1
+    Hold_Types = n
+    Join_Path = oe
+    Keep_Files = n
+    Mail_Points = a
+    mtime = Mon Jul 17 12:12:05 2017
+    Output_Path = login1.cluster:/home/bouthilx/logs/experiment-%(index)d.o
+    Priority = 0
+    qtime = Mon Jul 17 12:12:03 2017
+    Rerunable = True
+    Resource_List.nodes = 1:ppn=2:gpus=1
+    Resource_List.walltime = 12:00:00
+    session_id = %(index)d
+    Variable_List = PBS_O_QUEUE=gpu_1,PBS_O_HOME=/home/bouthilx,
+\tPBS_O_LOGNAME=bouthilx,PBS_O_PATH=/usr/local/bin:/usr/bin:/bin,
+\tPBS_O_SHELL=/bin/bash,PBS_O_LANG=en_US.UTF-8,PBS_O_WORKDIR=/home
+    euser = bouthilx
+    egroup = bouthilx
+    queue_type = E
+    etime = Mon Jul 17 12:12:03 2017
+    submit_args = -q gpu_1 script.sh
+    start_time = Mon Jul 17 12:12:05 2017
+    walltime.remaining = 39418
+    start_count = 1
+
+"""
+
+ROW_HEADER = """
+JobID                     Name             User            TimeUse  S Queue
+------------------------- ---------------- --------------- -------- - -----
+"""
+
+ROW_TEMPLATE = (
+    "%(id)-25s experiment-%(index)-5d bouthilx        01:12:43 %(state)s gpu_1"
+    "\n")
+
+XML_TEMPLATE = (
+    "<Job><Job_Id>%(id)s</Job_Id><Job_Name>experiment-%(index)d</Job_Name>"
+    "<Job_Owner>bouthilx@login1.cluster</Job_Owner>"
+    "<resources_used><cput>01:12:43</cput><mem>1843200kb</mem>"
+    "<vmem>4407040kb</vmem><walltime>01:13:02</walltime></resources_used>"
+    "<job_state>%(state)s</job_state><queue>gpu_1</queue>"
+    "<server>server.cluster</server><Checkpoint>u</Checkpoint>"
+    "<ctime>1500307923</ctime>"
+    "<Error_Path>login1.cluster:/home/bouthilx/logs/experiment-%(index)d.e"
+    "</Error_Path><exec_host>node%(node)d/0-1</exec_host>"
+    "<Hold_Types>n</Hold_Types><Join_Path>oe</Join_Path>"
+    "<Keep_Files>n</Keep_Files><Mail_Points>a</Mail_Points>"
+    "<mtime>1500307925</mtime>"
+    "<Output_Path>login1.cluster:/home/bouthilx/logs/experiment-%(index)d.o"
+    "</Output_Path><Priority>0</Priority><qtime>1500307923</qtime>"
+    "<Rerunable>True</Rerunable><Resource_List><nodes>1:ppn=2:gpus=1</nodes>"
+    "<walltime>12:00:00</walltime></Resource_List>"
+    "<session_id>%(index)d</session_id>"
+    "<Variable_List>PBS_O_QUEUE=gpu_1,PBS_O_HOME=/home/bouthilx,"
+    "PBS_O_LOGNAME=bouthilx,PBS_O_PATH=/usr/local/bin:/usr/bin:/bin,"
+    "PBS_O_SHELL=/bin/bash,PBS_O_LANG=en_US.UTF-8,PBS_O_WORKDIR=/home"
+    "</Variable_List><euser>bouthilx</euser><egroup>bouthilx</egroup>"
+    "<queue_type>E</queue_type><etime>1500307923</etime>"
+    "<submit_args>-q gpu_1 script.sh</submit_args>"
+    "<start_time>1500307925</start_time>"
+    "<walltime.remaining>39418</walltime.remaining>"
+    "<start_count>1</start_count></Job>")
+
+STATES = "RQHCE"
+
+ATTRIBUTES = ["Job_Name", "exec_host", "job_state"]
+
+
+def write_dumps(directory, n_jobs):
+    row_path = os.path.join(directory, "qstat-t-%d" % n_jobs)
+    full_path = os.path.join(directory, "qstat-f-%d" % n_jobs)
+    xml_path = os.path.join(directory, "qstat-x-%d" % n_jobs)
+    with open(row_path, 'w') as row_file, open(full_path, 'w') as full_file, \
+            open(xml_path, 'w') as xml_file:
+        row_file.write(ROW_HEADER)
+        xml_file.write("<Data>")
+        for index in xrange(n_jobs):
+            job = dict(id="%d.server.cluster" % index, index=index,
+                       state=STATES[index % len(STATES)],
+                       node=index % 512)
+            full_file.write(JOB_TEMPLATE % job)
+            row_file.write(ROW_TEMPLATE % job)
+            xml_file.write(XML_TEMPLATE % job)
+        xml_file.write("</Data>")
+
+    return row_path, full_path, xml_path
+
+
+def parse_in_memory(row_path, full_path):
+    with open(row_path) as row_file:
+        with open(full_path) as full_file:
+            return parse_qstat(row_file.read(), full_file.read())
+
+
+def parse_streaming(row_path, full_path, attributes=None):
+    with open(row_path) as row_file:
+        with open(full_path) as full_file:
+            return parse_qstat_stream(row_file, full_file, attributes)
+
+
+def parse_xml(xml_path, attributes=None):
+    with open(xml_path) as xml_file:
+        return parse_qstat_xml(xml_file, attributes)
+
+
+def _measure(queue, fct, args):
+    start = time.time()
+    jobs = fct(*args)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    queue.put((elapsed, peak, len(jobs)))
+
+
+def measure(fct, *args):
+    """Run in a separate process so that peak memory is not shared"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure,
+                                      args=(queue, fct, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--jobs", type=int, nargs="+",
+                        default=[10000, 100000])
+    options = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="bench-qstat-")
+    try:
+        print "%8s %-22s %10s %14s" % ("jobs", "parser", "time (s)",
+                                       "peak RSS (MB)")
+        for n_jobs in options.jobs:
+            row_path, full_path, xml_path = write_dumps(directory, n_jobs)
+            for name, fct, args in [
+                    ("in-memory", parse_in_memory, (row_path, full_path)),
+                    ("streaming", parse_streaming, (row_path, full_path)),
+                    ("streaming (3 attrs)", parse_streaming,
+                     (row_path, full_path, ATTRIBUTES)),
+                    ("xml", parse_xml, (xml_path, )),
+                    ("xml (3 attrs)", parse_xml, (xml_path, ATTRIBUTES))]:
+                elapsed, peak, n_parsed = measure(fct, *args)
+                assert n_parsed == n_jobs
+                print "%8d %-22s %10.3f %14.1f" % (n_jobs, name, elapsed,
+                                                   peak)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compare the standardization of the status of jobs by scanning the status of
+the scheduler for each state with the precomputed lookup table and the batch
+path on arrays of states.
+
+usage: python benchmarks/bench_status.py [--jobs 10000 100000]
+"""
+import argparse
+import copy
+import time
+
+import numpy
+
+from cumulus.scheduler.base import AbstractScheduler
+from cumulus.scheduler.table import JobTable
+from cumulus.scheduler.torque import Scheduler
+
+
+def make_queue(n_jobs, seed=1):
+    rng = numpy.random.RandomState(seed)
+    states = ["R", "Q", "H", "C", "E"]
+    queue = {}
+    for index in xrange(n_jobs):
+        n_states = rng.randint(1, len(states) + 1)
+        job_array = dict((state, int(rng.randint(1, 100))) for state in
+                         rng.choice(states, n_states, replace=False))
+        queue["%d.server" % index] = dict(
+            id="%d.server" % index, Job_Name="experiment-%d" % index,
+            job_array=job_array)
+
+    return queue
+
+
+def scan_standardize(scheduler, jobs):
+    """Former implementation, looking up the status of each state"""
+    jobs = copy.deepcopy(jobs)
+    for job_id, informations in jobs.iteritems():
+        job_array = informations["job_array"]
+        for custom_status in list(job_array.keys()):
+            status_key = [key for key in scheduler._status
+                          if getattr(scheduler, key) == custom_status]
+            assert len(status_key) == 1
+            standard_status = getattr(AbstractScheduler, status_key[0])
+            job_array[standard_status] = (
+                job_array.get(standard_status, 0) + job_array[custom_status])
+            del job_array[custom_status]
+
+    return jobs
+
+
+def lookup_standardize(scheduler, jobs):
+    return scheduler._standardize_status(jobs, inplace=False)
+
+
+def batch_standardize(scheduler, jobs):
+    return JobTable.from_queue(jobs, scheduler=scheduler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--jobs", type=int, nargs="+",
+                        default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args(argv)
+
+    scheduler = Scheduler()
+    print "%8s %-10s %10s" % ("jobs", "method", "time (s)")
+    for n_jobs in options.jobs:
+        queue = make_queue(n_jobs)
+        reference = JobTable.from_queue(scan_standardize(scheduler, queue))
+        for name, fct in [("scan", scan_standardize),
+                          ("lookup", lookup_standardize),
+                          ("batch", batch_standardize)]:
+            timings = []
+            for _ in xrange(options.repeat):
+                start = time.time()
+                standardized = fct(scheduler, queue)
+                timings.append(time.time() - start)
+
+            if not isinstance(standardized, JobTable):
+                standardized = JobTable.from_queue(standardized)
+            order = numpy.argsort(standardized.ids)
+            assert (standardized.counts[order] ==
+                    reference.counts[numpy.argsort(reference.ids)]).all()
+
+            print "%8d %-10s %10.3f" % (n_jobs, name, min(timings))
+
+        codes = numpy.random.choice(["R", "Q", "H", "C", "E"], n_jobs * 10)
+        start = time.time()
+        scheduler.standardize_codes(codes)
+        print "%8d %-10s %10.3f (%d task states)" % (
+            n_jobs, "codes", time.time() - start, len(codes))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,18 @@
 import argparse
 import json
 import logging
+import signal
 import sys
 import time
 
 import numpy
 
 from ..cluster.cumulus import Cumulus
+from ..cluster.daemon import Daemon, POLL_INTERVAL, DEPLOY_INTERVAL
 from ..database import status
 from ..database.project import Project
-from ..scheduler.base import AbstractScheduler
-from ..utils.process import pmap
+from ..scheduler.base import AbstractScheduler, task_id_regex
+from ..scheduler.table import JobTable
 
 
 logger = logging.getLogger(__name__)
@@ -26,6 +28,11 @@ SETUP = "setup"
 DEPLOY = "deploy"
 MONITOR = "monitor"
 CANCEL = "cancel"
+DAEMON = "daemon"
+
+# Maximum number of seconds to wait for cancelled jobs to leave the queues
+CANCEL_TIMEOUT = 60
+CANCEL_POLL_INTERVAL = 5
 
 
 def report(some_dicts, summarize=False):
@@ -39,13 +46,12 @@ def report_queue(some_dicts, summarize=False):
         print "Cluster:", cluster
         table.append(keys + AbstractScheduler._status)
         print " ".join(keys + AbstractScheduler._status)
-        for job_id, info in queue.iteritems():
-            table.append([info.get(key, "") for key in keys])
-            table[-1] += [str(info["job_array"].get(s, 0))
-                          for s in AbstractScheduler._status]
-            print " ".join(info.get(key, "") for key in keys), " ",
-            print " ".join(str(info["job_array"].get(s, 0))
-                           for s in AbstractScheduler._status)
+        job_table = JobTable.from_queue(queue, keys[1:])
+        for values, counts in job_table.rows(keys):
+            table.append([str(value) for value in values])
+            table[-1] += [str(count) for count in counts]
+            print " ".join(table[-1][:len(keys)]), " ",
+            print " ".join(table[-1][len(keys):])
 
     row_format = "{:>15}" * (len(table[0]))
     for row in table:
@@ -80,16 +86,32 @@ def deploy(clusters_config, experiments_config, retrieve_logs):
     print queues
 
     project = Project(experiments_config)
-    queued_experiments = project.get(status=status.QUEUED)
-    deployed = cumulus.deploy(queued_experiments)
+    deployed = cumulus.deploy(project, queues)
     report(deployed)
     if retrieve_logs:
         cumulus.retrieve_logs(retrieve_logs)
 
 
+def daemon(clusters_config, experiments_config, poll_interval,
+           deploy_interval, metrics_file):
+    cumulus = Cumulus(clusters_config)
+    project = Project(experiments_config)
+    deploy_daemon = Daemon(cumulus, project, poll_interval, deploy_interval,
+                           metrics_file)
+
+    def stop(signum, frame):
+        logger.info("Received signal %d, stopping after this cycle" % signum)
+        deploy_daemon.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    deploy_daemon.run()
+
+
 def monitor(clusters_config, experiments_config, summarize):
     cumulus = Cumulus(clusters_config)
-    queues = cumulus.get_queues()
+    queues = cumulus.update_stats()
     # for cluster_config in sort_by_priority(clusters_config):
     report_queue(queues, summarize)
 
@@ -98,69 +120,76 @@ def monitor(clusters_config, experiments_config, summarize):
         report(jobs, summarize=True)
 
 
-def _initialize_cancel_db_jobs(_found_job_ids):
-    global found_job_ids
-    found_job_ids = _found_job_ids
-
-
-def _cancel_db_jobs(experiment_config):
-    dataset = "for reference"  # Database()
-    non_failed_jobs = [
-        row for row in dataset.get(job_ids=found_job_ids)
-        if row[dataset.STATUS] != status.FAILED]
-    if non_failed_jobs:
-        # TODO
-        raise RuntimeError("Something went wrong... detail more")
-
-    return dataset.set(job_ids=found_job_ids, status=dataset.CANCELLED)
-
-
-def cancel(clusters_config, experiments_config, job_id):
+def wait_cancelled(cumulus, cancelled, timeout=CANCEL_TIMEOUT,
+                   interval=CANCEL_POLL_INTERVAL):
+    """
+    Wait until the jobs cancelled left the queues and return the ids of
+    those which did, by cluster name. The socket servers answer from their
+    cached queue, so polling them is cheap. Cancellations without a ticket,
+    like those of ranges of tasks, cannot be confirmed.
+    """
+    tickets = dict((name, rval["ticket"])
+                   for name, rval in cancelled.iteritems()
+                   if rval.get("ticket") is not None)
+    for name, rval in cancelled.iteritems():
+        if rval.get("ticket") is None and rval["job_ids"]:
+            logger.info("Cancellation of %d jobs on %s cannot be confirmed" %
+                        (len(rval["job_ids"]), name))
+    confirmed = {}
+
+    deadline = time.time() + timeout
+    while tickets:
+        statuses = cumulus.cancel_status(tickets)
+        for name, error in statuses.errors.iteritems():
+            logger.warning("Could not confirm cancellation on %s: %s" %
+                           (name, str(error)))
+            del tickets[name]
+
+        for name, cancel_status in statuses.iteritems():
+            confirmed[name] = cancel_status["cancelled"]
+            if cancel_status["done"]:
+                del tickets[name]
+            elif time.time() > deadline:
+                logger.warning("%d jobs still in queue of %s after %d "
+                               "seconds" % (len(cancel_status["pending"]),
+                                            name, timeout))
+                logger.debug("Jobs still in queue are: %s" %
+                             str(cancel_status["pending"]))
+
+        if time.time() > deadline:
+            break
+
+        if tickets:
+            time.sleep(interval)
+
+    return confirmed
+
+
+def cancel(clusters_config, experiments_config, job_id, job_array_id=None):
     cumulus = Cumulus(clusters_config)
-    cancelled = cumulus.cancel(job_id)
+    cancelled = cumulus.cancel(job_id, job_array_id)
 
     report(cancelled)
 
-    found_job_ids = sum((job_ids for job_ids in cancelled.itervalues()), [])
-    logger.info("%d jobs cancelled" % len(found_job_ids))
-
-    if experiments_config is not None:
-        project = Project(experiments_config)
-
-        WAIT_STEP = 5
-        MAX_WAIT = 60
-        waited = 0
-        while waited <= MAX_WAIT:
-            non_failed_jobs = [
-                row[Project.JOB_ID]
-                for row in project.get(job_ids=found_job_ids)
-                if row[Project.STATUS] != status.FAILED]
+    for name, error in cancelled.errors.iteritems():
+        logger.error("Could not cancel jobs on %s: %s" % (name, str(error)))
 
-            if len(non_failed_jobs) > 1:
-                break
-
-            time.sleep(5)
-            waited += WAIT_STEP
-
-        if non_failed_jobs:
-            logger.warning("%d jobs status were not updated properly.")
-            logger.debug("Jobs not updated are: %s" % str(non_failed_jobs))
+    found_job_ids = sum((rval["job_ids"] for rval in cancelled.itervalues()),
+                        [])
+    logger.info("%d jobs cancelled" % len(found_job_ids))
 
-        job_ids_to_update = list(set(found_job_ids) - set(non_failed_jobs))
-        results = project.set(job_ids=job_ids_to_update,
-                              status=status.CANCELLED)
-        logger.info("%d jobs status updated" % sum(results))
+    if experiments_config is None or not found_job_ids:
+        return
 
-    # found_job_ids = pmap(
-    #     _cancel_jobs, clusters_config, _initialize_cancel_jobs,
-    #     initargs=(job_id, ))
-    # found_job_ids = sum(found_job_ids, [])
-    # logger.info("%d jobs cancelled" % len(found_job_ids))
+    confirmed = wait_cancelled(cumulus, cancelled)
+    job_ids_to_update = sum(confirmed.itervalues(), [])
+    if not job_ids_to_update:
+        return
 
-    results = pmap(
-        _cancel_db_jobs, experiments_config,
-        initializer=_initialize_cancel_db_jobs, initargs=(found_job_ids, ))
-    logger.info("%d jobs status updated" % sum(results))
+    # Rows submitted in job arrays have the job id of their task
+    results = Project(experiments_config).set(
+        job_ids=task_id_regex(job_ids_to_update), status=status.CANCELLED)
+    logger.info("%d jobs status updated" % sum(results.itervalues()))
 
 
 def get_options(argv):
@@ -215,6 +244,28 @@ def get_options(argv):
         "job_id", metavar="job-id",
         help="Job id to cancel. Can specify many using regex.")
 
+    cancel_subparser.add_argument(
+        "--tasks",
+        help="Range of tasks to cancel in the job arrays, ex: 0-99. All "
+             "tasks are cancelled by default.")
+
+    daemon_subparser = subparsers.add_parser(
+        DAEMON, help="Keep the clusters connected and deploy continuously")
+
+    daemon_subparser.add_argument(
+        "--poll-interval", type=float, default=POLL_INTERVAL,
+        help="Number of seconds between the polls of the queues")
+
+    daemon_subparser.add_argument(
+        "--deploy-interval", type=float, default=DEPLOY_INTERVAL,
+        help="Maximum number of seconds between deployments when no queue "
+             "changed")
+
+    daemon_subparser.add_argument(
+        "--metrics-file",
+        help="Json file where the timings of the loop and the backlog are "
+             "written after each cycle")
+
     return parser.parse_args(argv)
 
 
@@ -259,7 +310,12 @@ def main(argv=None):
         monitor(options.clusters_config, options.experiments_config,
                 options.summarize)
     elif options.command == CANCEL:
-        cancel(options.clusters_config, options.job_id)
+        cancel(options.clusters_config, options.experiments_config,
+               options.job_id, options.tasks)
+    elif options.command == DAEMON:
+        daemon(options.clusters_config, options.experiments_config,
+               options.poll_interval, options.deploy_interval,
+               options.metrics_file)
 
 
 if __name__ == "__main__":
@@ -18,23 +18,30 @@
 
 import atexit
 import argparse
+from collections import OrderedDict
 import datetime
 import glob
 import json
 import logging
-import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import select
 import socket
+import struct
 import sys
-import time
+import threading
+import uuid
 
 import lockfile
 
-from ..cluster import Cluster
+from ..cluster import Cluster, SERVER_READY, SERVER_ALREADY_RUNNING
 from ..scheduler import Scheduler
-from ..ssh import receive, send
+from ..scheduler.cache import QueueCache, DEFAULT_TTL, DEFAULT_INTERVAL
+from ..ssh import (
+    send, send_frame, read_message, read_frame, negotiate, JSON)
+from ..utils.snapshot import diff, is_empty
+from ..utils.tail import Tail, DEFAULT_POLL_INTERVAL
 
 
 logger = logging.getLogger(__name__)
@@ -49,7 +56,27 @@ lock_regex = re.compile('%s[.lock]*$' % LOCK_FILE)
 
 CLOSE_BUFFER = 60  # 1 minute
 
+SELECT_TIMEOUT = 1
+# Replies which cannot be sent within this number of seconds are dropped
+SEND_TIMEOUT = 10
+# Maximum number of bytes read from a connection at once
+RECV_SIZE = 64 * 1024
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PENDING = 64
+DEFAULT_MAX_CONNECTIONS = 64
+
+MAX_SNAPSHOTS = 128
+
+# Maximum number of log streams opened by a client at the same time
+MAX_TAILS = 16
+
 scheduler = Scheduler()
+queue_cache = QueueCache(scheduler)
+scheduler.cache = queue_cache
+
+snapshots = OrderedDict()
+snapshots_lock = threading.Lock()
 
 
 def get_lock_files():
@@ -98,149 +125,586 @@ def release_all_locks():
         pass
 
 
-def setup(client_socket, address):
-    kwargs = receive(client_socket)
+def setup(address, **kwargs):
     # TODO Oh oh, setup should be done by cluster, not scheduler...
-    send(client_socket, returncode=1, message="Not implemented yet")
+    return dict(returncode=1, message="Not implemented yet")
 
 
-def submit(client_socket, address):
-    kwargs = receive(client_socket)
+def submit(address, **kwargs):
     submitted = scheduler.submit(**kwargs)
-    send(client_socket, returncode=0, **submitted)
+    return dict(returncode=0, **submitted)
+
+
+def submit_batch(address, jobs, max_array_size=None, throttle=None,
+                 log_dir=None):
+    submitted = scheduler.submit_batch(jobs, max_array_size, throttle,
+                                       log_dir)
+    return dict(returncode=0, **submitted)
+
+
+def monitor(address, client_id=None, version=None, refresh=False, **kwargs):
+    queue, cache = queue_cache.get(refresh=refresh, **kwargs)
+    if client_id is None:
+        return dict(returncode=0, queue=queue, cache=cache)
+
+    # Keep the last snapshot sent to each client, for each query, and only send
+    # the delta if the client still has the same one.
+    key = (client_id, json.dumps(kwargs, sort_keys=True))
+    with snapshots_lock:
+        last_version, last_queue = snapshots.pop(key, (None, None))
+        if last_version is not None and version == last_version:
+            delta = diff(last_queue, queue)
+            if not is_empty(delta):
+                last_version = uuid.uuid4().hex
+            snapshots[key] = (last_version, queue)
+        else:
+            delta = None
+            snapshots[key] = (uuid.uuid4().hex, queue)
+
+        while len(snapshots) > MAX_SNAPSHOTS:
+            snapshots.popitem(last=False)
+
+        new_version = snapshots[key][0]
 
+    if delta is None:
+        return dict(returncode=0, version=new_version, queue=queue,
+                    cache=cache)
 
-def monitor(client_socket, address):
-    kwargs = receive(client_socket)
-    queue = scheduler.queue(**kwargs)
-    send(client_socket, returncode=0, queue=queue)
+    return dict(returncode=0, version=new_version, delta=delta, cache=cache)
 
 
-def cancel(client_socket, address):
-    kwargs = receive(client_socket)
+def cancel(address, **kwargs):
     rval = scheduler.cancel(**kwargs)
-    send(client_socket, returncode=0, **rval)
+    return dict(returncode=0, **rval)
 
 
-def ping(client_socket, address):
-    logger.debug("PING: Retrieving date")
-    date = receive(client_socket)["date"]
+def cancel_status(address, ticket):
+    rval = scheduler.cancel_status(ticket)
+    return dict(returncode=0, **rval)
+
+
+def ping(address, date, **kwargs):
     now = datetime.datetime.now()
     logger.debug("Sending PING")
-    send(client_socket, returncode=0, sent=date, received=str(now))
+    return dict(returncode=0, sent=date, received=str(now))
+
+
+def close(address, **kwargs):
+    # The lock is released later, in case the client comes back soon. Waiting
+    # here would hold a worker.
+    logger.debug("Releasing lock in %d seconds" % CLOSE_BUFFER)
+    timer = threading.Timer(CLOSE_BUFFER, delayed_release_lock)
+    timer.daemon = True
+    timer.start()
 
+    return dict(returncode=0, message="")
 
-def close(client_socket, address):
-    logger.debug("Waiting %d seconds before closing" % CLOSE_BUFFER)
-    time.sleep(CLOSE_BUFFER)
+
+def delayed_release_lock():
     try:
         release_lock()
     except RuntimeError, e:
-        returncode=1
-        message=e.message
-    else:
-        returncode=0
-        message=""
+        logger.warning("Could not release lock: %s" % str(e))
 
-    send(client_socket, returncode=returncode, message=message)
 
-
-def invalid(client_socket, address, command):
+def invalid(address, command):
     message = (
         "invalid command from address %s: %s" %
         (address, command))
     logger.error(message)
 
-    message = (
-        "invalid command: %s" %
-        (address, command))
+    message = "invalid command: %s" % command
+
+    return dict(returncode=1, message=message)
+
+
+def dispatch(command, address, kwargs):
+    logger.debug("Received command: %d" % command)
+    if command == Cluster.SETUP:
+        return setup(address, **kwargs)
+    elif command == Cluster.SUBMIT:
+        return submit(address, **kwargs)
+    elif command == Cluster.SUBMIT_BATCH:
+        return submit_batch(address, **kwargs)
+    elif command == Cluster.MONITOR:
+        return monitor(address, **kwargs)
+    elif command == Cluster.CANCEL:
+        return cancel(address, **kwargs)
+    elif command == Cluster.CANCEL_STATUS:
+        return cancel_status(address, **kwargs)
+    elif command == Cluster.PING:
+        return ping(address, **kwargs)
+    elif command == Cluster.CLOSE:
+        return close(address, **kwargs)
+    else:
+        return invalid(address, command)
+
+
+class Connection(object):
+
+    def __init__(self, client_socket, address):
+        self.socket = client_socket
+        self.address = address
+        self.session = False
+        # Bytes received and not parsed yet
+        self.buffer = bytearray()
+        self.encoding = JSON
+        self.compression = None
+        self.send_lock = threading.Lock()
+        self.tails = {}
+        self.tails_lock = threading.Lock()
+
+    def fileno(self):
+        return self.socket.fileno()
 
-    send(client_socket, returncode=1, message=message)
+    def close(self):
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
 
 
-def start_server(port):
+def serve_request(connection, request_id, request):
+    try:
+        reply = dispatch(request["command"], connection.address,
+                         request["kwargs"])
+    except Exception as e:
+        logger.exception("Command %s failed" % str(request["command"]))
+        reply = dict(returncode=1, message=str(e))
+
+    with connection.send_lock:
+        try:
+            if request_id is None:
+                send(connection.socket, **reply)
+                connection.close()
+            else:
+                send_frame(connection.socket, request_id, reply,
+                           connection.encoding, connection.compression)
+        except socket.error:
+            logger.warning("Could not send reply to %s" %
+                           str(connection.address))
+
+
+class TailStream(object):
+    """
+    Follow log files in a thread of its own and push their new lines to the
+    client, in frames tagged with the id of the TAIL request.
+
+    The first frame holds no lines, only the offsets from which the files are
+    followed. A frame is sent only when the client granted some credit,
+    otherwise the files are not read until it catches up. A last frame with
+    done=True is sent when the stream stops.
+    """
+
+    def __init__(self, connection, stream_id, paths, from_end=True,
+                 offsets=None, credit=1, max_lines=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.tail = Tail(paths, from_end, offsets, poll_interval)
+        self.credit = credit
+        self.max_lines = max_lines
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def add_credit(self, credit):
+        with self.condition:
+            self.credit += credit
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def _wait_credit(self):
+        with self.condition:
+            while self.credit <= 0 and not self.stopped:
+                self.condition.wait(SELECT_TIMEOUT)
+
+            if self.stopped:
+                return False
+
+            return True
+
+    def send(self, reply):
+        with self.connection.send_lock:
+            send_frame(self.connection.socket, self.stream_id, reply,
+                       self.connection.encoding, self.connection.compression)
+
+    def send_lines(self, lines, offsets):
+        # Logs often contain bytes which are not valid utf-8, ex: progress
+        # bars, and json cannot encode them
+        lines = dict((path, [line.decode("utf-8", "replace")
+                             for line in path_lines])
+                     for path, path_lines in lines.iteritems())
+        with self.condition:
+            self.credit -= 1
+        self.send(dict(returncode=0, done=False, lines=lines,
+                       offsets=offsets))
+
+    def run(self):
+        logger.debug("Following %d files for %s" %
+                     (len(self.tail.files), str(self.connection.address)))
+        try:
+            # Tell the client from where the files are followed
+            if self._wait_credit():
+                self.send_lines({}, self.tail.offsets())
+
+            while self._wait_credit():
+                lines = self.tail.read_lines(self.max_lines, SELECT_TIMEOUT)
+                if not lines:
+                    continue
+
+                offsets = self.tail.offsets()
+                self.send_lines(lines, dict((path, offsets[path])
+                                            for path in lines))
+
+            self.send(dict(returncode=0, done=True))
+        except socket.error as e:
+            logger.warning("Could not send log lines to %s: %s" %
+                           (str(self.connection.address), str(e)))
+        except Exception as e:
+            logger.exception("Log stream failed")
+            try:
+                self.send(dict(returncode=1, done=True, message=str(e)))
+            except socket.error:
+                pass
+        finally:
+            self.tail.close()
+            with self.connection.tails_lock:
+                self.connection.tails.pop(self.stream_id, None)
+            logger.debug("Log stream %d closed" % self.stream_id)
+
+
+class Server(object):
+    """
+    Single threaded event loop accepting connections and reading requests,
+    while commands are executed by a fixed pool of worker threads.
+
+    When `max_pending` requests are waiting for a worker, the server stops
+    reading from its clients until some requests are done, and when
+    `max_connections` clients are connected it stops accepting new ones. The
+    clients are throttled by the socket buffers in the meantime.
+
+    The event loop never blocks on a client: the bytes of each connection are
+    buffered as they arrive and requests are only handled once complete.
+    """
+
+    def __init__(self, serversocket, workers=DEFAULT_WORKERS,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.serversocket = serversocket
+        self.pool = ThreadPool(workers)
+        self.max_pending = max_pending
+        self.max_connections = max_connections
+
+        self.connections = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+
+    def serve(self):
+        while len(get_lock_files()) > 0:
+            read_list = [self.wakeup_read]
+            if len(self.connections) < self.max_connections:
+                read_list.append(self.serversocket)
+            if self.pending < self.max_pending:
+                read_list += self.connections
+
+            readable, _, _ = select.select(read_list, [], [], SELECT_TIMEOUT)
+
+            # Requests left in the buffers when too many were pending
+            for connection in self.connections[:]:
+                if connection.buffer:
+                    self.process(connection)
+
+            for r in readable:
+                if r == self.wakeup_read:
+                    os.read(self.wakeup_read, 1024)
+                elif r is self.serversocket:
+                    self.accept()
+                else:
+                    self.read(r)
+
+        logger.debug("All requests to socket server are done. Closing "
+                     "socket server")
+        self.close()
+
+    def accept(self):
+        try:
+            (client_socket, address) = self.serversocket.accept()
+        except socket.error:
+            return
+
+        client_socket.settimeout(SEND_TIMEOUT)
+        self.connections.append(Connection(client_socket, address))
+        logger.debug("Accepted connection from %s" % str(address))
+
+    def read(self, connection):
+        # select reported the socket readable, recv does not block
+        try:
+            data = connection.socket.recv(RECV_SIZE)
+        except socket.error:
+            data = None
+
+        if not data:
+            self.drop(connection)
+            return
+
+        connection.buffer.extend(data)
+        self.process(connection)
+
+    def process(self, connection):
+        """Handle the complete requests buffered, while workers are free"""
+        offset = 0
+        try:
+            while (connection in self.connections and
+                   self.pending < self.max_pending):
+                parsed = self.parse_request(connection, offset)
+                if parsed is None:
+                    break
+                request_id, request, offset = parsed
+                self.handle(connection, request_id, request)
+        except (struct.error, ValueError, KeyError, TypeError) as e:
+            logger.warning("Invalid request from %s: %s" %
+                           (str(connection.address), str(e)))
+            if connection in self.connections:
+                self.drop(connection)
+            return
+
+        del connection.buffer[:offset]
+
+    def parse_request(self, connection, offset):
+        """
+        Parse the request starting at offset in the buffer of the connection
+
+        Returns the request id, the request and the offset following it, or
+        None if the request is not complete yet. One-shot commands have no
+        request id.
+        """
+        if connection.session:
+            return read_frame(connection.buffer, offset)
+
+        parsed = read_message(connection.buffer, offset)
+        if parsed is None:
+            return None
+
+        request, offset = parsed
+        if request["command"] == Cluster.SESSION:
+            return None, request, offset
+
+        # One-shot commands send their kwargs in a second message
+        parsed = read_message(connection.buffer, offset)
+        if parsed is None:
+            return None
+
+        kwargs, offset = parsed
+        return None, dict(command=request["command"], kwargs=kwargs), offset
+
+    def handle(self, connection, request_id, request):
+        if request["command"] == Cluster.SESSION:
+            self.open_session(connection, request)
+            return
+
+        # Streams are handled by threads of their own, they would hold the
+        # workers indefinitely.
+        if request["command"] == Cluster.TAIL:
+            self.open_tail(connection, request_id, request["kwargs"])
+            return
+
+        if request["command"] == Cluster.TAIL_CONTROL:
+            self.control_tail(connection, **request["kwargs"])
+            return
+
+        if not connection.session:
+            # One-shot command, the worker closes the connection once the
+            # reply is sent.
+            self.connections.remove(connection)
+
+        with self.lock:
+            self.pending += 1
+
+        self.pool.apply_async(self.serve_one,
+                              (connection, request_id, request))
+
+    def open_session(self, connection, request):
+        connection.encoding, connection.compression = negotiate(
+            request.get("encodings", []), request.get("compressions", []))
+        logger.debug("Opening session with %s using encoding=%s "
+                     "compression=%s" % (str(connection.address),
+                                         connection.encoding,
+                                         connection.compression))
+        connection.session = True
+        send(connection.socket, returncode=0, message="",
+             encoding=connection.encoding,
+             compression=connection.compression)
+
+    def open_tail(self, connection, request_id, kwargs):
+        if not connection.session:
+            try:
+                send(connection.socket, returncode=1,
+                     message="Log streams are only available in sessions")
+            except socket.error:
+                pass
+            self.drop(connection)
+            return
+
+        with connection.tails_lock:
+            too_many = len(connection.tails) >= MAX_TAILS
+
+        try:
+            if too_many:
+                raise RuntimeError("Too many log streams opened, maximum is "
+                                   "%d" % MAX_TAILS)
+            tail = TailStream(connection, request_id, **kwargs)
+        except Exception as e:
+            logger.warning("Could not open log stream: %s" % str(e))
+            try:
+                with connection.send_lock:
+                    send_frame(connection.socket, request_id,
+                               dict(returncode=1, done=True, message=str(e)),
+                               connection.encoding, connection.compression)
+            except socket.error:
+                self.drop(connection)
+            return
+
+        with connection.tails_lock:
+            connection.tails[request_id] = tail
+        tail.start()
+
+    def control_tail(self, connection, stream_id, credit=0, stop=False):
+        with connection.tails_lock:
+            tail = connection.tails.get(stream_id)
+
+        if tail is None:
+            # Already done
+            return
+
+        if stop:
+            tail.stop()
+        elif credit > 0:
+            tail.add_credit(credit)
+
+    def stop_tails(self, connection):
+        with connection.tails_lock:
+            tails = connection.tails.values()
+
+        for tail in tails:
+            tail.stop()
+
+    def serve_one(self, connection, request_id, request):
+        # The callback of apply_async is only called on success, the request
+        # must be accounted for even if it failed.
+        try:
+            serve_request(connection, request_id, request)
+        except Exception:
+            logger.exception("Could not serve request from %s" %
+                             str(connection.address))
+        finally:
+            self.done()
+
+    def done(self):
+        with self.lock:
+            self.pending -= 1
+
+        os.write(self.wakeup_write, "x")
+
+    def drop(self, connection):
+        logger.debug("Connection with %s closed" % str(connection.address))
+        self.connections.remove(connection)
+        self.stop_tails(connection)
+        connection.close()
+
+    def close(self):
+        self.serversocket.close()
+        self.pool.close()
+        self.pool.join()
+        for connection in self.connections:
+            self.stop_tails(connection)
+            connection.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+
+def report(marker):
+    """Tell the process which launched the server about its status"""
+    sys.stdout.write("%s\n" % marker)
+    sys.stdout.flush()
+
+
+def daemonize(log_file=None):
+    """
+    Detach from the launching shell and redirect the outputs to log_file
+
+    Returns in the daemon only, the launching process reports readiness
+    and exits without running the atexit handlers.
+    """
+    if os.fork() > 0:
+        report(SERVER_READY)
+        os._exit(0)
+
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+
+    if log_file is None:
+        log_file = os.devnull
+
+    null = os.open(os.devnull, os.O_RDONLY)
+    log = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(null, sys.stdin.fileno())
+    os.dup2(log, sys.stdout.fileno())
+    os.dup2(log, sys.stderr.fileno())
+    os.close(null)
+    os.close(log)
+
+
+def start_server(port, workers=DEFAULT_WORKERS,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 poll_interval=DEFAULT_INTERVAL, cache_ttl=DEFAULT_TTL,
+                 daemon=False, log_file=None):
     if request_lock() > 1:
         release_lock()
         logger.warning("Socket server already running")
+        report(SERVER_ALREADY_RUNNING)
         return
 
     atexit.register(release_all_locks)
 
     serversocket = socket.socket(
         socket.AF_INET, socket.SOCK_STREAM)
+    serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     serversocket.bind((socket.gethostname(), port))
     serversocket.listen(10)
+    logger.info("Socket server now listening on port %d" % port)
+
+    # The socket is already listening, clients can connect while the
+    # daemon starts.
+    if daemon:
+        daemonize(log_file)
+    else:
+        report(SERVER_READY)
 
     # TODO Put a timeout for no clients.
     # If not closed but no clients since X seconds, close anyway.
     # Maybe use X = 2 * CLOSE_BUFFER?
-    (clientsocket, address) = serversocket.accept()
-    p = multiprocessing.Process(
-        target=cmd, args=[clientsocket, address])
-    p.start()
-    processes = [p]
-    read_list = [serversocket, clientsocket]
-    while True:
-        # Accept connections from outside
-        readable, writable, errored = select.select(read_list, [], [])
-
-        if len(get_lock_files()) == 0:
-            logger.debug("All requests to socket server are done. Closing "
-                         "socket server")
-            break
-
-        for s in readable:
-            # Add a new client
-            if s is serversocket:
-                # Set a small timeout to avoid blocking on accept.
-                # It is very likely that no other socket get connected
-                # and the server cannot receive the close command if it is
-                # blocked on accept()
-                # defaulttimeout = socket.getdefaulttimeout()
-                # Gives 30 seconds for a new client to connect if any other
-                # socket.setdefaulttimeout(30)
-                try:
-                    (clientsocket, address) = serversocket.accept()
-                except socket.timeout:
-                    pass
-                else:
-                    read_list.append(clientsocket)
-                    p = multiprocessing.Process(
-                        target=cmd, args=[clientsocket, address])
-                    p.start()
-                    processes.append(p)
-                # finally:
-                #     socket.setdefaulttimeout(defaulttimeout)
-            # Remove any client which is done
-            else:
-                s_index = read_list.index(s)
-                process = processes[s_index - 1]
-                if not process.is_alive():
-                    del processes[s_index - 1]
-                    del read_list[s_index]
-
-    serversocket.close()
+    queue_cache.interval = poll_interval
+    queue_cache.ttl = cache_ttl
+    queue_cache.start()
 
+    server = Server(serversocket, workers, max_pending, max_connections)
+    server.serve()
 
-def cmd(client_socket, address):
-    command = receive(client_socket)["command"]
-    logger.debug("Received command: %d" % command)
-    if command == Cluster.SETUP:
-        setup(client_socket, address)
-    if command == Cluster.SUBMIT:
-        submit(client_socket, address)
-    elif command == Cluster.MONITOR:
-        monitor(client_socket, address)
-    elif command == Cluster.CANCEL:
-        cancel(client_socket, address)
-    elif command == Cluster.PING:
-        ping(client_socket, address)
-    elif command == Cluster.CLOSE:
-        close(client_socket, address)
-    else:
-        invalid(client_socket, address, command)
-
-    client_socket.close()
+    queue_cache.stop()
 
 
 def get_options(argv):
@@ -256,6 +720,38 @@ def get_options(argv):
         "--port", default=9990, type=int,
         help="Port used by socket server")
 
+    open_subparser.add_argument(
+        "--workers", default=DEFAULT_WORKERS, type=int,
+        help="Number of threads executing the commands")
+
+    open_subparser.add_argument(
+        "--max-pending", default=DEFAULT_MAX_PENDING, type=int,
+        help="Maximum number of commands waiting for a worker before the "
+             "server stops reading requests")
+
+    open_subparser.add_argument(
+        "--max-connections", default=DEFAULT_MAX_CONNECTIONS, type=int,
+        help="Maximum number of clients connected simultaneously")
+
+    open_subparser.add_argument(
+        "--poll-interval", default=DEFAULT_INTERVAL, type=float,
+        help="Number of seconds between refreshes of the cached queue")
+
+    open_subparser.add_argument(
+        "--cache-ttl", default=DEFAULT_TTL, type=float,
+        help="Number of seconds after which a cached queue is stale and "
+             "must be refreshed before being served")
+
+    open_subparser.add_argument(
+        "--daemon", action="store_true",
+        help="Run in background once the server is listening. The launching "
+             "process prints %s and exits." % SERVER_READY)
+
+    open_subparser.add_argument(
+        "--log-file",
+        help="File where the daemon writes its outputs. Defaults to "
+             "/dev/null.")
+
     open_subparser.add_argument(
         '-v', '--verbose', action='count', default=0,
         help="Print informations about the process.\n"
@@ -277,7 +773,13 @@ def main(argv=None):
         logging.basicConfig(level=logging.DEBUG)
 
     if options.command == OPEN:
-        start_server(options.port)
+        start_server(options.port, workers=options.workers,
+                     max_pending=options.max_pending,
+                     max_connections=options.max_connections,
+                     poll_interval=options.poll_interval,
+                     cache_ttl=options.cache_ttl,
+                     daemon=options.daemon,
+                     log_file=options.log_file)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,22 @@
+from collections import OrderedDict
 import copy
 import datetime
+import json
 import logging
 import os
 import socket
 import struct
 import time
+import uuid
 
 from .. import config
 from ..ssh import (
-    rsync, open_ssh_tunnel, receive, send, exec_command, line_buffered)
-from ..scheduler.base import AbstractScheduler
+    connect_fastest, open_ssh_tunnel, exec_command, iter_lines, receive, send)
+from ..scheduler.table import JobTable
+from ..utils.snapshot import patch
+from .ledger import SlotLedger
+from .logsync import LogSync, DEFAULT_STREAMS
+from .session import Session
 
 
 logger = logging.getLogger(__name__)
@@ -20,23 +27,50 @@ logger = logging.getLogger(__name__)
 # Scheduler. The informations spit out of get_queues do not contains
 # ChildScheduler.status but AbstractScheduler.status after all.
 
-SERVER_READY_LOG = (
-    "INFO:cumulus.bin.cumulus_socket:Socket server now listening")
+# Printed on stdout by cumulus-socket open
+SERVER_READY = "CUMULUS-SOCKET-READY"
+SERVER_ALREADY_RUNNING = "CUMULUS-SOCKET-ALREADY-RUNNING"
 
-SERVER_ALREADY_RUNNING_LOG = (
-    "WARNING:cumulus.bin.cumulus_socket:Socket server already running")
+SERVER_START_TIMEOUT = 2 * 60
+PROBE_INTERVAL = 0.1
+
+# Number of frames of log lines the socket server may send ahead of the client
+TAIL_CREDIT = 8
+TAIL_MAX_LINES = 1000
 
 
 class Cluster(object):
 
-    SETUP, SUBMIT, MONITOR, CANCEL, PING, CLOSE = range(6)
+    (SETUP, SUBMIT, MONITOR, CANCEL, PING, CLOSE, SESSION, TAIL,
+     TAIL_CONTROL, SUBMIT_BATCH, CANCEL_STATUS) = range(11)
 
     def __init__(self, name, home, hostnames, username=None, password=None,
-                 priority=None, lazy=False):
+                 priority=None, timeout=None, log_dir=None,
+                 max_array_size=None, array_throttle=None, max_jobs=None,
+                 threshold=None, default_queue=None, lazy=False):
 
         self.name = name
         self.home = home
+        if log_dir is None:
+            # smart-dispatch writes its logs in the working directory
+            log_dir = os.path.join(home, "SMART_DISPATCH_LOGS")
+        self.log_dir = log_dir
         self.priority = priority
+        # Maximum number of seconds Cumulus waits for this cluster
+        self.timeout = timeout
+        # Maximum number of tasks per job array, defaults to the scheduler's
+        self.max_array_size = max_array_size
+        # Maximum number of tasks of a job array running at the same time
+        self.array_throttle = array_throttle
+        # Queue, or partition, of the jobs whose experiment does not set one
+        self.default_queue = default_queue
+        # Maximum number of tasks submitted at the same time, and number of
+        # tasks queued above which no more are submitted
+        if max_jobs is None:
+            max_jobs = config["max_jobs"]
+        if threshold is None:
+            threshold = config["queue_threshold"]
+        self.ledger = SlotLedger(max_jobs, threshold)
 
         self.hostnames = hostnames
         if username is None:
@@ -44,22 +78,37 @@ class Cluster(object):
         self.username = username
         self.password = password
         self.sshtunnel = None
+        self.session = None
+        self.client_id = uuid.uuid4().hex
+        self._queue_snapshots = {}
+        self.queue_cache = None
+        # Changes whenever the queue returned by the socket server changed
+        self.queue_version = None
         self.connected_hostname = None
+        self.startup_timings = OrderedDict()
+        self.lazy = lazy
         if not lazy:
             self.start_remote_server()
 
     def detach_ssh_tunnel(self):
-        ssh_tunnel = self.sshtunnel
-        self.sshtunnel = None
+        ssh_tunnel, session = self.sshtunnel, self.session
+        self.sshtunnel, self.session = None, None
         cluster = copy.deepcopy(self)
-        self.sshtunnel = ssh_tunnel
+        self.sshtunnel, self.session = ssh_tunnel, session
         return cluster, ssh_tunnel
 
+    @property
+    def ssh_pkey(self):
+        return "%s/.ssh/id_rsa" % os.environ["HOME"]
+
     def start_remote_server(self):
         logger.debug("Starting remote socket server")
         if self.connected_hostname is not None:
             raise RuntimeError("Remote socket server already started")
 
+        self.startup_timings = OrderedDict()
+        start = time.time()
+
         # open socket server on cluster
         # use sockets to requests info from cluster
         # hostname, ssh_client = open_ssh_client(
@@ -78,73 +127,101 @@ class Cluster(object):
         # ssh_client.close()
 
         # remote_addr = "127.0.0.1"
-        self.connected_hostname, self.local_port, self.sshtunnel = (
-            open_ssh_tunnel(
-                self.hostnames, self.username, self.password,
-                ssh_pkey="%s/.ssh/id_rsa" % os.environ["HOME"],
-                remote_addr="localhost", remote_port=config["remote_port"]))
-
-        _, stdout, stderr, nohup_channel = exec_command(
-            self.sshtunnel._transport,
-            "nohup %(home)s/cumulus/cumulus/bin/cumulus-particle "
-            "--work-on cumulus cumulus-socket open --port %(port)d -vv"
-            ">>%(home)s/cumulus-%(name)s-open-socket.log 2>&1 </dev/null &" %
-            dict(home=self.home, name=self.name,
-                 port=config["remote_port"]))
+        if self.sshtunnel is not None and self.sshtunnel.is_active:
+            # The tunnel may have failed over to another login node
+            self.connected_hostname = self.sshtunnel.hostname
+        else:
+            if self.sshtunnel is not None:
+                self.sshtunnel.stop()
+            self.connected_hostname, self.local_port, self.sshtunnel = (
+                open_ssh_tunnel(
+                    self.hostnames, self.username, self.password,
+                    ssh_pkey=self.ssh_pkey,
+                    remote_addr="localhost",
+                    remote_port=config["remote_port"]))
 
-        nohup_channel.close()
+        self.startup_timings["tunnel"] = time.time() - start
 
-        _, stdout, stderr, tail_channel = exec_command(
-            self.sshtunnel._transport,
-            "tail -n 1 -f %(home)s/cumulus-%(name)s-open-socket.log" %
-            dict(home=self.home, name=self.name))
+        try:
+            phase_start = time.time()
+            self._launch_remote_server(deadline=start + SERVER_START_TIMEOUT)
+            self.startup_timings["launch"] = time.time() - phase_start
+
+            phase_start = time.time()
+            self._wait_remote_server(deadline=start + SERVER_START_TIMEOUT)
+            self.startup_timings["ping"] = time.time() - phase_start
+        except BaseException:
+            self.connected_hostname = None
+            raise
 
-        logger.info("Waiting for server status confirmation")
-        MAX_WAIT = 2 * 60
-        start = time.clock()
-        for line in line_buffered(stdout):
-            line = line.strip()
-            logger.debug(line)
-            if (line == SERVER_READY_LOG or
-                    line == SERVER_ALREADY_RUNNING_LOG or
-                    time.clock() - start > MAX_WAIT):
-                break
-
-        logger.debug("Close tail channel")
-        tail_channel.close()
-        logger.debug("Received: %s" % line)
+        self.startup_timings["total"] = time.time() - start
 
-        # while not ssh_client.exit_status_ready():
-        #     time.sleep(0.5)
+        logger.info("Remote socket server ready in %.2fs (%s)" %
+                    (self.startup_timings["total"],
+                     ", ".join("%s=%.2fs" % item for item in
+                               self.startup_timings.iteritems()
+                               if item[0] != "total")))
 
-        logger.debug("Remote socket server ready. Now verifying.")
+    def _launch_remote_server(self, deadline):
+        # The server prints its status on stdout once it listens, then
+        # detaches. No need to watch its log.
+        _, stdout, stderr, channel = exec_command(
+            self.sshtunnel._transport,
+            "%(home)s/cumulus/cumulus/bin/cumulus-particle "
+            "--work-on cumulus cumulus-socket open --port %(port)d -vv "
+            "--daemon --log-file %(home)s/cumulus-%(name)s-open-socket.log "
+            "</dev/null" %
+            dict(home=self.home, name=self.name,
+                 port=config["remote_port"]))
 
-        # logger.debug("SSH-client STDOUT: %s" % stdout.read())
-        # logger.debug("SSH-client STDERR: %s" % stderr.read())
+        logger.info("Waiting for server status confirmation")
+        try:
+            for line in iter_lines(channel, deadline=deadline):
+                line = line.strip()
+                logger.debug(line)
+                if line in (SERVER_READY, SERVER_ALREADY_RUNNING):
+                    logger.debug("Received: %s" % line)
+                    return line
+
+            raise RuntimeError(
+                "Remote server exited with status %d before being ready: %s" %
+                (channel.recv_exit_status(), stderr.read()))
+        except socket.timeout:
+            raise RuntimeError(
+                "Remote server did not report its status within %d seconds" %
+                SERVER_START_TIMEOUT)
+        finally:
+            channel.close()
 
+    def _wait_remote_server(self, deadline):
         logger.debug("Probing socket")
-        MAX_WAIT = 5 * 60
-        WAIT_STEP = 10
-        waited = 0
-        start = time.clock()
-        while waited <= MAX_WAIT:
+        while True:
             try:
-                rval = self.ping(date=str(datetime.datetime.now()),
-                                 resilience=0)
-            except (socket.error, struct.error):
-                waited = time.clock() - start
-                time.sleep(WAIT_STEP - (waited % WAIT_STEP))
-                waited = time.clock() - start
-                success = False
+                rval = self._probe_server()
+            except (socket.error, struct.error) as e:
+                if time.time() > deadline:
+                    raise RuntimeError(
+                        "Failed to start remote server: %s" % str(e))
+                time.sleep(PROBE_INTERVAL)
             else:
                 logger.debug("PING: %s" % str(rval))
-                success = True
-                break
+                return rval
 
-        if success:
-            logger.info("Remote socket server ready.")
-        else:
-            raise RuntimeError("Failed to start remote server.")
+    def _probe_server(self):
+        # Called while the session is being opened, so the ping is sent on a
+        # one-shot connection of its own.
+        s = socket.create_connection(("localhost", self.local_port), 5)
+        try:
+            send(s, command=self.PING)
+            send(s, date=str(datetime.datetime.now()))
+            rval = receive(s)
+        finally:
+            s.close()
+
+        if not rval:
+            raise socket.error("Socket server closed the connection")
+
+        return rval
 
     def close_remote_server(self):
         logger.info("Closing remote socket server")
@@ -159,11 +236,17 @@ class Cluster(object):
         except socket.error:
             logger.warning("Tried to close remote socket server %s but it was "
                            "inaccessible." % self.connected_hostname)
+        except RuntimeError as e:
+            logger.warning("Remote socket server %s could not close cleanly: "
+                           "%s" % (self.connected_hostname, str(e)))
         else:
             logger.info("Remote socket server closed.")
             logger.debug("Remote socket server closed with message: %s" %
                          str(feedback))
         finally:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
             self.connected_hostname = None
             if self.sshtunnel is not None:
                 self.sshtunnel.stop()
@@ -178,6 +261,12 @@ class Cluster(object):
             raise RuntimeError("No remote server started")
         elif self.connected_hostname is None and self.lazy:
             self.start_remote_server()
+        elif self.sshtunnel.hostname != self.connected_hostname:
+            logger.info("Tunnel failed over from %s to %s, starting the "
+                        "socket server there" %
+                        (self.connected_hostname, self.sshtunnel.hostname))
+            self.connected_hostname = None
+            self.start_remote_server()
 
         logger.debug("Opening a socket")
         s = socket.socket(
@@ -211,16 +300,23 @@ class Cluster(object):
 
         return s
 
+    def _get_session(self):
+        if self.session is None:
+            self.session = Session(
+                self.get_client_socket, self.SESSION,
+                repeatable=(self.PING, self.MONITOR, self.CANCEL_STATUS))
+
+        return self.session
+
     def _command(self, command_id, resilience=1, **kwargs):
-        client_socket = self.get_client_socket(resilience)
-        logger.debug("Sending command=%d" % command_id)
-        send(client_socket, command=command_id)
-        logger.debug("Sending %s" % str(kwargs))
-        send(client_socket, **kwargs)
-        response = receive(client_socket)
+        logger.debug("Sending command=%d with %s" % (command_id, str(kwargs)))
+        response = self._get_session().request(
+            command_id, resilience=resilience, **kwargs)
         logger.debug("Received %s" % str(response))
-        client_socket.close()
-        logger.debug("Client socket closed.")
+        if response.get("returncode", 0) != 0:
+            raise RuntimeError("Command %d failed on %s: %s" %
+                               (command_id, self.name,
+                                response.get("message", str(response))))
         return response
 
     def ping(self, **kwargs):
@@ -229,35 +325,142 @@ class Cluster(object):
     def setup(self, **kwargs):
         return self._command(self.SETUP, **kwargs)
 
-    def deploy(self, **kwargs):
-        return self._command(self.SUBMIT, **kwargs)
+    def submit_batch(self, jobs):
+        """
+        Submit jobs in as few job arrays as possible and return the job id of
+        the task of each row id, see Scheduler.submit_batch. The tasks write
+        their outputs in log_dir, where retrieve_logs and tail find them.
+        """
+        response = self._command(self.SUBMIT_BATCH, jobs=jobs,
+                                 max_array_size=self.max_array_size,
+                                 throttle=self.array_throttle,
+                                 log_dir=self.log_dir)
+        # Row ids come back as strings when the session encodes in json
+        for key in ["tasks", "errors"]:
+            response[key] = dict(
+                (int(row_id), value)
+                for row_id, value in response[key].iteritems())
+        self.ledger.record_submission(len(response["tasks"]))
+        return response
+
+    def queue(self, refresh=False, **kwargs):
+        kwargs = dict((k, v) for k, v in kwargs.iteritems() if v is not None)
+        # The socket server only sends what changed since our last snapshot
+        key = json.dumps(kwargs, sort_keys=True)
+        version, snapshot = self._queue_snapshots.get(key, (None, None))
+        response = self._command(self.MONITOR, client_id=self.client_id,
+                                 version=version, refresh=refresh, **kwargs)
+        # Age and staleness of the queue cached by the socket server
+        self.queue_cache = response.get("cache")
+        if "delta" in response:
+            queue = patch(snapshot, response["delta"])
+        else:
+            queue = response["queue"]
+
+        self._queue_snapshots[key] = (response["version"], queue)
+        self.queue_version = response["version"]
+
+        # The ledger follows the unfiltered queue
+        if not kwargs:
+            snapshot_time = time.time()
+            if self.queue_cache and self.queue_cache.get("age") is not None:
+                snapshot_time -= self.queue_cache["age"]
+            if "delta" in response:
+                self.ledger.update(response["delta"], queue, snapshot_time)
+            else:
+                self.ledger.reset(queue, snapshot_time)
 
-    def queue(self, **kwargs):
-        return self._command(self.MONITOR, **kwargs)["queue"]
+        return queue
 
     def cancel(self, **kwargs):
-        return self._command(self.CANCEL, **kwargs)
-
-    def get_free_slots(self):
-        jobs = self.get_queues()
-        logger.info("%d jobs found by parser" % len(jobs))
-        submitted_jobs = 0
-        queued_jobs = 0
-        for job in jobs.itervalues():
-            if AbstractScheduler.COMPLETED in job['job_array']:
-                del job['job_array'][AbstractScheduler.COMPLETED]
-            submitted_job_arrays = sum(job['job_array'].itervalues())
-            submitted_jobs += submitted_job_arrays
-            running_jobs = job['job_array'][AbstractScheduler.RUNNING]
-            queued_jobs += (submitted_job_arrays - running_jobs)
-
-        logger.info("%d queued jobs found by parser" % queued_jobs)
-        logger.info("%d submitted_jobs found by parser" % submitted_jobs)
-
-        if queued_jobs < self.threshold:  # and threshold < submitted_jobs:
-            return self.max_jobs - submitted_jobs
-        else:
-            return 0
+        """
+        Cancel jobs with a single scheduler call, see Scheduler.cancel. The
+        ticket returned is given to cancel_status to confirm the
+        cancellation.
+        """
+        response = self._command(self.CANCEL, **kwargs)
+        # Only whole jobs free their slots
+        if kwargs.get("job_array_id") is None:
+            self.ledger.record_cancellation(
+                set(response["job_ids"]) - set(response["failed"]))
+        return response
+
+    def cancel_status(self, ticket):
+        return self._command(self.CANCEL_STATUS, ticket=ticket)
+
+    def tail(self, paths, from_end=True, offsets=None, credit=TAIL_CREDIT,
+             max_lines=TAIL_MAX_LINES):
+        """
+        Follow log files on the cluster and return an iterator of their new
+        lines as (path, line), as they are written
+
+        Parameters
+        ----------
+
+        paths: list of str
+            Paths relative to log_dir, or absolute.
+        from_end: bool
+            Only yield lines written after the call, otherwise read the files
+            from their beginning.
+        offsets: dict or None
+            Position from which to read each path, overrides from_end.
+        credit: int
+            Number of frames the socket server may send ahead. The server
+            stops reading the files when the client lags behind.
+        max_lines: int
+            Maximum number of lines in a frame.
+        """
+        paths = [os.path.join(self.log_dir, path) for path in paths]
+        stream = self._get_session().stream(
+            self.TAIL, self.TAIL_CONTROL, credit, paths=paths,
+            from_end=from_end, offsets=offsets, max_lines=max_lines)
+        # Wait until the server follows the files rather than until the first
+        # iteration, so that no line written in between is missed.
+        frames = iter(stream)
+        try:
+            next(frames)
+        except BaseException:
+            stream.close()
+            raise
 
-    def retrieve_logs(self, output_dir):
-        stdout, stderr = rsync(self, output_dir)
+        return self._iter_tail(stream, frames)
+
+    def _iter_tail(self, stream, frames):
+        try:
+            for frame in frames:
+                for path, lines in frame["lines"].iteritems():
+                    for line in lines:
+                        yield path, line
+        finally:
+            stream.close()
+
+    def queue_table(self, attributes=tuple(), **kwargs):
+        return JobTable.from_queue(self.queue(**kwargs), attributes)
+
+    def get_free_slots(self, refresh=False):
+        """
+        Number of tasks which can be submitted, from the ledger kept up to
+        date by queue, submit_batch and cancel. The queue is only
+        fetched if it never was or if refresh is True.
+        """
+        if refresh or not self.ledger.synced:
+            self.queue()
+
+        free_slots = self.ledger.free_slots()
+        logger.info("%d free slots on %s, ledger: %s" %
+                    (free_slots, self.name, str(self.ledger.summary())))
+
+        return free_slots
+
+    def retrieve_logs(self, output_dir, streams=DEFAULT_STREAMS):
+        """
+        Copy the new and grown files of log_dir into output_dir and return a
+        report of the transfer, see LogSync.run
+        """
+        connection = connect_fastest(self.hostnames, self.username,
+                                     self.password, self.ssh_pkey)
+        try:
+            return LogSync(connection, self.log_dir, output_dir,
+                           streams).run()
+        finally:
+            connection.release()
@@ -0,0 +1,192 @@
+"""
+    Allocation of the queued rows of many experiments to the free slots of
+    many clusters, in a single vectorized pass.
+
+    Ex:
+        assignment = allocate(free_slots=[10, 5], counts=[8, 8, 2])
+        assignment.matrix  # rows of each experiment given to each cluster
+        assignment.split(row_ids)  # row ids by cluster index and experiment
+
+    The clusters are filled in the order given, so that when there are more
+    free slots than rows, the first clusters get all the rows. The number of
+    rows taken from each experiment is proportional to its weight, but never
+    more than its backlog. Each cluster gets a proportional mix of the
+    experiments, and each row is assigned at most once.
+"""
+
+import numpy
+
+
+def quotas(counts, weights, total):
+    """
+    Number of rows to take from each experiment so that they sum to total,
+    proportionally to weights but at most counts
+
+    Parameters
+    ----------
+
+    counts: array of int
+        Number of queued rows of each experiment.
+    weights: array of float
+        Experiments with a weight of 0 get no rows.
+    total: int
+        Must not be larger than the sum of counts with a positive weight.
+    """
+    counts = numpy.asarray(counts, dtype=float)
+    weights = numpy.asarray(weights, dtype=float)
+    shares = numpy.zeros(len(counts))
+    if total <= 0:
+        return shares.astype(int)
+
+    # Water-filling: the experiments whose backlog is smaller than their
+    # share are capped, and the others share what is left in proportion of
+    # their weights.
+    active = weights > 0
+    ratios = numpy.full(len(counts), numpy.inf)
+    ratios[active] = counts[active] / weights[active]
+    order = numpy.argsort(ratios, kind="mergesort")
+    sorted_counts = numpy.where(active, counts, 0)[order]
+    sorted_weights = numpy.where(active, weights, 0)[order]
+
+    capped_counts = numpy.concatenate([[0], numpy.cumsum(sorted_counts)])
+    remaining_weights = numpy.cumsum(sorted_weights[::-1])[::-1]
+    # The first experiment whose ratio is above the level is not capped, nor
+    # any after it. Experiments without weight are last, with a nan level.
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        levels = (total - capped_counts[:-1]) / remaining_weights
+        uncapped = numpy.flatnonzero(levels <= ratios[order])
+    first = uncapped[0] if len(uncapped) else len(counts)
+    level = levels[first] if first < len(counts) else 0.
+
+    sorted_shares = numpy.where(numpy.arange(len(counts)) < first,
+                                sorted_counts, level * sorted_weights)
+    shares[order] = numpy.minimum(sorted_shares, sorted_counts)
+
+    # Largest remainders, the experiments with a fractional share are not
+    # capped so they can take one more row.
+    integers = numpy.floor(shares + 1e-9).astype(int)
+    missing = int(total - integers.sum())
+    if missing > 0:
+        remainders = shares - integers
+        integers[numpy.argsort(-remainders, kind="mergesort")[:missing]] += 1
+
+    return integers
+
+
+class Assignment(object):
+
+    def __init__(self, clusters, experiments, positions, n_clusters,
+                 n_experiments):
+        """
+        Parameters
+        ----------
+
+        clusters: array of int
+            Index of the cluster of each row assigned.
+        experiments: array of int
+            Index of the experiment of each row assigned.
+        positions: array of int
+            Position of each row assigned in the backlog of its experiment.
+        """
+        self.clusters = clusters
+        self.experiments = experiments
+        self.positions = positions
+        self.n_clusters = n_clusters
+        self.n_experiments = n_experiments
+
+    def __len__(self):
+        return len(self.clusters)
+
+    @property
+    def matrix(self):
+        """Number of rows of each experiment (columns) by cluster (rows)"""
+        return numpy.bincount(
+            self.clusters * self.n_experiments + self.experiments,
+            minlength=self.n_clusters * self.n_experiments).reshape(
+                self.n_clusters, self.n_experiments)
+
+    def split(self, row_ids):
+        """
+        Return the row ids assigned to each cluster, as a list with a dict of
+        row ids by experiment index for each cluster
+
+        Parameters
+        ----------
+
+        row_ids: list of arrays
+            Row ids of the backlog of each experiment, in the order they
+            should be taken.
+        """
+        offsets = numpy.concatenate(
+            [[0], numpy.cumsum([len(ids) for ids in row_ids], dtype=int)])
+        all_ids = numpy.empty(offsets[-1], dtype=object)
+        for index, ids in enumerate(row_ids):
+            all_ids[offsets[index]:offsets[index + 1]] = ids
+
+        # Group by cluster then by experiment, keeping the backlog order
+        order = numpy.lexsort((self.positions, self.experiments,
+                               self.clusters))
+        sorted_ids = all_ids[offsets[self.experiments] + self.positions][order]
+        groups = (self.clusters * self.n_experiments +
+                  self.experiments)[order]
+        boundaries = numpy.flatnonzero(numpy.diff(groups)) + 1
+        starts = numpy.concatenate([[0], boundaries])
+        ends = numpy.concatenate([boundaries, [len(groups)]])
+
+        split_ids = [dict() for _ in xrange(self.n_clusters)]
+        for start, end in zip(starts, ends):
+            if start == end:
+                continue
+            cluster, experiment = divmod(groups[start], self.n_experiments)
+            split_ids[cluster][experiment] = sorted_ids[start:end].tolist()
+
+        return split_ids
+
+
+def allocate(free_slots, counts, weights=None):
+    """
+    Assign rows of experiments to clusters
+
+    Parameters
+    ----------
+
+    free_slots: array of int
+        Free slots of each cluster, in the order the clusters should be
+        filled.
+    counts: array of int
+        Number of queued rows of each experiment.
+    weights: array of float or None
+        Relative share of the slots for each experiment. Defaults to counts,
+        so that experiments are drained at the same pace.
+
+    Returns
+    -------
+
+    Assignment
+    """
+    free_slots = numpy.maximum(numpy.asarray(free_slots, dtype=int), 0)
+    counts = numpy.asarray(counts, dtype=int)
+    if weights is None:
+        weights = counts
+    weights = numpy.asarray(weights, dtype=float)
+
+    demand = int(counts[weights > 0].sum())
+    total = min(int(free_slots.sum()), demand)
+    experiment_quotas = quotas(counts, weights, total)
+
+    # Interleave the rows of the experiments: the j-th row of an experiment
+    # with quota q is placed at (j + 0.5) / q of the sequence of slots.
+    experiments = numpy.repeat(numpy.arange(len(counts)), experiment_quotas)
+    starts = numpy.concatenate([[0], numpy.cumsum(experiment_quotas)[:-1]])
+    positions = numpy.arange(total) - starts[experiments]
+    keys = (positions + 0.5) / experiment_quotas[experiments]
+    order = numpy.argsort(keys, kind="mergesort")
+
+    # The sequence of slots fills the clusters one after the other
+    slots = numpy.empty(total, dtype=int)
+    slots[order] = numpy.arange(total)
+    clusters = numpy.searchsorted(numpy.cumsum(free_slots), slots,
+                                  side="right")
+
+    return Assignment(clusters, experiments, positions, len(free_slots),
+                      len(counts))
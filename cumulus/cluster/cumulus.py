@@ -1,17 +1,21 @@
 import os
 
-import numpy
-
 from ..cluster import Cluster
-from ..database import Database
-from ..utils.process import pmap
+from ..database import status
+from ..database.base import AbstractDatabase
+from .allocation import allocate
+from .fanout import fan_out
+from .policy import RankingPolicy
 
 
 class Cumulus(object):
 
-    def __init__(self, clusters_config, lazy=True):
+    def __init__(self, clusters_config, lazy=True, policy=None):
         self.clusters = [Cluster(lazy=lazy, **cluster_config)
                          for cluster_config in clusters_config]
+        if policy is None:
+            policy = RankingPolicy.load()
+        self.policy = policy
 
     @property
     def cluster_names(self):
@@ -23,117 +27,232 @@ class Cumulus(object):
 
     @property
     def clusters_sorted_by_priority(self):
-        if any(cluster.priority is not None for cluster in self.clusters):
-            upper_bound = max(cluster.priority for cluster in self.clusters
-                              if cluster.priority is not None)
-        else:
-            upper_bound = 1
+        """
+        Clusters sorted by the expected time before a job submitted now
+        starts, see RankingPolicy.rank
+        """
+        return self.policy.rank(self.clusters)
 
-        for cluster in self.clusters:
-            if cluster.priority is None:
-                cluster.priority = numpy.random.uniform(upper_bound + 1)
+    @property
+    def timeouts(self):
+        return dict((c.name, c.timeout) for c in self.clusters)
 
-        return sorted(self.clusters, key=lambda c: c.priority)
+    def _fan_out(self, fct, clusters=None, args=None):
+        if clusters is None:
+            clusters = self.clusters
 
-    def connect(self):
-        rval = pmap(
-            _connect, ((c.name, ) for c in self.clusters),
-            initializer=_initialize_clusters,
-            initargs=[self.clusters_dict])
+        return fan_out(fct, clusters, args=args, timeout=self.timeouts)
 
-        return rval
+    def connect(self):
+        return self._fan_out(_connect)
 
-    def deploy(self, project):
-        sorted_clusters = self.clusters_sorted_by_priority
-        cluster_names = map(lambda c: getattr(c, "name"), sorted_clusters)
+    def deploy(self, project, queues=None):
+        self.update_stats(queues)
 
-        deployed = {}
-        queued_experiments = project.get(status=project.QUEUED)
+        queued_experiments = project.get(status=status.QUEUED)
 
-        if all(len(e) == 0 for e in queued_experiments):
-            return dict(zip(cluster_names, [{} for _ in cluster_names))
+        if all(len(e) == 0 for e in queued_experiments.itervalues()):
+            return dict((c.name, {}) for c in self.clusters)
 
         free_slots = self.get_free_slots()
 
         ids_to_deploy = self.distribute_experiments(
             free_slots, queued_experiments)
 
-        deployed = pmap(
-            _deploy,
-            ((cluster, ids_to_deploy[cluster.name], project)
-             for cluster in sorted_clusters))
-        cluster_names = map(lambda c: getattr(c, "name"), sorted_clusters)
-        return dict(zip(cluster_names, deployed))
-
-    def distribute_experiments(self, free_slots, experiments):
-        nb_of_experiments = numpy.array(
-            len(e) for e in experiments.itervalues())
-
-        ids = {}
-        for cluster in self.clusters_sorted_by_priority:
-            pvals = (nb_of_experiments /
-                     nb_of_experiments.sum().astype(float))
-
-            samples = numpy.random.multinomial(free_slots, pvals)
-            samples = numpy.min(samples, nb_of_experiments)
-            nb_of_experiments -= samples
-
-            ids_for_cluster = {}
-            for number_of_jobs_to_launch, [experiment_name, experiment] in \
-                    zip(samples, experiments):
-                ids_for_cluster[experiment_name] = [
-                    row[Database.ROW_ID] for row in
-                    experiment[:number_of_jobs_to_launch]]
-
-            ids[cluster.name] = ids_for_cluster
-
-        return ids
+        results = self.deploy_rows(project, ids_to_deploy)
+        self.record_submissions(
+            project, submitted_rows(ids_to_deploy, results))
+
+        return results
+
+    def deploy_rows(self, project, ids_to_deploy):
+        """
+        Submit the rows assigned to each cluster as job arrays, see
+        submit_batch
+
+        Parameters
+        ----------
+
+        project: Project
+            Experiments of the rows, whose configs define the jobs.
+        ids_to_deploy: dict
+            Row ids by experiment name, by cluster name. See
+            distribute_experiments.
+        """
+        jobs = {}
+        for name, experiment_ids in ids_to_deploy.iteritems():
+            default_queue = self.clusters_dict[name].default_queue
+            cluster_jobs = [
+                project.job(experiment, row_id, default_queue)
+                for experiment, row_ids in experiment_ids.iteritems()
+                for row_id in row_ids]
+            if cluster_jobs:
+                jobs[name] = cluster_jobs
+
+        return self.submit_batch(jobs)
+
+    def record_submissions(self, project, rows):
+        """
+        Mark the rows submitted as SUBMITTED, with the cluster and job id of
+        their task, so that they are not deployed again
+
+        Parameters
+        ----------
+
+        project: Project
+        rows: dict
+            Cluster name and job id by row id, by experiment name. See
+            submitted_rows.
+        """
+        updates = dict(
+            (experiment, dict(
+                (row_id, {AbstractDatabase.STATUS: status.SUBMITTED,
+                          AbstractDatabase.CLUSTER: name,
+                          AbstractDatabase.JOB_ID: job_id})
+                for row_id, (name, job_id) in experiment_rows.iteritems()))
+            for experiment, experiment_rows in rows.iteritems()
+            if experiment_rows)
+
+        return project.set_many(updates)
+
+    def submit_batch(self, jobs):
+        """
+        Submit jobs on each cluster in as few job arrays as possible
+
+        Parameters
+        ----------
+
+        jobs: dict
+            List of jobs by cluster name, see Scheduler.submit_batch.
+        """
+        return self._fan_out(
+            _submit_batch, [self.clusters_dict[name] for name in jobs],
+            args=dict((name, (cluster_jobs, ))
+                      for name, cluster_jobs in jobs.iteritems()))
+
+    def distribute_experiments(self, free_slots, experiments, weights=None):
+        """
+        Assign the queued rows of the experiments to the free slots of the
+        clusters, filling the clusters by priority. See allocation.allocate.
+
+        Parameters
+        ----------
+
+        free_slots: dict
+            Number of free slots by cluster name. Clusters missing get
+            nothing.
+        experiments: dict
+            List of queued rows by experiment name.
+        weights: dict or None
+            Relative share of the slots by experiment name. Defaults to the
+            number of queued rows of each experiment.
+
+        Returns
+        -------
+
+        dict of row ids by experiment name, by cluster name
+        """
+        clusters = [cluster for cluster in self.clusters_sorted_by_priority
+                    if cluster.name in free_slots]
+        names = experiments.keys()
+
+        row_ids = [[row[AbstractDatabase.ROW_ID] for row in experiments[name]]
+                   for name in names]
+        if weights is not None:
+            weights = [weights.get(name, 0) for name in names]
+
+        assignment = allocate(
+            [free_slots[cluster.name] for cluster in clusters],
+            [len(ids) for ids in row_ids], weights)
+
+        return dict(
+            (cluster.name, dict((names[index], ids)
+                                for index, ids in cluster_ids.iteritems()))
+            for cluster, cluster_ids in zip(clusters,
+                                            assignment.split(row_ids)))
 
     def get_queues(self):
-        sorted_clusters = self.clusters_sorted_by_priority
-        queues = pmap(
-            _get_queues,
-            ((c.detach_ssh_tunnel()[0], ) for c in sorted_clusters))
-        cluster_names = map(lambda c: getattr(c, "name"), sorted_clusters)
-        return dict(zip(cluster_names, queues))
-
-    def cancel(self, job_ids):
-        cancelled_jobs = pmap(
-            _cancel_jobs, ((c.name, ) for c in self.clusters),
-            initializer=_initialize_cancel,
-            initargs=[self.clusters_dict, job_ids])
-        return dict(zip(self.cluster_names, cancelled_jobs))
+        return self._fan_out(_get_queues, self.clusters_sorted_by_priority)
+
+    def update_stats(self, queues=None):
+        """
+        Update the statistics of the ranking policy with a snapshot of the
+        queues and save them. The queues are fetched if not given, and
+        returned.
+        """
+        if queues is None:
+            queues = self.get_queues()
+
+        for name, queue in queues.iteritems():
+            self.policy.observe(name, queue)
+        self.policy.save()
+
+        return queues
+
+    def cancel(self, job_ids, job_array_id=None):
+        return self._fan_out(
+            _cancel_jobs,
+            args=dict((c.name, (job_ids, job_array_id))
+                      for c in self.clusters))
+
+    def cancel_status(self, tickets):
+        """
+        Parameters
+        ----------
+
+        tickets: dict
+            Cancellation ticket by cluster name, see Cluster.cancel.
+        """
+        return self._fan_out(
+            _cancel_status, [self.clusters_dict[name] for name in tickets],
+            args=dict((name, (ticket, ))
+                      for name, ticket in tickets.iteritems()))
 
     def get_free_slots(self):
-        free_slots = pmap(_get_free_slots, self.clusters)
-        cluster_names = map(lambda c: getattr(c, "name"), self.clusters)
-        return dict(zip(cluster_names, free_slots))
+        return self._fan_out(_get_free_slots)
 
     def retrieve_logs(self, output_dir):
-        rval = pmap(
+        return self._fan_out(
             _retrieve_logs,
-            ((c, os.path.join(output_dir, c.name)) for c in self.clusters))
-        cluster_names = map(lambda c: getattr(c, "name"), self.clusters)
-        return dict(zip(cluster_names, rval))
-
-
-def _initialize_clusters(_clusters):
-    global clusters
-    clusters = _clusters
+            args=dict((c.name, (os.path.join(output_dir, c.name), ))
+                      for c in self.clusters))
 
 
 # Connect
 ##########
 
-def _connect(cluster_name):
-    return clusters[cluster_name].connect()
+def _connect(cluster):
+    if cluster.connected_hostname is None:
+        cluster.start_remote_server()
+
+    return cluster.connected_hostname
 
 
 # Deploy
 #########
 
-def _deploy(cluster_name, experiment_ids):
-    return clusters[cluster_name].deploy(experiment_ids)
+def _submit_batch(cluster, jobs):
+    return cluster.submit_batch(jobs)
+
+
+def submitted_rows(ids_to_deploy, results):
+    """
+    Cluster name and job id of the task of each row submitted, by row id, by
+    experiment name
+    """
+    rows = {}
+    for name, experiment_ids in ids_to_deploy.iteritems():
+        if name not in results:
+            continue
+
+        tasks = results[name]["tasks"]
+        for experiment, row_ids in experiment_ids.iteritems():
+            for row_id in row_ids:
+                job_id = tasks.get(row_id)
+                if job_id is not None:
+                    rows.setdefault(experiment, {})[row_id] = (name, job_id)
+
+    return rows
 
 
 # Queues
@@ -146,14 +265,12 @@ def _get_queues(cluster):
 # Cancel
 #########
 
-def _initialize_cancel(_clusters, _job_ids):
-    _initialize_clusters(clusters)
-    global job_ids
-    job_ids = _job_ids
+def _cancel_jobs(cluster, job_ids, job_array_id):
+    return cluster.cancel(job_id=job_ids, job_array_id=job_array_id)
 
 
-def _cancel_jobs(cluster_name):
-    return clusters[cluster_name].cancel(job_ids)
+def _cancel_status(cluster, ticket):
+    return cluster.cancel_status(ticket)
 
 
 # Free slots
@@ -0,0 +1,256 @@
+"""
+    Continuous deployment: the clusters stay connected between cycles, their
+    queues are polled on a short cadence and their free slots are topped up
+    whenever a queue changed, or at least every deploy_interval seconds.
+
+    Ex:
+        daemon = Daemon(Cumulus(clusters_config), Project(experiments_config),
+                        poll_interval=30, deploy_interval=5 * 60,
+                        metrics_path="~/.cumulus/daemon-metrics.json")
+        daemon.run()  # until daemon.stop() is called
+
+    Polling is cheap since the socket servers answer from their cached queue
+    and only send what changed. A queue changed when the version of its
+    snapshot changed. Rows submitted are marked SUBMITTED. Until they are not
+    queued anymore they are left out of the next deployments, and marked
+    again if it failed. The timings of the loop and the backlog of queued rows
+    are kept in metrics, written atomically to metrics_path after each cycle
+    so that monitoring can read them without talking to the daemon.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from ..database import status
+from ..database.base import AbstractDatabase
+from .cumulus import submitted_rows
+
+
+logger = logging.getLogger(__name__)
+
+
+POLL_INTERVAL = 30
+DEPLOY_INTERVAL = 5 * 60
+TIMING_SMOOTHING = 0.3
+
+
+def _smooth(value, sample):
+    if value is None:
+        return sample
+
+    return value + TIMING_SMOOTHING * (sample - value)
+
+
+class Daemon(object):
+
+    def __init__(self, cumulus, project, poll_interval=POLL_INTERVAL,
+                 deploy_interval=DEPLOY_INTERVAL, metrics_path=None):
+        """
+        Parameters
+        ----------
+
+        cumulus: Cumulus
+        project: Project
+            Experiments whose queued rows are deployed.
+        poll_interval: float
+            Number of seconds between the polls of the queues.
+        deploy_interval: float
+            Maximum number of seconds between two deployments when no queue
+            changed.
+        metrics_path: str or None
+            Json file where the metrics are written after each cycle. They
+            are only logged if None.
+        """
+        self.cumulus = cumulus
+        self.project = project
+        self.poll_interval = poll_interval
+        self.deploy_interval = deploy_interval
+        if metrics_path is not None:
+            metrics_path = os.path.expanduser(metrics_path)
+        self.metrics_path = metrics_path
+
+        self.versions = {}
+        self.last_deploy = None
+        # Cluster name and job id of the rows submitted and maybe still
+        # queued, by row id, by experiment name
+        self.submitted = {}
+        self._stopped = threading.Event()
+        self.metrics = dict(
+            started=time.time(), cycles=0, deploys=0, errors=0,
+            last_cycle=None, cycle_duration=None, mean_cycle_duration=None,
+            poll_duration=None, last_deploy=None, deploy_duration=None,
+            backlog=0, backlog_by_experiment={}, free_slots={},
+            deployed={}, unrecorded=0, changed=[], unreachable=[],
+            queue_cache={})
+
+    def stop(self):
+        """Stop after the current cycle, can be called from another thread"""
+        self._stopped.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def run(self, max_cycles=None):
+        connected = self.cumulus.connect()
+        for name, error in connected.errors.iteritems():
+            logger.warning("Could not connect to %s, will retry: %s" %
+                           (name, str(error)))
+
+        while not self.stopped:
+            self.cycle()
+            if (max_cycles is not None and
+                    self.metrics["cycles"] >= max_cycles):
+                break
+
+            elapsed = time.time() - self.metrics["last_cycle"]
+            self._stopped.wait(max(self.poll_interval - elapsed, 0))
+
+    def cycle(self):
+        """Poll the queues and deploy if one changed or deploy is due"""
+        start = time.time()
+        try:
+            queues = self.cumulus.update_stats()
+            self.metrics["poll_duration"] = time.time() - start
+            self.metrics["unreachable"] = sorted(
+                queues.errors.keys() + queues.timed_out)
+
+            changed = self.changed_clusters(queues)
+            self.metrics["changed"] = changed
+            due = (self.last_deploy is None or
+                   start - self.last_deploy >= self.deploy_interval)
+            if changed or due:
+                logger.info("Deploying, %s" %
+                            ("queues of %s changed" % ", ".join(changed)
+                             if changed else "no change in queues"))
+                self.deploy()
+        except Exception:
+            logger.exception("Deploy cycle failed")
+            self.metrics["errors"] += 1
+
+        duration = time.time() - start
+        self.metrics["cycles"] += 1
+        self.metrics["last_cycle"] = start
+        self.metrics["cycle_duration"] = duration
+        self.metrics["mean_cycle_duration"] = _smooth(
+            self.metrics["mean_cycle_duration"], duration)
+        self.metrics["queue_cache"] = dict(
+            (cluster.name, cluster.queue_cache)
+            for cluster in self.cumulus.clusters)
+        if duration > self.poll_interval:
+            logger.warning("Cycle took %.1fs, more than the poll interval of "
+                           "%.1fs" % (duration, self.poll_interval))
+
+        self.save_metrics()
+
+    def changed_clusters(self, queues):
+        """
+        Names of the clusters whose queue version changed since the last poll
+        """
+        changed = []
+        for cluster in self.cumulus.clusters:
+            if cluster.name not in queues:
+                continue
+
+            if self.versions.get(cluster.name) != cluster.queue_version:
+                changed.append(cluster.name)
+            self.versions[cluster.name] = cluster.queue_version
+
+        return changed
+
+    def deploy(self):
+        start = time.time()
+        queued_experiments = self.pending_rows(
+            self.project.get(status=status.QUEUED))
+        backlog = dict((name, len(rows))
+                       for name, rows in queued_experiments.iteritems())
+        self.metrics["backlog_by_experiment"] = backlog
+        self.metrics["backlog"] = sum(backlog.itervalues())
+
+        deployed = {}
+        if self.metrics["backlog"] > 0:
+            free_slots = self.cumulus.get_free_slots()
+            self.metrics["free_slots"] = dict(free_slots)
+
+            ids_to_deploy = self.cumulus.distribute_experiments(
+                free_slots, queued_experiments)
+            results = self.cumulus.deploy_rows(self.project, ids_to_deploy)
+            for name, error in results.errors.iteritems():
+                logger.error("Could not deploy on %s: %s" %
+                             (name, str(error)))
+
+            for experiment, rows in submitted_rows(
+                    ids_to_deploy, results).iteritems():
+                self.submitted.setdefault(experiment, {}).update(rows)
+                for name, _ in rows.itervalues():
+                    deployed[name] = deployed.get(name, 0) + 1
+
+        if any(self.submitted.itervalues()):
+            self.record_submissions()
+
+        self.last_deploy = start
+        self.metrics["deploys"] += 1
+        self.metrics["last_deploy"] = start
+        self.metrics["deploy_duration"] = time.time() - start
+        self.metrics["deployed"] = deployed
+        self.metrics["unrecorded"] = sum(
+            len(rows) for rows in self.submitted.itervalues())
+        logger.info("%d rows deployed in %.1fs, %d rows left in backlog" %
+                    (sum(deployed.itervalues()),
+                     self.metrics["deploy_duration"],
+                     self.metrics["backlog"] - sum(deployed.itervalues())))
+
+    def pending_rows(self, queued_experiments):
+        """
+        Leave out the queued rows already submitted. Those not queued anymore
+        were marked SUBMITTED, or started, and are forgotten.
+        """
+        pending = {}
+        submitted = {}
+        for experiment, rows in queued_experiments.iteritems():
+            previous = self.submitted.get(experiment, {})
+            pending[experiment] = []
+            for row in rows:
+                row_id = row[AbstractDatabase.ROW_ID]
+                if row_id not in previous:
+                    pending[experiment].append(row)
+                    continue
+
+                submitted.setdefault(experiment, {})[row_id] = previous[row_id]
+
+        self.submitted = submitted
+        return pending
+
+    def record_submissions(self):
+        try:
+            reports = self.cumulus.record_submissions(self.project,
+                                                      self.submitted)
+        except Exception:
+            logger.exception("Could not mark the rows submitted")
+            self.metrics["errors"] += 1
+            return
+
+        for experiment, report in reports.iteritems():
+            for row_id, error in report["errors"].iteritems():
+                logger.error("Could not mark row %s of %s submitted: %s" %
+                             (str(row_id), experiment, error))
+            if report["skipped"]:
+                logger.error("%d rows of %s not marked submitted" %
+                             (len(report["skipped"]), experiment))
+
+    def save_metrics(self):
+        logger.debug("Metrics: %s" % str(self.metrics))
+        if self.metrics_path is None:
+            return
+
+        directory = os.path.dirname(self.metrics_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp_path = self.metrics_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.metrics, f)
+        os.rename(tmp_path, self.metrics_path)
@@ -0,0 +1,112 @@
+"""
+    Run an operation on many clusters concurrently, with one thread per
+    cluster. The clusters stay in the current process with their live ssh
+    tunnels and sessions, which is what matters since the operations are I/O
+    bound.
+
+    Ex:
+        queues = fan_out(_get_queues, clusters, timeout=dict(hades=30))
+        queues.timed_out  # names of clusters which did not answer in time
+        queues.errors     # exceptions indexed by cluster name
+
+    The results of clusters which did not answer in time or failed are
+    missing, the other ones are returned anyway.
+"""
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class FanOutResult(dict):
+    """Results indexed by cluster name"""
+
+    def __init__(self):
+        super(FanOutResult, self).__init__()
+        self.errors = {}
+        self.timed_out = []
+
+    @property
+    def complete(self):
+        return not self.errors and not self.timed_out
+
+
+def _call(fct, cluster, args, outcome, lock):
+    # Each call has an outcome of its own, fan_out copies it in the result if
+    # it is set before the deadline. Once the call is abandoned, what it
+    # returns is dropped so that the result does not change after being
+    # returned.
+    try:
+        rval = fct(cluster, *args)
+    except Exception as e:
+        logger.exception("Operation %s failed on cluster %s" %
+                         (fct.__name__, cluster.name))
+        outcome_key, outcome_value = "error", e
+    else:
+        outcome_key, outcome_value = "value", rval
+
+    with lock:
+        if outcome.get("abandoned"):
+            logger.debug("Dropping late result of %s on cluster %s" %
+                         (fct.__name__, cluster.name))
+        else:
+            outcome[outcome_key] = outcome_value
+
+
+def fan_out(fct, clusters, args=None, timeout=None):
+    """
+    Call fct(cluster, *args[cluster.name]) on all clusters concurrently
+
+    Parameters
+    ----------
+
+    fct: callable
+        Operation to execute, taking the cluster as first argument.
+    clusters: list of Cluster
+    args: dict or None
+        Additional arguments of fct indexed by cluster name.
+    timeout: float, dict or None
+        Maximum number of seconds to wait for each cluster, either the same
+        for all or indexed by cluster name. Wait indefinitely if None.
+    """
+    if args is None:
+        args = {}
+    if not isinstance(timeout, dict):
+        timeout = dict((cluster.name, timeout) for cluster in clusters)
+
+    result = FanOutResult()
+    lock = threading.Lock()
+    start = time.time()
+
+    threads = []
+    for cluster in clusters:
+        outcome = {}
+        thread = threading.Thread(
+            target=_call,
+            args=(fct, cluster, args.get(cluster.name, ()), outcome, lock))
+        # Do not hold the process if a cluster never answers
+        thread.daemon = True
+        thread.start()
+        threads.append((cluster.name, thread, outcome))
+
+    for name, thread, outcome in threads:
+        if timeout.get(name) is None:
+            thread.join()
+        else:
+            thread.join(max(start + timeout[name] - time.time(), 0))
+
+        with lock:
+            if "value" in outcome:
+                result[name] = outcome["value"]
+            elif "error" in outcome:
+                result.errors[name] = outcome["error"]
+            else:
+                logger.warning("Cluster %s did not answer within %s seconds" %
+                               (name, str(timeout[name])))
+                outcome["abandoned"] = True
+                result.timed_out.append(name)
+
+    return result
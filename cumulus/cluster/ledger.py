@@ -0,0 +1,176 @@
+"""
+    Accounting of the slots of a cluster, so that its free slots are known
+    without scanning its whole queue. The ledger keeps the number of tasks
+    submitted and queued by job, and is updated with the deltas of the queue
+    sent by the socket server and with our own submissions and
+    cancellations.
+
+    Ex:
+        ledger = SlotLedger(max_jobs=500, threshold=50)
+        ledger.reset(queue, snapshot_time)
+        ledger.update(delta, queue, snapshot_time)
+        ledger.record_submission(100)
+        ledger.record_cancellation(["1234", "1235"])
+        ledger.free_slots()
+
+    Our submissions count until a snapshot of the queue taken after them is
+    received, since the scheduler lists jobs as soon as they are submitted.
+    Cancelled jobs stop counting right away although they stay in the queue
+    for a while, unless they are still there after CANCEL_TTL seconds.
+"""
+
+import threading
+import time
+
+from ..scheduler.base import AbstractScheduler
+
+
+# Number of seconds after which jobs cancelled but still in the queue count
+# again, the cancellation probably failed.
+CANCEL_TTL = 10 * 60
+
+
+def count_tasks(job):
+    """Number of tasks submitted and not completed, and of those not running"""
+    job_array = job["job_array"]
+    total = sum(job_array.get(status, 0)
+                for status in AbstractScheduler._status)
+    submitted = total - job_array.get(AbstractScheduler.COMPLETED, 0)
+    queued = submitted - job_array.get(AbstractScheduler.RUNNING, 0)
+
+    return submitted, queued
+
+
+class SlotLedger(object):
+
+    def __init__(self, max_jobs, threshold):
+        """
+        Parameters
+        ----------
+
+        max_jobs: int
+            Maximum number of tasks submitted and not completed at the same
+            time.
+        threshold: int
+            No task is submitted while at least that many are queued.
+        """
+        self.max_jobs = max_jobs
+        self.threshold = threshold
+
+        self.jobs = {}
+        self.submitted = 0
+        self.queued = 0
+        # Time at which the last snapshot of the queue was taken
+        self.snapshot_time = None
+        # Submission time and number of tasks of our submissions not yet in
+        # the snapshot
+        self.pending = []
+        # Cancellation time of the jobs cancelled still in the queue
+        self.cancelled = {}
+        self._lock = threading.Lock()
+
+    @property
+    def synced(self):
+        return self.snapshot_time is not None
+
+    def _add(self, job_id, sign):
+        submitted, queued = self.jobs[job_id]
+        self.submitted += sign * submitted
+        self.queued += sign * queued
+
+    def _set(self, job_id, job):
+        counted = job_id not in self.cancelled
+        if counted and job_id in self.jobs:
+            self._add(job_id, -1)
+        self.jobs[job_id] = count_tasks(job)
+        if counted:
+            self._add(job_id, 1)
+
+    def _remove(self, job_id):
+        if job_id not in self.jobs:
+            return
+
+        if self.cancelled.pop(job_id, None) is None:
+            self._add(job_id, -1)
+        del self.jobs[job_id]
+
+    def _synced_at(self, snapshot_time):
+        self.snapshot_time = snapshot_time
+        self.pending = [(submitted_at, n_tasks)
+                        for submitted_at, n_tasks in self.pending
+                        if submitted_at > snapshot_time]
+
+    def reset(self, queue, snapshot_time):
+        """Rebuild the ledger from a full snapshot of the queue"""
+        with self._lock:
+            self.jobs = {}
+            self.submitted = 0
+            self.queued = 0
+            self.cancelled = dict(
+                (job_id, cancelled_at)
+                for job_id, cancelled_at in self.cancelled.iteritems()
+                if job_id in queue)
+            for job_id, job in queue.iteritems():
+                self._set(job_id, job)
+            self._synced_at(snapshot_time)
+
+    def update(self, delta, queue, snapshot_time):
+        """
+        Apply the delta of the queue, only the jobs added, changed or removed
+        are counted again
+
+        Parameters
+        ----------
+
+        delta: dict
+            Delta between the last snapshot and this one, see
+            utils.snapshot.diff.
+        queue: dict
+            Snapshot with the delta applied.
+        snapshot_time: float
+            Time at which the snapshot was taken.
+        """
+        with self._lock:
+            for job_id in delta["removed"]:
+                self._remove(job_id)
+            for job_id in delta["added"].keys() + delta["changed"].keys():
+                self._set(job_id, queue[job_id])
+            self._synced_at(snapshot_time)
+
+    def record_submission(self, n_tasks):
+        with self._lock:
+            self.pending.append((time.time(), n_tasks))
+
+    def record_cancellation(self, job_ids):
+        now = time.time()
+        with self._lock:
+            for job_id in job_ids:
+                if job_id in self.jobs and job_id not in self.cancelled:
+                    self._add(job_id, -1)
+                    self.cancelled[job_id] = now
+
+    def _expire_cancelled(self):
+        now = time.time()
+        for job_id, cancelled_at in self.cancelled.items():
+            if now - cancelled_at > CANCEL_TTL:
+                del self.cancelled[job_id]
+                self._add(job_id, 1)
+
+    def free_slots(self):
+        with self._lock:
+            self._expire_cancelled()
+            pending = sum(n_tasks for _, n_tasks in self.pending)
+            submitted = self.submitted + pending
+            queued = self.queued + pending
+
+        if queued >= self.threshold:
+            return 0
+
+        return max(self.max_jobs - submitted, 0)
+
+    def summary(self):
+        with self._lock:
+            return dict(submitted=self.submitted, queued=self.queued,
+                        pending=sum(n_tasks for _, n_tasks in self.pending),
+                        cancelled=len(self.cancelled),
+                        snapshot_time=self.snapshot_time)
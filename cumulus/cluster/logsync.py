@@ -0,0 +1,337 @@
+"""
+    Incremental copy of the log directory of a cluster. A manifest of the
+    files already copied (size, mtime and sha1 of their last block) is kept in
+    the local directory, so that only new files are fetched and only the new
+    bytes of growing logs are appended. The remote directory is listed with a
+    single find command, and the files are transferred by several sftp
+    sessions in parallel on the same ssh transport.
+
+    Ex:
+        connection = connect_fastest(hostnames, username)
+        report = LogSync(connection, "/home/user/logs", "logs/hades").run()
+        report["bytes"], report["throughput"]
+        connection.release()
+
+    A transfer interrupted midway is resumed on the next run: files are only
+    recorded in the manifest once they are fully written.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import pipes
+import Queue
+import threading
+import time
+
+import paramiko
+
+from ..ssh import exec_command
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST = ".cumulus-manifest.json"
+
+DEFAULT_STREAMS = 4
+CHUNK_SIZE = 32 * 1024
+# Files larger than this are read with pipelined sftp requests
+PREFETCH_THRESHOLD = 1024 * 1024
+# Size of the last block of a file whose hash is checked before appending
+TAIL_BLOCK = 4096
+# Number of transfers between two saves of the manifest
+SAVE_INTERVAL = 500
+SFTP_ATTEMPTS = 3
+
+NEW, APPEND, REPLACE = "new", "append", "replace"
+
+
+def _tail_sha1(path, size):
+    start = max(size - TAIL_BLOCK, 0)
+    with open(path, "rb") as f:
+        f.seek(start)
+        return hashlib.sha1(f.read(size - start)).hexdigest()
+
+
+class Manifest(object):
+
+    def __init__(self, local_dir):
+        self.path = os.path.join(local_dir, MANIFEST)
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.files = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.files = {}
+        except ValueError:
+            logger.warning("Corrupted manifest %s, fetching all files again" %
+                           self.path)
+            self.files = {}
+
+        return self
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self.files)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.rename(tmp_path, self.path)
+
+    def get(self, relpath):
+        with self._lock:
+            return self.files.get(relpath)
+
+    def update(self, relpath, size, mtime, tail_sha1):
+        with self._lock:
+            self.files[relpath] = dict(size=size, mtime=mtime,
+                                       tail_sha1=tail_sha1)
+
+
+class LogSync(object):
+
+    def __init__(self, connection, remote_dir, local_dir,
+                 streams=DEFAULT_STREAMS):
+        """
+        Parameters
+        ----------
+
+        connection: ssh.PooledTransport
+        remote_dir: str
+        local_dir: str
+        streams: int
+            Number of sftp sessions transferring files in parallel.
+        """
+        self.connection = connection
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        self.streams = streams
+        self.manifest = Manifest(local_dir)
+
+        self._lock = threading.Lock()
+        self._transfers = 0
+
+    def list_remote(self):
+        """Return size and mtime of the remote files by relative path"""
+        _, stdout, stderr, channel = exec_command(
+            self.connection.transport,
+            "find %s -type f -printf '%%s %%T@ %%P\\0'" %
+            pipes.quote(self.remote_dir))
+        try:
+            output = stdout.read()
+            if channel.recv_exit_status() != 0:
+                logger.warning("Could not list %s completely: %s" %
+                               (self.remote_dir, stderr.read().strip()))
+        finally:
+            channel.close()
+
+        files = {}
+        for entry in output.split("\0"):
+            if not entry:
+                continue
+            size, mtime, relpath = entry.split(" ", 2)
+            files[relpath] = (int(size), float(mtime))
+
+        return files
+
+    def plan(self, remote_files):
+        """Return the (relpath, action) to execute and the number skipped"""
+        transfers = []
+        skipped = 0
+        for relpath, (size, mtime) in remote_files.iteritems():
+            entry = self.manifest.get(relpath)
+            if entry is None:
+                transfers.append((relpath, NEW))
+            elif entry["size"] == size and entry["mtime"] == mtime:
+                skipped += 1
+            elif size > entry["size"]:
+                transfers.append((relpath, APPEND))
+            else:
+                transfers.append((relpath, REPLACE))
+
+        return transfers, skipped
+
+    def _local_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def _can_append(self, remote_file, local_path, entry):
+        local_size = self._local_size(local_path)
+        if local_size is None or local_size < entry["size"]:
+            return False
+
+        if local_size > entry["size"]:
+            # Leftover of an interrupted append
+            with open(local_path, "r+b") as f:
+                f.truncate(entry["size"])
+
+        # The remote file may have been replaced by a larger one
+        start = max(entry["size"] - TAIL_BLOCK, 0)
+        remote_file.seek(start)
+        tail = remote_file.read(entry["size"] - start)
+        return hashlib.sha1(tail).hexdigest() == entry["tail_sha1"]
+
+    def _copy(self, remote_file, local_file):
+        nbytes = 0
+        while True:
+            data = remote_file.read(CHUNK_SIZE)
+            if not data:
+                return nbytes
+            local_file.write(data)
+            nbytes += len(data)
+
+    def fetch(self, sftp, relpath, action, mtime):
+        """
+        Execute one transfer and return the action executed, which may be
+        REPLACE instead of APPEND, and the number of bytes copied
+        """
+        remote_path = os.path.join(self.remote_dir, relpath)
+        local_path = os.path.join(self.local_dir, relpath)
+
+        if action == APPEND:
+            entry = self.manifest.get(relpath)
+            remote_file = sftp.open(remote_path, "rb")
+            try:
+                if self._can_append(remote_file, local_path, entry):
+                    # The remote file is positioned at the end of the tail
+                    with open(local_path, "ab") as local_file:
+                        nbytes = self._copy(remote_file, local_file)
+                else:
+                    logger.debug("%s changed, fetching it again" % relpath)
+                    action = REPLACE
+            finally:
+                remote_file.close()
+
+        if action != APPEND:
+            directory = os.path.dirname(local_path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+            tmp_path = local_path + ".part"
+            remote_file = sftp.open(remote_path, "rb")
+            try:
+                if remote_file.stat().st_size > PREFETCH_THRESHOLD:
+                    remote_file.prefetch()
+                with open(tmp_path, "wb") as local_file:
+                    nbytes = self._copy(remote_file, local_file)
+            finally:
+                remote_file.close()
+            os.rename(tmp_path, local_path)
+
+        size = os.path.getsize(local_path)
+        self.manifest.update(relpath, size, mtime,
+                             _tail_sha1(local_path, size))
+
+        return action, nbytes
+
+    def _open_sftp(self):
+        for attempt in xrange(SFTP_ATTEMPTS):
+            try:
+                return paramiko.SFTPClient.from_transport(
+                    self.connection.transport)
+            except paramiko.SSHException as e:
+                logger.debug("Could not open sftp session: %s" % str(e))
+
+        return None
+
+    def _work(self, transfers, remote_files, report):
+        sftp = self._open_sftp()
+        if sftp is None:
+            # The other streams carry on with the transfers
+            logger.warning("Could not open sftp session, running one "
+                           "stream less")
+            return
+
+        try:
+            while True:
+                try:
+                    relpath, action = transfers.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    action, nbytes = self.fetch(
+                        sftp, relpath, action, remote_files[relpath][1])
+                except (IOError, OSError, paramiko.SSHException) as e:
+                    logger.warning("Could not retrieve %s: %s" %
+                                   (relpath, str(e)))
+                    with self._lock:
+                        report["errors"][relpath] = str(e)
+                    continue
+
+                with self._lock:
+                    report[action] += 1
+                    report["bytes"] += nbytes
+                    self._transfers += 1
+                    save = self._transfers % SAVE_INTERVAL == 0
+
+                if save:
+                    self.manifest.save()
+        finally:
+            sftp.close()
+
+    def run(self):
+        """
+        Copy the new and grown remote files and return a report with the
+        number of files per action, the bytes copied and the throughput in
+        bytes per second
+        """
+        start = time.time()
+        if not os.path.isdir(self.local_dir):
+            os.makedirs(self.local_dir)
+        self.manifest.load()
+
+        remote_files = self.list_remote()
+        planned, skipped = self.plan(remote_files)
+        logger.debug("%d remote files, %d to transfer" %
+                     (len(remote_files), len(planned)))
+
+        report = {NEW: 0, APPEND: 0, REPLACE: 0, "skipped": skipped,
+                  "bytes": 0, "errors": {}}
+
+        transfers = Queue.Queue()
+        for transfer in planned:
+            transfers.put(transfer)
+
+        workers = [
+            threading.Thread(target=self._work,
+                             args=(transfers, remote_files, report))
+            for _ in xrange(min(self.streams, len(planned)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        while not transfers.empty():
+            relpath, _ = transfers.get_nowait()
+            report["errors"][relpath] = "No sftp session available"
+
+        self.manifest.save()
+
+        report["elapsed"] = time.time() - start
+        report["throughput"] = report["bytes"] / max(report["elapsed"], 1e-6)
+
+        logger.info(
+            "Retrieved logs of %s: %d new, %d appended, %d replaced, "
+            "%d unchanged, %d failed. %.1f MB in %.1fs (%.1f MB/s)" %
+            (self.remote_dir, report[NEW], report[APPEND], report[REPLACE],
+             report["skipped"], len(report["errors"]),
+             report["bytes"] / 1e6, report["elapsed"],
+             report["throughput"] / 1e6))
+
+        return report
@@ -0,0 +1,205 @@
+"""
+    Ranking of the clusters by the expected time before a job submitted now
+    starts. Rolling statistics of each cluster are measured by comparing
+    successive snapshots of its queue, and kept in a json file between runs.
+    The snapshots themselves, one entry per job of all users, only stay in
+    memory: the statistics are measured by processes which observe the queues
+    repeatedly, like the daemon, and used by all.
+
+    Ex:
+        policy = RankingPolicy.load()
+        policy.observe("hades", cluster.queue())
+        policy.rank(clusters)
+        policy.save()
+
+    The rate at which queued tasks start is smoothed over the observations,
+    and the expected time to start follows from Little's law: the number of
+    tasks queued divided by the rate at which they start. Clusters where
+    jobs often fail are penalized, since failed jobs must be started again.
+"""
+
+import errno
+import json
+import logging
+import os
+import time
+
+import numpy
+
+from .. import config
+from ..scheduler.base import AbstractScheduler
+from ..scheduler.table import JobTable
+
+
+logger = logging.getLogger(__name__)
+
+
+STATS_SMOOTHING = 0.3
+# Snapshots further apart are not compared, too much happened in between
+MAX_SNAPSHOT_GAP = 60 * 60
+# Expected time to start, in seconds, of clusters never observed
+DEFAULT_WAIT = 30 * 60
+# Expected time to start of clusters where no queued task ever started
+STALLED_WAIT = 24 * 60 * 60
+# Failure rate above which a cluster is not penalized further
+MAX_FAILURE_RATE = 0.9
+
+QUEUED, RUNNING, COMPLETED, FAILED = range(4)
+
+
+def _smooth(value, sample):
+    if value is None:
+        return sample
+
+    return value + STATS_SMOOTHING * (sample - value)
+
+
+def take_snapshot(queue):
+    """Counters of queued, running, completed and failed tasks by job id"""
+    table = JobTable.from_queue(queue)
+    counts = numpy.column_stack([
+        table.column(AbstractScheduler.QUEUED),
+        table.column(AbstractScheduler.RUNNING),
+        table.column(AbstractScheduler.COMPLETED),
+        table.column(AbstractScheduler.FAILED)])
+
+    return dict(zip(table.ids, counts.tolist()))
+
+
+def compare(previous, current):
+    """
+    Return the number of tasks which started, finished and failed between two
+    snapshots
+    """
+    started = finished = failed = 0
+    for job_id, counts in current.iteritems():
+        before = previous.get(job_id)
+        if before is None:
+            # Submitted in between, the tasks not queued anymore started
+            started += counts[RUNNING] + counts[COMPLETED] + counts[FAILED]
+            finished += counts[COMPLETED] + counts[FAILED]
+            failed += counts[FAILED]
+            continue
+
+        started += max(before[QUEUED] - counts[QUEUED], 0)
+        finished += max(counts[COMPLETED] + counts[FAILED] -
+                        before[COMPLETED] - before[FAILED], 0)
+        failed += max(counts[FAILED] - before[FAILED], 0)
+
+    return started, finished, failed
+
+
+class RankingPolicy(object):
+
+    def __init__(self, path=None):
+        """
+        Parameters
+        ----------
+
+        path: str or None
+            Json file where the statistics are kept. Defaults to the
+            cluster_stats option of the configuration.
+        """
+        if path is None:
+            path = config["cluster_stats"]
+        self.path = os.path.expanduser(path)
+        self.clusters = {}
+        # Time and snapshot of the last observation of each cluster
+        self.snapshots = {}
+
+    @classmethod
+    def load(cls, path=None):
+        policy = cls(path)
+        try:
+            with open(policy.path) as f:
+                policy.clusters = json.load(f)
+            # Saved by previous versions
+            for stats in policy.clusters.itervalues():
+                stats.pop("snapshot", None)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logger.warning("Corrupted cluster statistics %s, starting over" %
+                           policy.path)
+
+        return policy
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.clusters, f)
+        os.rename(tmp_path, self.path)
+
+    def _get(self, name):
+        return self.clusters.setdefault(
+            name, dict(start_rate=None, failure_rate=None, queued=0,
+                       observations=0, updated=None))
+
+    def observe(self, name, queue, now=None):
+        """Update the statistics of a cluster with a snapshot of its queue"""
+        if now is None:
+            now = time.time()
+
+        stats = self._get(name)
+        snapshot = take_snapshot(queue)
+        stats["queued"] = sum(counts[QUEUED]
+                              for counts in snapshot.itervalues())
+
+        if name in self.snapshots:
+            last_time, last_snapshot = self.snapshots[name]
+            elapsed = now - last_time
+            if 0 < elapsed <= MAX_SNAPSHOT_GAP:
+                started, finished, failed = compare(last_snapshot, snapshot)
+                stats["start_rate"] = _smooth(stats["start_rate"],
+                                              started / float(elapsed))
+                if finished > 0:
+                    stats["failure_rate"] = _smooth(
+                        stats["failure_rate"], failed / float(finished))
+                stats["observations"] += 1
+                logger.debug("%s: %d tasks started, %d finished and %d "
+                             "failed in %.0fs" %
+                             (name, started, finished, failed, elapsed))
+            else:
+                logger.debug("%s: last snapshot is %.0fs old, not compared" %
+                             (name, elapsed))
+
+        self.snapshots[name] = (now, snapshot)
+        stats["updated"] = now
+
+    def expected_wait(self, name):
+        """Expected number of seconds before a task submitted now starts"""
+        stats = self.clusters.get(name)
+        if stats is None or stats["observations"] == 0:
+            return DEFAULT_WAIT
+
+        if not stats["start_rate"]:
+            return 0. if stats["queued"] == 0 else STALLED_WAIT
+
+        wait = (stats["queued"] + 1) / stats["start_rate"]
+        failure_rate = min(stats["failure_rate"] or 0., MAX_FAILURE_RATE)
+
+        return min(wait / (1. - failure_rate), STALLED_WAIT)
+
+    def rank(self, clusters):
+        """
+        Sort clusters from the fastest to start jobs to the slowest. The
+        priority of the clusters breaks ties, then the order given.
+        """
+        def key(cluster):
+            priority = cluster.priority
+            if priority is None:
+                priority = float("inf")
+            return (self.expected_wait(cluster.name), priority)
+
+        return sorted(clusters, key=key)
+
+    def summary(self):
+        """Statistics of each cluster, with their expected time to start"""
+        return dict(
+            (name, dict(stats, expected_wait=self.expected_wait(name)))
+            for name, stats in self.clusters.iteritems())
@@ -0,0 +1,335 @@
+"""
+    A session is a long-lived connection to a socket server on which many
+    commands are multiplexed. Each request is sent in a frame tagged with a
+    request id and the server answers with a frame carrying the same id, so
+    many requests can be in flight at the same time on the same connection.
+
+    Ex:
+        session = Session(cluster.get_client_socket, Cluster.SESSION)
+        session.request(Cluster.PING, date=str(datetime.datetime.now()))
+        session.close()
+
+    If the connection breaks, all in-flight requests fail with socket.error
+    and the next request reconnects. A request which was sent may have reached
+    the server already, so it is only sent again on a new connection if its
+    command is repeatable, like a query. Others raise, since submitting or
+    cancelling twice is worse than not knowing whether it was done.
+
+    A request may also open a stream, to which the server pushes frames with
+    the id of the request until one of them is marked done. The server only
+    sends as many frames as the credit given by the client, which grants more
+    as it consumes them.
+
+    Ex:
+        stream = session.stream(Cluster.TAIL, Cluster.TAIL_CONTROL, credit=8,
+                                paths=["job1.out"])
+        for frame in stream:
+            ...
+        stream.close()
+"""
+
+import itertools
+import logging
+import Queue
+import socket
+import struct
+import threading
+
+from ..ssh import (
+    receive, send, receive_frame, send_frame, available_encodings,
+    available_compressions, JSON)
+
+
+logger = logging.getLogger(__name__)
+
+
+class PendingRequest(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.reply = None
+        self.error = None
+
+    def set_reply(self, reply):
+        self.reply = reply
+        self.event.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise socket.timeout("No reply received after %s seconds" %
+                                 str(timeout))
+
+        if self.error is not None:
+            raise self.error
+
+        return self.reply
+
+
+class Stream(object):
+
+    def __init__(self, session, stream_id, control_command, credit):
+        """
+        Parameters
+        ----------
+
+        session: Session
+        stream_id: int
+            Id of the request which opened the stream.
+        control_command: int
+            Command id used to grant credit to the server or stop the stream.
+        credit: int
+            Number of frames the server may send before waiting for more
+            credit.
+        """
+        self.session = session
+        self.stream_id = stream_id
+        self.control_command = control_command
+        self.credit = credit
+        self.done = False
+        self._frames = Queue.Queue()
+        self._consumed = 0
+
+    def put(self, frame):
+        self._frames.put((frame, None))
+
+    def set_error(self, error):
+        self._frames.put((None, error))
+
+    def _get(self):
+        # A get without timeout cannot be interrupted by signals
+        while True:
+            try:
+                return self._frames.get(timeout=1)
+            except Queue.Empty:
+                pass
+
+    def __iter__(self):
+        while not self.done:
+            frame, error = self._get()
+            if error is not None:
+                self.done = True
+                raise error
+
+            if frame.get("done"):
+                self.done = True
+                if frame.get("returncode", 0) != 0:
+                    raise RuntimeError(frame.get("message", str(frame)))
+                return
+
+            # Grant credit back by batches rather than for each frame
+            self._consumed += 1
+            if self._consumed >= max(self.credit // 2, 1):
+                self.session.notify(self.control_command,
+                                    stream_id=self.stream_id,
+                                    credit=self._consumed)
+                self._consumed = 0
+
+            yield frame
+
+    def close(self):
+        if self.done:
+            return
+
+        self.done = True
+        try:
+            self.session.notify(self.control_command,
+                                stream_id=self.stream_id, stop=True)
+        except socket.error:
+            pass
+
+
+class Session(object):
+
+    def __init__(self, connect, command, timeout=None, repeatable=tuple()):
+        """
+        Parameters
+        ----------
+
+        connect: callable
+            Called with a resilience level, must return a socket connected to
+            the socket server.
+        command: int
+            Command id sent by the client to turn the connection into a
+            session.
+        timeout: float or None
+            Default number of seconds to wait for a reply. Wait indefinitely if
+            None.
+        repeatable: list of int
+            Command ids without side effects, which are sent again on a new
+            connection if the connection breaks after they were sent.
+        """
+        self._connect = connect
+        self.command = command
+        self.timeout = timeout
+        self.repeatable = frozenset(repeatable)
+
+        self._socket = None
+        self.encoding = JSON
+        self.compression = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._streams = {}
+        self._request_ids = itertools.count(1)
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    def _open(self, resilience):
+        client_socket = self._connect(resilience)
+        logger.debug("Opening session")
+        send(client_socket, command=self.command,
+             encodings=available_encodings(),
+             compressions=available_compressions())
+        reply = receive(client_socket)
+        if not reply or reply.get("returncode") != 0:
+            client_socket.close()
+            raise socket.error("Socket server refused the session: %s" %
+                               str(reply))
+
+        self.encoding = reply["encoding"]
+        self.compression = reply["compression"]
+        self._socket = client_socket
+        reader = threading.Thread(target=self._read, args=(client_socket, ))
+        reader.daemon = True
+        reader.start()
+        logger.debug("Session opened with encoding=%s compression=%s" %
+                     (self.encoding, self.compression))
+
+    def _read(self, client_socket):
+        try:
+            while True:
+                request_id, reply = receive_frame(client_socket)
+                if reply is None:
+                    raise socket.error("Connection closed by socket server")
+
+                with self._lock:
+                    pending = self._pending.pop(request_id, None)
+                    stream = self._streams.get(request_id)
+                    if stream is not None and reply.get("done"):
+                        del self._streams[request_id]
+
+                if pending is not None:
+                    pending.set_reply(reply)
+                elif stream is not None:
+                    stream.put(reply)
+                else:
+                    logger.warning("Received reply for unknown request %d" %
+                                   request_id)
+        except (socket.error, struct.error, ValueError) as e:
+            self._drop(client_socket, e)
+
+    def _drop(self, client_socket, error):
+        with self._lock:
+            if self._socket is not client_socket:
+                return
+
+            logger.debug("Session dropped: %s" % str(error))
+            self._socket = None
+            pending_requests = self._pending.values()
+            self._pending = {}
+            streams = self._streams.values()
+            self._streams = {}
+
+        if not isinstance(error, socket.error):
+            error = socket.error(str(error))
+
+        for pending in pending_requests:
+            pending.set_error(error)
+
+        for stream in streams:
+            stream.set_error(error)
+
+        try:
+            client_socket.close()
+        except socket.error:
+            pass
+
+    def request(self, command, resilience=1, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+
+        pending = PendingRequest()
+        with self._lock:
+            if self._socket is None:
+                self._open(resilience)
+            client_socket = self._socket
+            request_id = next(self._request_ids)
+            self._pending[request_id] = pending
+
+        logger.debug("Sending request=%d command=%d" % (request_id, command))
+        try:
+            with self._send_lock:
+                send_frame(client_socket, request_id,
+                           dict(command=command, kwargs=kwargs),
+                           self.encoding, self.compression)
+            return pending.wait(timeout)
+        except socket.timeout:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise
+        except socket.error as e:
+            self._drop(client_socket, e)
+            # The server may have received the request already
+            if resilience <= 0 or command not in self.repeatable:
+                raise
+
+            logger.debug("Session request failed. Reconnecting")
+            return self.request(command, resilience - 1, timeout, **kwargs)
+
+    def notify(self, command, **kwargs):
+        """Send a command for which the server sends no reply"""
+        with self._lock:
+            client_socket = self._socket
+            if client_socket is None:
+                raise socket.error("Session is not connected")
+            request_id = next(self._request_ids)
+
+        try:
+            with self._send_lock:
+                send_frame(client_socket, request_id,
+                           dict(command=command, kwargs=kwargs),
+                           self.encoding, self.compression)
+        except socket.error as e:
+            self._drop(client_socket, e)
+            raise
+
+    def stream(self, command, control_command, credit, resilience=1,
+               **kwargs):
+        """
+        Send a command opening a stream and return the Stream of frames
+        pushed by the server. The stream is not reopened if the connection
+        breaks, its iteration raises socket.error instead.
+        """
+        with self._lock:
+            if self._socket is None:
+                self._open(resilience)
+            client_socket = self._socket
+            request_id = next(self._request_ids)
+            stream = Stream(self, request_id, control_command, credit)
+            self._streams[request_id] = stream
+
+        logger.debug("Opening stream=%d command=%d" % (request_id, command))
+        try:
+            with self._send_lock:
+                send_frame(client_socket, request_id,
+                           dict(command=command,
+                                kwargs=dict(kwargs, credit=credit)),
+                           self.encoding, self.compression)
+        except socket.error as e:
+            self._drop(client_socket, e)
+            raise
+
+        return stream
+
+    def close(self):
+        with self._lock:
+            client_socket = self._socket
+
+        if client_socket is not None:
+            self._drop(client_socket, socket.error("Session closed"))
@@ -9,6 +9,10 @@ class AbstractStatus(object):
     def QUEUED(self):
         pass
 
+    @abstractproperty
+    def SUBMITTED(self):
+        pass
+
     @abstractproperty
     def RUNNING(self):
         pass
@@ -37,6 +41,7 @@ class AbstractStatus(object):
 class AbstractDatabase(object):
     __metaclass__ = ABCMeta
 
+    ROW_ID = "row_id"
     CLUSTER = "cluster"
     NODE = "node"
     JOB_ID = "job_id"
@@ -44,8 +49,8 @@ class AbstractDatabase(object):
     REPOSITORIES = "repositories"
     STATUS = "status"
 
-    _fields = ["CLUSTER", "NODE", "JOB_ID", "JOBARRAY_ID", "REPOSITORIES",
-               "STATUS"]
+    _fields = ["ROW_ID", "CLUSTER", "NODE", "JOB_ID", "JOBARRAY_ID",
+               "REPOSITORIES", "STATUS"]
 
     def __init__(self):
         pass
@@ -55,8 +60,9 @@ class AbstractDatabase(object):
         pass
 
     def validate_keys(self, keys):
-        invalid_keys = tuple(key for key in keys
-                             if hasattr(self, key, None) is not None)
+        valid_keys = set(getattr(AbstractDatabase, field)
+                         for field in self._fields)
+        invalid_keys = tuple(key for key in keys if key not in valid_keys)
         if invalid_keys:
             raise KeyError("Invalid keys for Database: %s" % str(invalid_keys))
 
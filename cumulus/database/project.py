@@ -8,58 +8,83 @@ class Project(Database):
     def __init__(self, experiments_config):
         self.databases = [Database(experiment_config)
                           for experiment_config in experiments_config]
+        self.experiments_config = dict(
+            (experiment_config["name"], experiment_config)
+            for experiment_config in experiments_config)
+
+    def job(self, name, row_id, default_queue=None):
+        """
+        Job running a row of the experiment, see Scheduler.submit_batch
+
+        The config of the experiment gives the command to run in arguments,
+        which finds the row id in the environment variable CUMULUS_ROW_ID,
+        and the walltime in time. queue and job_name are optional.
+        """
+        experiment_config = self.experiments_config[name]
+        for key in ["arguments", "time"]:
+            if key not in experiment_config:
+                raise ValueError("Experiment %s has no %s in its config" %
+                                 (name, key))
+
+        queue = experiment_config.get("queue", default_queue)
+        if queue is None:
+            raise ValueError("Experiment %s has no queue in its config and "
+                             "the cluster has no default_queue" % name)
+
+        return dict(row_id=row_id, queue=queue,
+                    job_name=experiment_config.get("job_name", name),
+                    time=experiment_config["time"],
+                    arguments=experiment_config["arguments"])
 
     def get(self, job_ids=None, **kwargs):
         experiments = pmap(
-            _get, (database for database in self.databases),
-            initializer=_initialize_get, initargs=(job_ids, kwargs))
+            _get, ((database, job_ids, kwargs) for database in self.databases))
 
         experiment_names = map(lambda d: getattr(d, "name"), self.databases)
         return dict(zip(experiment_names, experiments))
 
     def set(self, job_ids=None, **kwargs):
         experiments = pmap(
-            _set, (database for database in self.databases),
-            initializer=_initialize_set, initargs=(job_ids, kwargs))
+            _set, ((database, job_ids, kwargs) for database in self.databases))
 
         experiment_names = map(lambda d: getattr(d, "name"), self.databases)
         return dict(zip(experiment_names, experiments))
 
+    def set_many(self, updates, **kwargs):
+        """
+        Parameters
+        ----------
 
-# Get
-################
+        updates: dict
+            Updates by experiment name, see Database.set_many. Other
+            experiments are not touched.
+        """
+        databases = [database for database in self.databases
+                     if database.name in updates]
+        reports = pmap(
+            _set_many, ((database, updates[database.name], kwargs)
+                        for database in databases))
 
-def _initialize_get(_job_ids, _kwargs):
-    # TODO Test if we do 2 pmap simultaneously if it breaks global
-    # found_job_ids values across both pmaps
-    global get_job_ids, get_kwargs
-    get_job_ids = _job_ids
-    get_kwargs = _kwargs
+        experiment_names = map(lambda d: getattr(d, "name"), databases)
+        return dict(zip(experiment_names, reports))
 
 
-def _get(dataset):
-    dataset.get(get_job_ids, **get_kwargs)
+# Get
+################
+
+def _get(dataset, job_ids, kwargs):
+    return dataset.get(job_ids, **kwargs)
 
 
 # Set
 ################
 
-def _initialize_set(_job_ids, _kwargs):
-    # TODO Test if we do 2 pmap simultaneously if it breaks global
-    # found_job_ids values across both pmaps
-    global set_job_ids, set_kwargs
-    set_job_ids = _job_ids
-    set_kwargs = _kwargs
-
+def _set(dataset, job_ids, kwargs):
+    return dataset.set(job_ids, **kwargs)
 
-def _set(dataset):
-    dataset.set(set_job_ids, **set_kwargs)
 
-    # non_failed_jobs = [
-    #     row for row in dataset.set(job_ids=set_job_ids)
-    #     if row[dataset.STATUS] != status.FAILED]
-    # if non_failed_jobs:
-    #     # TODO
-    #     raise RuntimeError("Something went wrong... detail more")
+# Set many
+################
 
-    # return dataset.set(job_ids=set_job_ids, status=dataset.CANCELLED)
+def _set_many(dataset, updates, kwargs):
+    return dataset.set_many(updates, **kwargs)
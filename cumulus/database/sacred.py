@@ -1,10 +1,28 @@
+import logging
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+
 from base import AbstractStatus, AbstractDatabase
 
 from ..utils.json import flatten, expand
 
 
+logger = logging.getLogger(__name__)
+
+
+# Number of updates sent in each bulk_write
+BULK_BATCH_SIZE = 1000
+# Number of times a batch is sent again after losing the connection, waiting
+# BULK_RETRY_DELAY seconds the first time and twice as long each time after
+BULK_MAX_RETRIES = 3
+BULK_RETRY_DELAY = 0.5
+
+
 class Status(AbstractStatus):
     QUEUED = ["QUEUED", "INTERRUPTED"]
+    SUBMITTED = "SUBMITTED"
     RUNNING = "RUNNING"
     COMPLETED = "COMPLETED"
     FAILED = "FAILED"
@@ -17,6 +35,7 @@ status = Status()
 
 
 class Database(AbstractDatabase):
+    ROW_ID = "_id"
     CLUSTER = "info.cluster"
     NODE = "info.node"
     JOB_ID = "info.job_id"
@@ -27,6 +46,14 @@ class Database(AbstractDatabase):
     def __init__(self):
         pass
 
+    def _field(self, key):
+        """Name in the collection of the AbstractDatabase field key"""
+        for field in self._fields:
+            if getattr(AbstractDatabase, field) == key:
+                return getattr(self, field)
+
+        raise KeyError("Invalid key for Database: %s" % key)
+
     @property
     def projection(self):
         return {getattr(self, field): 1 for field in self._fields}
@@ -79,6 +106,96 @@ class Database(AbstractDatabase):
         self.validate_values(kwargs.itervalues())
 
         query = self.get_query(job_ids, row_ids, query)
-        updates = {"$set": {getattr(self, k): v}
-                   for k, v in kwargs.iteritems()}
+        updates = {"$set": dict((self._field(k), v)
+                                for k, v in kwargs.iteritems())}
         return self.table.update_many(query, updates).modified_count
+
+    def set_many(self, updates, batch_size=BULK_BATCH_SIZE, ordered=True,
+                 max_retries=BULK_MAX_RETRIES):
+        """
+        Set different values on many rows, with one bulk_write per batch of
+        updates
+
+        Ex:
+            database.set_many({row_id: dict(job_id="1234[0]",
+                                            cluster="hades"), ...})
+
+        Parameters
+        ----------
+
+        updates: dict
+            Values by key, like the kwargs of set, by row id.
+        batch_size: int
+            Number of updates in each bulk_write.
+        ordered: bool
+            Stop at the first update which fails, otherwise apply all the
+            other ones.
+        max_retries: int
+            Number of times a batch is sent again when the connection is
+            lost. Setting values is idempotent, so a batch partially applied
+            before the connection was lost can be sent again.
+
+        Returns
+        -------
+
+        dict with
+            matched: int, number of rows found
+            modified: int, number of rows whose values changed
+            batches: int, number of batches written
+            errors: dict of error message by row id
+            skipped: list of row ids not updated because an update failed
+                before them, when ordered
+        """
+        for values in updates.itervalues():
+            self.validate_keys(values.iterkeys())
+            self.validate_values(values.itervalues())
+
+        row_ids = updates.keys()
+        report = dict(matched=0, modified=0, batches=0, errors={},
+                      skipped=[])
+        for start in xrange(0, len(row_ids), batch_size):
+            batch_ids = row_ids[start:start + batch_size]
+            requests = [
+                UpdateOne({self.ROW_ID: row_id},
+                          {"$set": dict((self._field(k), v) for k, v
+                                        in updates[row_id].iteritems())})
+                for row_id in batch_ids]
+
+            result = self._bulk_write(requests, ordered, max_retries)
+            report["batches"] += 1
+            report["matched"] += result["nMatched"]
+            report["modified"] += result["nModified"]
+            for error in result["writeErrors"]:
+                report["errors"][batch_ids[error["index"]]] = error["errmsg"]
+
+            if ordered and result["writeErrors"]:
+                failed = result["writeErrors"][0]["index"]
+                report["skipped"] = (batch_ids[failed + 1:] +
+                                     row_ids[start + batch_size:])
+                break
+
+        logger.info("%d rows matched and %d modified in %d batches, %d "
+                    "failed" % (report["matched"], report["modified"],
+                                report["batches"], len(report["errors"])))
+
+        return report
+
+    def _bulk_write(self, requests, ordered, max_retries):
+        """Result of bulk_write, with the errors of its updates"""
+        delay = BULK_RETRY_DELAY
+        for attempt in xrange(max_retries + 1):
+            try:
+                result = self.table.bulk_write(requests, ordered=ordered)
+            except BulkWriteError as e:
+                return e.details
+            except AutoReconnect as e:
+                if attempt == max_retries:
+                    raise
+                logger.warning("Lost connection during bulk write, retrying "
+                               "in %.1fs: %s" % (delay, str(e)))
+                time.sleep(delay)
+                delay *= 2
+            else:
+                return dict(nMatched=result.matched_count,
+                            nModified=result.modified_count,
+                            writeErrors=[])
@@ -1,4 +1,4 @@
-from research.framework.utils.scripts import command_is_available
+from cumulus.utils.scripts import command_is_available
 
 from .qstat import qstat
 from .squeue import squeue
@@ -1,48 +1,39 @@
 from collections import defaultdict
 import re
-import subprocess
-import sys
+import xml.etree.cElementTree as ElementTree
 
-from research.framework.utils.num import is_int
+from cumulus.utils.num import is_int
+from cumulus.utils.scripts import Command
 
 
-def qstat(username=None, job_id=None):
+def qstat(username=None, job_id=None, attributes=None):
     if username is None:
         command = "qstat -f"
     else:
         command = "qstat -f -u %s" % username
 
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
-
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
-
-    full_qstat = process.stdout.read()
+    full_process = Command([command], shell=True)
 
     if username is None:
         command = "qstat -t"
     else:
         command = "qstat -t -u %s" % username
 
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
+    # Both commands run at the same time, the rows are buffered in the pipe
+    # while the full description is parsed.
+    row_process = Command([command], shell=True)
 
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
+    jobs = parse_qstat_stream(
+        iter(row_process.stdout.readline, ""),
+        iter(full_process.stdout.readline, ""),
+        attributes=attributes)
 
-    row_qstat = process.stdout.read()
-
-    jobs = parse_qstat(row_qstat, full_qstat)
+    for process in [full_process, row_process]:
+        process.check()
 
     if job_id is not None:
-        return filter(lambda job: job["id"] == job_id, jobs)
+        return dict((key, job) for key, job in jobs.iteritems()
+                    if job["id"] == job_id)
     else:
         return jobs
 
@@ -63,7 +54,7 @@ def parse_qstat(row_qstat, full_qstat):
 
         for line in job_desc.split("\n")[1:]:
 
-            if line[0] == "\t":
+            if line[:1] == "\t":
                 if last_key is None:
                     raise ValueError("qstat stdout is not formatted correctly")
                 job[last_key] += line[1:]
@@ -82,16 +73,198 @@ def parse_qstat(row_qstat, full_qstat):
 
         jobs[job["id"]] = job
 
-    # R: Running
-    # Q: Queued
-    # H: On hold
+    return count_qstat_rows(row_qstat.split("\n"), jobs)
+
+
+def iter_qstat_full(lines, attributes=None):
+    """
+    Parse the output of qstat -f line by line and yield the jobs one by one
+
+    Parameters
+    ----------
+
+    lines: iterable of str
+        Lines of qstat -f output, can be a pipe.
+    attributes: collection of str or None
+        Attributes of the jobs to keep. All attributes are kept if None. The id
+        of the job is always kept.
+    """
+    job = None
+    last_key = None
+    for line in lines:
+        if line.startswith("Job Id:"):
+            if job is not None:
+                yield job
+            job = dict(id=line.split(":")[-1].strip())
+            last_key = None
+            continue
+
+        if job is None:
+            continue
+
+        # Long values are wrapped on following lines starting with a tab
+        if line[:1] == "\t":
+            if last_key is None:
+                raise ValueError("qstat stdout is not formatted correctly")
+            if last_key in job:
+                job[last_key] += line[1:].rstrip("\n")
+            continue
+
+        line = line.strip()
+        if not line:
+            continue
+
+        key, _, value = line.partition(" = ")
+        key = key.strip()
+        if attributes is None or key in attributes:
+            job[key] = value.strip()
+        last_key = key
+
+    if job is not None:
+        yield job
+
+
+array_index_regex = re.compile("\[[0-9]+\]")
+
+
+def count_qstat_rows(lines, jobs):
+    """
+    Count the states of the jobs listed by qstat -t, adding them to the
+    job_array of the jobs parsed from qstat -f. Tasks of job arrays are counted
+    in their parent job.
+    """
     job_id_index = 0
-    state_index = 9
-    for row in filter(lambda a: a.strip(), row_qstat.split("\n")):
-        if is_int(row[0]):
-            row = row.split()
+    state_index = None  # Need to find it
+    for row in lines:
+        row = row.split()
+        if not row:
+            continue
+
+        if is_int(row[0][0]):
+            assert state_index is not None
             job_id = row[job_id_index]
-            state = row[state_index]
-            jobs[job_id]["job_array"][state] += 1
+            if job_id not in jobs:
+                job_id = array_index_regex.sub("[]", job_id)
+            jobs[job_id]["job_array"][row[state_index]] += 1
+        elif len(row) > 4 and row[4] == "S":
+            state_index = 4
+        elif len(row) > 9 and row[9] == "S":
+            state_index = 9
+
+    return jobs
+
+
+def parse_qstat_stream(row_lines, full_lines, attributes=None):
+    """
+    Streaming equivalent of parse_qstat, consuming the outputs of qstat -t and
+    qstat -f line by line without holding them in memory.
+    """
+    jobs = {}
+    for job in iter_qstat_full(full_lines, attributes):
+        if job["id"] in jobs:
+            raise ValueError("Two jobs have the same ids: %s" % job["id"])
+
+        job["job_array"] = defaultdict(int)
+        jobs[job["id"]] = job
+
+    return count_qstat_rows(row_lines, jobs)
+
+
+def qstat_xml(username=None, job_id=None, attributes=None):
+    """
+    Same as qstat but with a single call to qstat, using its XML output which
+    includes both the attributes of the jobs and the tasks of job arrays.
+    """
+    command = ["qstat", "-x", "-t"]
+    if username is not None:
+        command += ["-u", username]
+
+    process = Command(command)
+    try:
+        jobs = parse_qstat_xml(process.stdout, attributes=attributes)
+    except ElementTree.ParseError:
+        # Nothing is printed when qstat fails, nor when there is no job
+        process.check()
+        jobs = {}
+    process.check()
+
+    if job_id is not None:
+        return dict((key, job) for key, job in jobs.iteritems()
+                    if job["id"] == job_id)
+    else:
+        return jobs
+
+
+def _flatten_element(element, job, prefix=""):
+    for child in element:
+        if len(child):
+            _flatten_element(child, job, prefix + child.tag + ".")
+        else:
+            job[prefix + child.tag] = (child.text or "").strip()
+
+
+def iter_qstat_xml(stream, attributes=None):
+    """
+    Parse the output of qstat -x incrementally and yield the jobs one by one.
+    Nested elements are flattened with dots like in the output of qstat -f,
+    ex: Resource_List.walltime.
+
+    Parameters
+    ----------
+
+    stream: file-like object
+        Output of qstat -x, can be a pipe.
+    attributes: collection of str or None
+        Attributes of the jobs to keep. All attributes are kept if None. The id
+        and the state of the job are always kept.
+    """
+    if attributes is not None:
+        attributes = set(attributes) | set(["id", "job_state"])
+
+    for _, element in ElementTree.iterparse(stream):
+        if element.tag != "Job":
+            continue
+
+        job = {}
+        _flatten_element(element, job)
+        job["id"] = job.pop("Job_Id")
+
+        # Free the parsed job as we go, only an empty element remains
+        element.clear()
+
+        if attributes is not None:
+            job = dict((key, value) for key, value in job.iteritems()
+                       if key in attributes)
+
+        yield job
+
+
+def parse_qstat_xml(stream, attributes=None):
+    """
+    Build the queue from the output of qstat -x -t. Tasks of job arrays are
+    counted in the job_array of their parent job.
+    """
+    jobs = {}
+    for job in iter_qstat_xml(stream, attributes):
+        job_id = job["id"]
+        parent_id = array_index_regex.sub("[]", job_id)
+        if job_id != parent_id:
+            # A task of a job array
+            if parent_id not in jobs:
+                parent = dict(job, id=parent_id)
+                parent["job_array"] = defaultdict(int)
+                jobs[parent_id] = parent
+            jobs[parent_id]["job_array"][job["job_state"]] += 1
+        elif "[]" in job_id:
+            # Summary of a job array, the tasks are counted separately
+            if job_id in jobs:
+                jobs[job_id].update(job)
+            else:
+                job["job_array"] = defaultdict(int)
+                jobs[job_id] = job
+        else:
+            job["job_array"] = defaultdict(int)
+            job["job_array"][job["job_state"]] += 1
+            jobs[job_id] = job
 
     return jobs
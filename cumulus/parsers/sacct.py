@@ -0,0 +1,98 @@
+"""
+    Query the accounting database of Slurm for the tasks which left the queue.
+    squeue only lists pending and running jobs, sacct tells how the others
+    ended.
+
+    Ex:
+        jobs = sacct(username="bouthilx", since=10 * 60)
+        jobs["1234"]["job_array"]  # {"COMPLETED": 98, "FAILED": 2}
+"""
+
+from collections import defaultdict
+import datetime
+
+from cumulus.utils.scripts import Command
+
+
+# Fields of sacct --format, the job name comes last because it may contain
+# the delimiter.
+PARSABLE_FIELDS = [
+    ("JobID", "JobID"),
+    ("ST", "State"),
+    ("exec_host", "NodeList"),
+    ("Job_Name", "JobName")]
+
+DELIMITER = "|"
+
+# States of the tasks which left the queue
+FINISHED_STATES = ["BF", "CA", "CD", "DL", "F", "NF", "OOM", "PR", "TO"]
+
+
+def sacct(username=None, job_id=None, since=None, states=FINISHED_STATES):
+    """
+    Return the tasks which were in one of the given states in the last
+    `since` seconds, counted by array job like squeue_parsable
+    """
+    process = sacct_process(username, job_id, since, states)
+    jobs = parse_sacct(iter(process.stdout.readline, ""))
+    process.check()
+
+    return jobs
+
+
+def sacct_process(username=None, job_id=None, since=None,
+                  states=FINISHED_STATES):
+    """Start sacct, its output is parsed with parse_sacct"""
+    command = ["sacct", "--parsable2", "--noheader", "--allocations",
+               "--delimiter=%s" % DELIMITER,
+               "--format=%s" % ",".join(field for _, field
+                                        in PARSABLE_FIELDS)]
+    if username is not None:
+        command += ["--user", username]
+    else:
+        command += ["--allusers"]
+    if job_id is not None:
+        command += ["--jobs", job_id]
+    if since is not None:
+        now = datetime.datetime.now()
+        command += [
+            "--starttime",
+            (now - datetime.timedelta(seconds=since)).strftime(
+                "%Y-%m-%dT%H:%M:%S"),
+            "--endtime", now.strftime("%Y-%m-%dT%H:%M:%S")]
+    if states:
+        command += ["--state", ",".join(states)]
+
+    return Command(command)
+
+
+def parse_sacct(lines, jobs=None):
+    """
+    Build the queue from the output of sacct --parsable2 with
+    PARSABLE_FIELDS. Tasks of job arrays are counted in the job_array of
+    their array job. If jobs is given, the tasks are added to it.
+    """
+    names = [name for name, _ in PARSABLE_FIELDS]
+    maxsplit = len(names) - 1
+
+    if jobs is None:
+        jobs = {}
+
+    for line in lines:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+
+        row = dict(zip(names, line.split(DELIMITER, maxsplit)))
+        # ex: CANCELLED by 1234
+        row["ST"] = row["ST"].split(" ", 1)[0]
+        # ex: 1234_7, or 1234_[8-100%10] for tasks which did not start
+        job_id = row["JobID"].split("_", 1)[0]
+        if job_id not in jobs:
+            row["id"] = job_id
+            row["job_array"] = defaultdict(int)
+            jobs[job_id] = row
+
+        jobs[job_id]["job_array"][row["ST"]] += 1
+
+    return jobs
@@ -2,9 +2,9 @@ from collections import defaultdict
 import subprocess
 import sys
 
-from research import config
-
-from research.framework.utils.num import is_int
+from cumulus import config
+from cumulus.utils.num import is_int
+from cumulus.utils.scripts import Command
 
 
 _slurm_state_to_moab = {
@@ -15,7 +15,7 @@ _slurm_state_to_moab = {
 
 
 def convert_to_moab(state, scheduler="slurm"):
-    if state not in _slurm_state_to_moab[state]:
+    if state not in _slurm_state_to_moab:
         raise ValueError("Convertion unknown for scheduler %s with state %s" %
                          (state, scheduler))
 
@@ -30,7 +30,7 @@ def squeue(username=None, job_id=None, format_option=None):
     if username is None:
         command = "squeue --Format=%s" % format_option
     else:
-        command = "qstat -u %s --Format=%s" % (username, format_option)
+        command = "squeue -u %s --Format=%s" % (username, format_option)
 
     process = subprocess.Popen([command],
                                stdout=subprocess.PIPE,
@@ -78,3 +78,61 @@ def parse_squeue(row_squeue):
 
     return jobs
 
+
+# Fields of squeue --format, the job name comes last because it may contain
+# the delimiter.
+PARSABLE_FIELDS = [
+    ("JOBID", "%i"),
+    ("id", "%F"),
+    ("ARRAY_TASK_ID", "%K"),
+    ("ST", "%t"),
+    ("exec_host", "%N"),
+    ("Job_Name", "%j")]
+
+DELIMITER = "|"
+
+
+def squeue_parsable(username=None, job_id=None):
+    """
+    Same as squeue but using a fixed delimiter, one line per task of job
+    arrays, so the output can be parsed as it is read.
+    """
+    command = ["squeue", "--noheader", "--array",
+               "--format=%s" % DELIMITER.join(code for _, code
+                                              in PARSABLE_FIELDS)]
+    if username is not None:
+        command += ["--user", username]
+    if job_id is not None:
+        command += ["--jobs", job_id]
+
+    process = Command(command)
+    jobs = parse_squeue_parsable(iter(process.stdout.readline, ""))
+    process.check()
+
+    return jobs
+
+
+def parse_squeue_parsable(lines):
+    """
+    Build the queue from the output of squeue --noheader --array with
+    PARSABLE_FIELDS. Tasks of job arrays are counted in the job_array of
+    their array job.
+    """
+    names = [name for name, _ in PARSABLE_FIELDS]
+    maxsplit = len(names) - 1
+
+    jobs = {}
+    for line in lines:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+
+        row = dict(zip(names, line.split(DELIMITER, maxsplit)))
+        job_id = row["id"]
+        if job_id not in jobs:
+            row["job_array"] = defaultdict(int)
+            jobs[job_id] = row
+
+        jobs[job_id]["job_array"][row["ST"]] += 1
+
+    return jobs
@@ -1,83 +1,459 @@
 from abc import ABCMeta, abstractmethod
-import copy
+from collections import OrderedDict
+import logging
 import os
+import pipes
 import re
+import subprocess
+import threading
+import time
+import uuid
+
+import numpy
+
+
+logger = logging.getLogger(__name__)
+
+
+# Environment variable holding the row id of the experiment run by a task of
+# a job array submitted by submit_batch
+ROW_ID = "CUMULUS_ROW_ID"
+
+ARRAY_SCRIPT = """#!/bin/bash
+ROW_IDS=(%(row_ids)s)
+export %(row_id)s=${ROW_IDS[$%(task_id)s]}
+
+%(arguments)s
+"""
+
+# A single job id, ex: 1234[].hades or 1234_5. Anything else is a regex.
+job_id_regex = re.compile(r"^[\w.\[\]]+$")
+
+# Cancellations not confirmed after this number of seconds are forgotten
+TICKET_TTL = 60 * 60
+tickets_lock = threading.Lock()
+
+# Fields of a job which must be identical to share a job array
+BATCH_KEYS = ("job_name", "queue", "time", "arguments")
+
+
+def group_batch(jobs, max_array_size):
+    """
+    Group jobs sharing the same job_name, queue, time and arguments into
+    lists of row ids of at most max_array_size, in order of appearance
+
+    Parameters
+    ----------
+
+    jobs: list of dict
+        Each with a row_id and the keys of BATCH_KEYS.
+    max_array_size: int
+
+    Returns
+    -------
+
+    list of (dict of BATCH_KEYS, list of row ids)
+    """
+    groups = OrderedDict()
+    for job in jobs:
+        key = tuple(job[name] for name in BATCH_KEYS)
+        groups.setdefault(key, []).append(job["row_id"])
+
+    arrays = []
+    for key, row_ids in groups.iteritems():
+        for start in xrange(0, len(row_ids), max_array_size):
+            arrays.append((dict(zip(BATCH_KEYS, key)),
+                           row_ids[start:start + max_array_size]))
+
+    return arrays
+
+
+def task_id_regex(job_ids):
+    """
+    Regex matching the job ids and the job ids of their tasks, ex: 1234[].hades
+    matches 1234[5].hades and 1234 matches 1234_5
+    """
+    patterns = []
+    for job_id in job_ids:
+        if "[]" in job_id:
+            prefix, suffix = job_id.split("[]", 1)
+            patterns.append(r"%s\[\d*\]%s" % (re.escape(prefix),
+                                               re.escape(suffix)))
+        else:
+            patterns.append(r"%s(_\d+)?" % re.escape(job_id))
+
+    return re.compile("^(%s)$" % "|".join(patterns))
+
+
+def array_script(row_ids, arguments, task_id_variable):
+    """Script of a job array whose tasks run arguments with their row id"""
+    return ARRAY_SCRIPT % dict(
+        row_ids=" ".join(pipes.quote(str(row_id)) for row_id in row_ids),
+        row_id=ROW_ID, task_id=task_id_variable, arguments=arguments)
+
+
+class SchedulerMeta(ABCMeta):
+    """
+    Precompute the mapping of the scheduler's states to the standard status of
+    AbstractScheduler when a scheduler class is created. A standard status
+    may be given a list of states, ex: FAILED = ["F", "NF", "TO"].
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(SchedulerMeta, cls).__init__(name, bases, attrs)
+
+        lookup = {}
+        for status_key in cls._status:
+            states = getattr(cls, status_key)
+            if not isinstance(states, (list, tuple)):
+                states = [states]
+            for state in states:
+                if lookup.get(state, status_key) != status_key:
+                    raise ValueError(
+                        "State %s of %s is mapped to both %s and %s" %
+                        (state, name, lookup[state], status_key))
+                lookup[state] = status_key
+
+        # Standardizing twice is harmless
+        for status_key in cls._status:
+            lookup.setdefault(status_key, status_key)
+
+        cls._status_lookup = lookup
+        cls._status_indices = dict(
+            (state, cls._status.index(status_key))
+            for state, status_key in lookup.iteritems())
+
+
+CANCELLABLE_STATUS = set(["RUNNING", "QUEUED", "HOLD"])
+
+# Unknown states already reported, to warn only once per state
+_unknown_states = set()
+
+
+def warn_unknown_states(states):
+    new_states = set(states) - _unknown_states
+    if new_states:
+        _unknown_states.update(new_states)
+        logger.warning("Unknown scheduler states counted as UNKNOWN: %s" %
+                       ", ".join(sorted(str(state) for state in new_states)))
+
+
+class CancelTicket(object):
+    """Jobs cancelled by a single scheduler call, until they leave the queue"""
+
+    def __init__(self, job_ids, username):
+        self.id = uuid.uuid4().hex
+        self.job_ids = job_ids
+        self.username = username
+        self.created = time.time()
+
+    def age(self):
+        return time.time() - self.created
 
 
 class AbstractScheduler(object):
-    __meta__ = ABCMeta
+    __metaclass__ = SchedulerMeta
 
     JOB_ID = "PBS_ARRAYID"
     JOBARRAY_ID = "PBS_JOBID"
+    # Index of the task inside its job array
+    ARRAY_TASK_ID = "PBS_ARRAYID"
+
+    # Largest job array accepted by the scheduler, may be lowered by clusters
+    MAX_ARRAY_SIZE = 1000
 
     FAILED = "FAILED"
     RUNNING = "RUNNING"
     COMPLETED = "COMPLETED"
     QUEUED = "QUEUED"
     HOLD = "HOLD"
+    # States the scheduler does not list are counted here instead of dropped
+    UNKNOWN = "UNKNOWN"
+
+    _status = ["FAILED", "RUNNING", "COMPLETED", "QUEUED", "HOLD", "UNKNOWN"]
 
-    _status = ["FAILED", "RUNNING", "COMPLETED", "QUEUED", "HOLD"]
+    # QueueCache shared by the clients of a socket server, if any
+    cache = None
 
     @abstractmethod
     def submit(self):
         pass
 
+    @abstractmethod
+    def submit_array(self, queue, job_name, time, row_ids, arguments,
+                     throttle=None, log_dir=None):
+        """
+        Submit a job array of len(row_ids) tasks, with at most throttle of
+        them running at the same time, and return its job id. The tasks
+        write their outputs in log_dir, an absolute path, or where the
+        scheduler puts them by default if None.
+        """
+        pass
+
+    @abstractmethod
+    def task_id(self, job_id, index):
+        """Job id of the task at index of job array job_id"""
+        pass
+
+    def submit_batch(self, jobs, max_array_size=None, throttle=None,
+                     log_dir=None):
+        """
+        Submit jobs with as few job arrays as possible, with one scheduler
+        call per job array. Each task finds the row id of its experiment in
+        the environment variable CUMULUS_ROW_ID.
+
+        Parameters
+        ----------
+
+        jobs: list of dict
+            Each with the keys row_id, job_name, queue, time and arguments.
+            Jobs differing on anything but row_id are put in different job
+            arrays.
+        max_array_size: int or None
+            Maximum number of tasks per job array. Defaults to MAX_ARRAY_SIZE.
+        throttle: int or None
+            Maximum number of tasks of each job array running at the same
+            time. Not limited if None.
+        log_dir: str or None
+            Directory where the tasks write their outputs, created if
+            missing. See submit_array.
+
+        Returns
+        -------
+
+        dict with
+            tasks: dict of task job id by row id
+            arrays: list of the job ids of the job arrays submitted
+            errors: dict of submission error by row id
+        """
+        if max_array_size is None:
+            max_array_size = self.MAX_ARRAY_SIZE
+
+        if log_dir is not None and not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+        tasks = {}
+        arrays = []
+        errors = {}
+        for options, row_ids in group_batch(jobs, max_array_size):
+            try:
+                job_id = self.submit_array(row_ids=row_ids,
+                                           throttle=throttle,
+                                           log_dir=log_dir, **options)
+            except (OSError, RuntimeError) as e:
+                logger.error("Could not submit job array of %d jobs for %s: "
+                             "%s" % (len(row_ids), options["job_name"],
+                                     str(e)))
+                for row_id in row_ids:
+                    errors[row_id] = str(e)
+                continue
+
+            arrays.append(job_id)
+            for index, row_id in enumerate(row_ids):
+                tasks[row_id] = self.task_id(job_id, index)
+
+        logger.info("Submitted %d jobs in %d job arrays, %d failed" %
+                    (len(tasks), len(arrays), len(errors)))
+
+        return dict(tasks=tasks, arrays=arrays, errors=errors)
+
     @abstractmethod
     def queue(self):
         pass
 
     @abstractmethod
-    def cancel(self):
+    def cancel_command(self, job_ids, job_array_id=None):
+        """
+        Command cancelling all job_ids at once, or only the tasks in range
+        job_array_id (ex: 0-99) of each of them
+        """
         pass
 
-    def _get_cancellable_jobs(self, job_id, job_array_id=None):
+    def parse_cancel_errors(self, stderrdata):
+        """Return the job ids which could not be cancelled"""
+        return set()
+
+    @property
+    def tickets(self):
+        with tickets_lock:
+            if getattr(self, "_tickets", None) is None:
+                self._tickets = {}
+
+            return self._tickets
+
+    def cancel(self, job_id, job_array_id=None):
+        """
+        Cancel the jobs matching job_id with a single scheduler call and
+        return without waiting for them to leave the queue
+
+        Parameters
+        ----------
+
+        job_id: str or list of str
+            A job id, * for all jobs of the user, a regex or a list of job
+            ids.
+        job_array_id: str or None
+            Range of tasks to cancel in each job array, ex: 0-99. All the
+            tasks are cancelled if None.
+
+        Returns
+        -------
+
+        dict with
+            ticket: id to give to cancel_status to confirm the cancellation,
+                None if there is nothing to confirm
+            job_ids: list of the jobs cancelled
+            failed: list of the jobs the scheduler could not cancel
+        """
         username = os.environ["USER"]
+        # * and regexes are resolved before the range of tasks is applied
+        job_ids = self._get_cancellable_jobs(job_id)
 
-        if job_array_id is not None:
-            raise NotImplementedError("Does not support cancelling jobarray "
-                                      "yet")
+        if not job_ids:
+            return dict(ticket=None, job_ids=[], failed=[])
 
-        if job_id.replace(".", "").isalnum():
-            jobs = self.queue(username=username, job_id=job_id)
+        process = subprocess.Popen(
+            self.cancel_command(job_ids, job_array_id),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderrdata = process.communicate()
+
+        # The schedulers go on with the other jobs when one fails
+        failed = self.parse_cancel_errors(stderrdata)
+        if process.returncode != 0 and not failed:
+            raise RuntimeError(stderrdata)
+
+        job_ids = [job_id for job_id in job_ids if job_id not in failed]
+        logger.info("Cancelled %d jobs, %d failed" %
+                    (len(job_ids), len(failed)))
+
+        # The queue counts the tasks by job array, a cancelled range of tasks
+        # cannot be told apart from the others.
+        if job_array_id is not None or not job_ids:
+            return dict(ticket=None, job_ids=job_ids, failed=sorted(failed))
+
+        ticket = CancelTicket(job_ids, username)
+        tickets = self.tickets
+        with tickets_lock:
+            for key, other in tickets.items():
+                if other.age() > TICKET_TTL:
+                    del tickets[key]
+            tickets[ticket.id] = ticket
+
+        return dict(ticket=ticket.id, job_ids=job_ids, failed=sorted(failed))
+
+    def cancel_status(self, ticket):
+        """
+        Tell which jobs of a cancellation left the queue. The cached queue is
+        used if it was updated after the cancellation, otherwise the queue is
+        refreshed once.
+
+        Returns
+        -------
+
+        dict with
+            cancelled: list of the jobs which left the queue
+            pending: list of the jobs still running or queued
+            done: True if no job is pending. The ticket is then forgotten.
+            elapsed: seconds since the cancellation
+        """
+        tickets = self.tickets
+        with tickets_lock:
+            cancel_ticket = tickets.get(ticket)
+
+        if cancel_ticket is None:
+            raise KeyError("Unknown or expired cancellation ticket %s" %
+                           ticket)
+
+        elapsed = cancel_ticket.age()
+        jobs = self.cached_queue(elapsed, username=cancel_ticket.username)
+        pending = [job_id for job_id in cancel_ticket.job_ids
+                   if job_id in jobs and self._is_cancellable(jobs[job_id])]
+        done = not pending
+        if done:
+            with tickets_lock:
+                tickets.pop(ticket, None)
+
+        return dict(ticket=ticket, done=done, elapsed=elapsed,
+                    pending=pending,
+                    cancelled=[job_id for job_id in cancel_ticket.job_ids
+                               if job_id not in pending])
+
+    def cached_queue(self, max_age=None, **kwargs):
+        if self.cache is None:
+            return self.queue(**kwargs)
+
+        return self.cache.get(max_age=max_age, **kwargs)[0]
+
+    def _is_cancellable(self, job):
+        return any(count > 0 and status in CANCELLABLE_STATUS
+                   for status, count in job["job_array"].iteritems())
+
+    def _get_cancellable_jobs(self, job_id, max_age=None):
+        username = os.environ["USER"]
+
+        if isinstance(job_id, list):
+            job_ids = set(job_id)
+            jobs = self.cached_queue(max_age, username=username)
+            jobs = dict((key, job) for key, job in jobs.iteritems()
+                        if key in job_ids)
         elif job_id.strip() == "*":
-            jobs = self.queue(username=username)
+            jobs = self.cached_queue(max_age, username=username)
+        elif job_id_regex.match(job_id):
+            jobs = self.cached_queue(max_age, username=username,
+                                     job_id=job_id)
         else:
             regex = re.compile(job_id)
-            jobs = self.queue(username=username)
-            job = [
-                job for job in jobs if regex.match(job["job_id"])]
-
-        cancellable_status = set(self.RUNNING, self.QUEUED, self.HOLD)
-        job_ids = []
-        for job in jobs:
-            if any(status in cancellable_status
-                   for status in job['status'].keys()):
-                job_ids.append(job['job_id'])
+            jobs = self.cached_queue(max_age, username=username)
+            jobs = dict((key, job) for key, job in jobs.iteritems()
+                        if regex.match(key))
 
-        return job_ids
+        return [key for key, job in jobs.iteritems()
+                if self._is_cancellable(job)]
 
     def get_status_key(self, status):
-        status_key = [status_key for status_key in self._status
-                      if getattr(self, status_key) == status]
+        return self._status_lookup[status]
+
+    @classmethod
+    def standardize_codes(cls, states):
+        """
+        Map an array of scheduler states to indices of standard status in
+        _status, the one of UNKNOWN for unknown states. Each distinct state is
+        looked up once.
+        """
+        if len(states) == 0:
+            return numpy.zeros(0, dtype=int)
 
-        # TODO Maybe support many to one mapping, meaning we could return a
-        # list of status keys
-        assert len(status_key) == 1
+        unique_states, codes = numpy.unique(states, return_inverse=True)
+        unknown = [state for state in unique_states
+                   if state not in cls._status_indices]
+        if unknown:
+            warn_unknown_states(unknown)
 
-        return status_key[0]
+        unknown_index = cls._status.index(cls.UNKNOWN)
+        lookup = numpy.array([cls._status_indices.get(state, unknown_index)
+                              for state in unique_states])
+        return lookup[codes]
 
     def _standardize_status(self, jobs, inplace=True):
+        lookup = self._status_lookup
+
+        if inplace:
+            standardized_jobs = jobs
+        else:
+            standardized_jobs = {}
 
-        if not inplace:
-            jobs = copy.deepcopy(jobs)
+        for job_id, job in jobs.iteritems():
+            job_array = {}
+            for state, count in job["job_array"].iteritems():
+                status_key = lookup.get(state)
+                if status_key is None:
+                    warn_unknown_states([state])
+                    status_key = self.UNKNOWN
+                job_array[status_key] = job_array.get(status_key, 0) + count
 
-        for job_id, informations in jobs.iteritems():
-            for job_array in informations["job_array"]:
-                for custom_status in list(job_array.keys()):
-                    status_key = self.get_status_key(custom_status)
-                    standard_status = getattr(AbstractScheduler, status_key)
-                    if standard_status in job_array:
-                        job_array[standard_status] += job_array[custom_status]
-                    del job_array[custom_status]
+            if not inplace:
+                job = dict(job)
+            job["job_array"] = job_array
+            standardized_jobs[job_id] = job
 
-        return jobs
+        return standardized_jobs
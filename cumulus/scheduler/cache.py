@@ -0,0 +1,146 @@
+"""
+    Cache of the scheduler's queue shared by all the clients of a socket
+    server. A background thread refreshes the queries that were read recently
+    every `interval` seconds, so that clients are served from memory instead
+    of each one calling qstat or squeue.
+
+    Ex:
+        cache = QueueCache(scheduler, ttl=30, interval=15)
+        cache.start()
+        queue, metadata = cache.get(username="bouthilx")
+        queue, metadata = cache.get(refresh=True)
+        cache.stop()
+"""
+
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TTL = 30
+DEFAULT_INTERVAL = 15
+
+# Queries not read for that long are not refreshed in background anymore
+IDLE_TIMEOUT = 10 * 60
+
+
+class CacheEntry(object):
+
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.queue = None
+        self.updated = None
+        self.last_read = time.time()
+        self.lock = threading.Lock()
+
+    def age(self):
+        if self.updated is None:
+            return None
+
+        return time.time() - self.updated
+
+
+class QueueCache(object):
+
+    def __init__(self, scheduler, ttl=DEFAULT_TTL, interval=DEFAULT_INTERVAL):
+        self.scheduler = scheduler
+        self.ttl = ttl
+        self.interval = interval
+
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._poller = None
+
+    def _get_entry(self, kwargs):
+        kwargs = dict((k, v) for k, v in kwargs.iteritems() if v is not None)
+        key = json.dumps(kwargs, sort_keys=True)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = CacheEntry(kwargs)
+            return self._entries[key]
+
+    def _refresh(self, entry, max_age):
+        # Many readers may need a refresh at the same time, only the first
+        # one calls the scheduler.
+        with entry.lock:
+            age = entry.age()
+            if age is not None and age <= max_age:
+                return
+
+            logger.debug("Refreshing queue for %s" % str(entry.kwargs))
+            try:
+                entry.queue = self.scheduler.queue(**entry.kwargs)
+            except Exception:
+                if entry.queue is None:
+                    raise
+                logger.exception("Could not refresh queue, serving stale "
+                                 "queue")
+            else:
+                entry.updated = time.time()
+
+    def get(self, refresh=False, max_age=None, **kwargs):
+        """
+        Return the queue and the metadata of the cache for this query
+
+        Parameters
+        ----------
+
+        refresh: bool
+            Query the scheduler even if the cached queue is still valid.
+        max_age: float or None
+            Maximum age in seconds of the cached queue. Defaults to ttl.
+        """
+        if max_age is None:
+            max_age = self.ttl
+        if refresh:
+            max_age = -1
+
+        entry = self._get_entry(kwargs)
+        entry.last_read = time.time()
+        self._refresh(entry, max_age)
+
+        age = entry.age()
+        metadata = dict(updated=entry.updated, age=age, ttl=self.ttl,
+                        stale=age > self.ttl)
+
+        return entry.queue, metadata
+
+    def poll(self):
+        while not self._stop.wait(self.interval):
+            now = time.time()
+            with self._lock:
+                entries = self._entries.items()
+
+            for key, entry in entries:
+                if now - entry.last_read > IDLE_TIMEOUT:
+                    with self._lock:
+                        del self._entries[key]
+                    continue
+
+                try:
+                    self._refresh(entry, max_age=self.interval / 2.0)
+                except Exception:
+                    logger.exception("Could not refresh queue for %s" %
+                                     str(entry.kwargs))
+
+    def start(self):
+        if self._poller is not None:
+            raise RuntimeError("Queue poller already started")
+
+        self._stop.clear()
+        self._poller = threading.Thread(target=self.poll)
+        self._poller.daemon = True
+        self._poller.start()
+
+    def stop(self):
+        if self._poller is None:
+            return
+
+        self._stop.set()
+        self._poller.join()
+        self._poller = None
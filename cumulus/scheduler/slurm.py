@@ -1,155 +1,140 @@
-from collections import OrderedDict, defaultdict
-import datetime
+import logging
 import os
+import re
 import subprocess
-import sys
-import tempfile
 
-from cumulus.scheduler.base import AbstractScheduler
+from cumulus.parsers.sacct import sacct_process, parse_sacct
+from cumulus.parsers.squeue import squeue_parsable
+from cumulus.scheduler.base import AbstractScheduler, array_script
 from cumulus.scheduler import smartdispatch
-from cumulus.utils.script import command_is_available
-from cumulus.utils.num import is_int
+from cumulus.utils.scripts import command_is_available
 
 
-SBATCH_SCRIPT = """
-#!/bin/bash
+logger = logging.getLogger(__name__)
 
-%(options)s
 
-######################
-# Begin work section #
-######################
+# Number of seconds during which tasks which left the queue are still
+# reported, like Torque keeps completed jobs for a while.
+FINISHED_WINDOW = 10 * 60
 
-# Print this sub-job's task ID
-# Do some work based on the SLURM_ARRAY_TASK_ID
-
-%(script)s
-
-echo "Task ${SLURM_ARRAY_TASK_ID} completed"
-"""
+# ex: scancel: error: Kill job error on job id 1234_5: Invalid job id
+cancel_error_regex = re.compile(r"job id (\S+?):")
 
 
 class Scheduler(AbstractScheduler):
     JOB_ID = "SLURM_JOBID"
     JOBARRAY_ID = "SLURM_ARRAY_TASK_ID"
-
-    FAILED = "F"
-    RUNNING = "R"
-    COMPLETED = "CD"
-    QUEUED = "PD"
-    HOLD = "UNKNOWN"
-
-    def __init__(self):
-        pass
-
-    def submit(self, cluster, job_name, job_ids, time, command):
+    ARRAY_TASK_ID = "SLURM_ARRAY_TASK_ID"
+
+    # squeue reports compact states, sacct full ones
+    FAILED = ["F", "NF", "TO", "CA", "BF", "OOM", "DL", "PR",
+              "FAILED", "NODE_FAIL", "TIMEOUT", "CANCELLED", "BOOT_FAIL",
+              "OUT_OF_MEMORY", "DEADLINE", "PREEMPTED"]
+    RUNNING = ["R", "CG", "CF", "SO", "RUNNING", "COMPLETING",
+               "CONFIGURING"]
+    COMPLETED = ["CD", "COMPLETED"]
+    QUEUED = ["PD", "RQ", "RF", "RS", "PENDING", "REQUEUED", "REQUEUE_FED",
+              "RESIZING"]
+    HOLD = ["S", "ST", "RH", "SUSPENDED", "STOPPED", "REQUEUE_HOLD"]
+
+    def __init__(self, finished_window=FINISHED_WINDOW):
+        self.finished_window = finished_window
+
+    def submit(self, queue, job_name, time, row_ids, arguments):
         if command_is_available("smart-dispatch"):
-            smartdispatch.submit(cluster.queue, job_name, time)
-        pass
-
-    def queue(self):
-        pass
-
-    def cancel(self):
-        pass
-
-
-def build_command(job_name, time, ids, script, arguments):
-
-    # TODO Stop building a new directory, just make a temp script file
-    #      We alredy build a tmp directory with cumulus-particle run
-    working_dir = tempfile.mkdtemp(
-        prefix=job_name + "_",
-        suffix=datetime.datetime.now().strftime("_%Y-%m-%d_%H:%M:%S"))
-    working_dir = os.realpath(working_dir)
-
-    options = OrderedDict()
-    options["--time"] = time
-    options["--array"] = "0-%d" % (len(ids) - 1)
-    options["--work-dir"] = working_dir
+            return smartdispatch.submit(queue, job_name, time, row_ids,
+                                        arguments)
+
+        job_id = self.submit_array(queue, job_name, time, row_ids, arguments)
+        return [self.task_id(job_id, index)
+                for index in xrange(len(row_ids))]
+
+    def submit_array(self, queue, job_name, time, row_ids, arguments,
+                     throttle=None, log_dir=None):
+        command = build_command(queue, job_name, time, len(row_ids),
+                                throttle, log_dir)
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdoutdata, stderrdata = process.communicate(
+            array_script(row_ids, arguments, self.ARRAY_TASK_ID))
+        if process.returncode != 0:
+            raise RuntimeError(stderrdata)
+
+        # ex: 1234567 or 1234567;cluster
+        return stdoutdata.strip().split(";")[0]
+
+    def task_id(self, job_id, index):
+        return "%s_%d" % (job_id, index)
+
+    def queue(self, username=None, job_id=None, attributes=None):
+        """
+        Pending and running tasks from squeue, plus the tasks which ended in
+        the last finished_window seconds from sacct. Both run at the same
+        time.
+        """
+        finished_process = None
+        if self.finished_window:
+            finished_process = sacct_process(username, job_id,
+                                             since=self.finished_window)
+
+        jobs = squeue_parsable(username=username, job_id=job_id)
+
+        if finished_process is not None:
+            parse_sacct(iter(finished_process.stdout.readline, ""), jobs)
+            try:
+                finished_process.check()
+            except RuntimeError as e:
+                # The accounting database may not be available, the active
+                # jobs are still valid
+                logger.warning(str(e))
+
+        return self._standardize_status(jobs)
+
+    def cancel_command(self, job_ids, job_array_id=None):
+        if job_array_id is not None:
+            job_ids = ["%s_[%s]" % (job_id, job_array_id)
+                       for job_id in job_ids]
+
+        return ["scancel"] + job_ids
+
+    def parse_cancel_errors(self, stderrdata):
+        return set(cancel_error_regex.findall(stderrdata))
+
+
+def build_command(queue, job_name, time, n_tasks, throttle=None,
+                  log_dir=None):
+    """
+    sbatch command submitting a job array of n_tasks, whose script is given
+    on stdin
+
+    Parameters
+    ----------
+
+    queue: str
+        Partition of the job.
+    job_name: str or None
+    time: str
+        Walltime, ex: 12:00:00
+    n_tasks: int
+    throttle: int or None
+        Maximum number of tasks running at the same time.
+    log_dir: str or None
+        Directory where each task writes job_name_%A_%a.out and .err. The
+        outputs go where sbatch puts them by default if None.
+    """
+    array = "0-%d" % (n_tasks - 1)
+    if throttle:
+        array += "%%%d" % throttle
+
+    command = ["sbatch", "--parsable", "--array=%s" % array,
+               "--partition=%s" % queue, "--time=%s" % time]
     if job_name is not None:
-        options["--job-name"] = job_name
-        options["--output"] = job_name + "_%A_%a.out"
-
-    script_path = os.path.join(working_dir, "script.sh")
-    with open(script_path, 'w') as f:
-        f.write(SBATCH_SCRIPT % dict(
-            options="\n".join("%s = %s" % (name.strip("--"), value)
-                              for name, value in options.iteritems()),
-            script=arguments))
+        command.append("--job-name=%s" % job_name)
 
-    command = ["sbatch", script_path]
+    if log_dir is not None:
+        prefix = os.path.join(log_dir, job_name or "slurm")
+        command += ["--output=%s_%%A_%%a.out" % prefix,
+                    "--error=%s_%%A_%%a.err" % prefix]
 
     return command
-
-
-_slurm_state_to_moab = {
-    "F": "C",
-    "R": "R",
-    "CD": "C",
-    "PD": "Q"}
-
-
-def convert_to_moab(state, scheduler="slurm"):
-    if state not in _slurm_state_to_moab[state]:
-        raise ValueError("Convertion unknown for scheduler %s with state %s" %
-                         (state, scheduler))
-
-    return _slurm_state_to_moab[state]
-
-
-DEFAULT_FORMAT_OPTION = "arrayjobid,arraytaskid,statecompact"
-
-
-def squeue(username=None, job_id=None, format_option=DEFAULT_FORMAT_OPTION):
-
-    if username is None:
-        command = "squeue --Format=%s" % format_option
-    else:
-        command = "qstat -u %s --Format=%s" % (username, format_option)
-
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
-
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
-
-    return parse_squeue(process.stdout.read())
-
-
-def parse_squeue(row_squeue):
-    rows = filter(lambda a: a.strip(), row_squeue.split("\n"))
-
-    header = rows.pop(0)
-
-    if "ARRAY_JOB_ID" not in header:
-        raise ValueError("format_option should include arrayjobid")
-    if "ARRAY_TASK_ID" not in header:
-        raise ValueError("format_option should include arraytaskid")
-    if "ST" not in header:
-        raise ValueError("format_option should include statecompact")
-
-    job_id_index = header.index("ARRAY_JOB_ID")
-    job_array_id_index = header.index("ARRAY_TASK_ID")
-    state_index = header.index("ST")
-
-    jobs = {}
-    for row in map(str.split, rows):
-        if not is_int(row[job_id_index]):
-            continue
-
-        job_id = row[job_id_index]
-        job_array_id_index = row[job_array_id_index]
-        state = row[state_index]
-        if job_id not in jobs:
-            jobs[job_id] = dict(job_array=defaultdict(int))
-
-        for name, value in zip(header, row):
-            jobs[job_id][name] = value
-
-        jobs[job_id]["job_array"][state] += 1
-
-    return jobs
@@ -0,0 +1,108 @@
+"""
+    Columnar representation of a queue. Instead of a dict per job with a
+    job_array dict of counters, the counters of all jobs are held in a single
+    integer matrix with one row per job and one column per standard status
+    of AbstractScheduler. Only the attributes needed are kept, as columns.
+
+    Ex:
+        table = JobTable.from_queue(cluster.queue(), ["Job_Name"])
+        table.total(AbstractScheduler.RUNNING)
+        table.submitted()
+"""
+
+import logging
+
+import numpy
+
+from .base import AbstractScheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+STATUS = AbstractScheduler._status
+
+
+class JobTable(object):
+
+    def __init__(self, ids, counts, attributes=None):
+        self.ids = ids
+        self.counts = counts
+        if attributes is None:
+            attributes = {}
+        self.attributes = attributes
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_queue(cls, queue, attributes=tuple(),
+                   scheduler=AbstractScheduler):
+        """
+        Parameters
+        ----------
+
+        queue: dict
+            Jobs indexed by job id, with counters of tasks per status in
+            job_array.
+        attributes: list of str
+            Attributes of the jobs to keep as columns.
+        scheduler: AbstractScheduler class or instance
+            Scheduler whose states are used in job_array. Defaults to
+            standard status only.
+        """
+        ids = numpy.array(queue.keys(), dtype=object)
+        columns = dict((name, numpy.empty(len(ids), dtype=object))
+                       for name in attributes)
+
+        job_indices = []
+        states = []
+        values = []
+        for index, job_id in enumerate(ids):
+            job = queue[job_id]
+            for name, column in columns.iteritems():
+                column[index] = job.get(name, "")
+
+            job_array = job["job_array"]
+            job_indices.extend([index] * len(job_array))
+            states.extend(job_array.iterkeys())
+            values.extend(job_array.itervalues())
+
+        counts = numpy.zeros((len(ids), len(STATUS)), dtype=numpy.int64)
+        if not states:
+            return cls(ids, counts, columns)
+
+        status_indices = scheduler.standardize_codes(states)
+        numpy.add.at(counts, (numpy.array(job_indices), status_indices),
+                     numpy.array(values))
+
+        return cls(ids, counts, columns)
+
+    def job_arrays(self):
+        """Yield the job ids with their standard job_array counters"""
+        for job_id, row in zip(self.ids, self.counts):
+            yield job_id, dict((STATUS[i], int(row[i]))
+                               for i in numpy.flatnonzero(row))
+
+    def column(self, status):
+        return self.counts[:, STATUS.index(status)]
+
+    def total(self, status):
+        return int(self.column(status).sum())
+
+    def submitted(self):
+        """Number of tasks submitted and not completed, per job"""
+        return (self.counts.sum(1) -
+                self.column(AbstractScheduler.COMPLETED))
+
+    def queued(self):
+        """Number of tasks submitted and not running, per job"""
+        return self.submitted() - self.column(AbstractScheduler.RUNNING)
+
+    def rows(self, attributes):
+        """Yield the attributes and the counters of each job"""
+        columns = [self.attributes[name] if name != "id" else self.ids
+                   for name in attributes]
+        for index in xrange(len(self)):
+            yield ([column[index] for column in columns],
+                   self.counts[index].tolist())
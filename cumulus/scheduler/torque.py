@@ -1,19 +1,17 @@
-from collections import defaultdict
-import re
 import subprocess
-import sys
-import time
 
+from cumulus import config
+from cumulus.parsers.qstat import qstat, qstat_xml
 from cumulus.utils.scripts import command_is_available
-from cumulus.utils.num import is_int
 
-from .base import AbstractScheduler
+from .base import AbstractScheduler, array_script
 from . import smartdispatch
 
 
 class Scheduler(AbstractScheduler):
     JOB_ID = "PBS_ARRAYID"
     JOBARRAY_ID = "PBS_JOBID"
+    ARRAY_TASK_ID = "PBS_ARRAYID"
 
     FAILED = "E"
     RUNNING = "R"
@@ -30,138 +28,52 @@ class Scheduler(AbstractScheduler):
                                         arguments)
         raise NotImplementedError("Torque qsub scheduler not implemented yet")
 
-    def queue(self, username=None, job_id=None):
-        return self._standardize_status(
-            qstat(username=username, job_id=job_id))
-
-    def cancel(self, job_id, job_array_id):
-        cancellable_job_ids = self._get_cancellable_jobs(job_id)
-
-        command = "qdel %s" % " ".join(cancellable_job_ids)
-
-        process = subprocess.Popen(command)
-        stdoutdata, stderrdata = process.communicate()
-        if process.returncode > 0:
-            print stdoutdata
+    def submit_array(self, queue, job_name, time, row_ids, arguments,
+                     throttle=None, log_dir=None):
+        array = "0-%d" % (len(row_ids) - 1)
+        if throttle:
+            array += "%%%d" % throttle
+
+        # The script is given on stdin, no file to write and clean up
+        command = ["qsub", "-t", array, "-q", queue,
+                   "-l", "walltime=%s" % time, "-N", job_name]
+        if log_dir is not None:
+            # Given a directory, qsub names the outputs of each task
+            # job_name.o1234-5 and job_name.e1234-5
+            command += ["-o", log_dir, "-e", log_dir]
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdoutdata, stderrdata = process.communicate(
+            array_script(row_ids, arguments, self.ARRAY_TASK_ID))
+        if process.returncode != 0:
             raise RuntimeError(stderrdata)
 
-        # stdoutdata does not give information about cancelled jobs to we need
-        # to monitor the queue and see which got cancelled succesfully
-        cancelled_job_ids = []
-        failed_cancel_job_ids = []
-        job_ids_buffer = cancellable_job_ids
-        WAIT_STEP = 5
-        MAX_WAIT = 60
-        waited = 0
-        while waited <= MAX_WAIT:
-            job_ids = self._get_cancellable_jobs(job_id)
-            while job_ids_buffer:
-                job_id = job_ids_buffer.pop(0)
-                if job_id in job_ids:
-                    failed_cancel_job_ids.append(job_id)
-                else:
-                    cancelled_job_ids.append(job_id)
-
-            if len(failed_cancel_job_ids) == 0:
-                break
-
-            time.sleep(WAIT_STEP)
-            waited += WAIT_STEP
-
-        return cancelled_job_ids, failed_cancel_job_ids
-
-
-def qstat(username=None, job_id=None):
-    if username is None:
-        command = "qstat -f"
-    else:
-        command = "qstat -f -u %s" % username
-
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
-
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
-
-    full_qstat = process.stdout.read()
-
-    if username is None:
-        command = "qstat -t"
-    else:
-        command = "qstat -t -u %s" % username
-
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
-
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
-
-    row_qstat = process.stdout.read()
-
-    jobs = parse_qstat(row_qstat, full_qstat)
-
-    if job_id is not None:
-        return filter(lambda job: job["id"] == job_id, jobs)
-    else:
-        return jobs
-
-
-id_regex = re.compile("^[0-9]*")
-
-
-def parse_qstat(row_qstat, full_qstat):
-
-    jobs = {}
-    for job_desc in full_qstat.split("\n\n"):
-        if job_desc.strip() == "":
-            continue
-
-        job = dict(id=job_desc.split("\n")[0].split(":")[-1].strip())
-
-        last_key = None
-
-        for line in job_desc.split("\n")[1:]:
+        # ex: 1234567[].hades
+        return stdoutdata.strip()
 
-            if line[0] == "\t":
-                if last_key is None:
-                    raise ValueError("qstat stdout is not formatted correctly")
-                job[last_key] += line[1:]
-            else:
-                splits = line.split(" = ")
-                key = splits[0].strip()
-                value = " = ".join(splits[1:]).strip()
-                job[key] = value
+    def task_id(self, job_id, index):
+        return job_id.replace("[]", "[%d]" % index, 1)
 
-            last_key = key
+    def queue(self, username=None, job_id=None, attributes=None):
+        if config["queue_format"] == "structured":
+            jobs = qstat_xml(username=username, job_id=job_id,
+                             attributes=attributes)
+        else:
+            jobs = qstat(username=username, job_id=job_id,
+                         attributes=attributes)
 
-        job["job_array"] = defaultdict(int)
+        return self._standardize_status(jobs)
 
-        if job["id"] in jobs:
-            return ValueError("Two jobs have the same ids: %s" % job["id"])
+    def cancel_command(self, job_ids, job_array_id=None):
+        command = ["qdel"]
+        if job_array_id is not None:
+            command += ["-t", job_array_id]
 
-        jobs[job["id"]] = job
+        return command + job_ids
 
-    # R: Running
-    # Q: Queued
-    # H: On hold
-    job_id_index = 0
-    state_index = None  # Need to find it
-    for row in filter(lambda a: a.strip(), row_qstat.split("\n")):
-        row = row.split()
-        if is_int(row[0][0]):
-            assert state_index is not None
-            job_id = row[job_id_index]
-            state = row[state_index]
-            jobs[job_id]["job_array"][state] += 1
-        elif row[4] == "S":
-            state_index = 4
-        elif (len(row) > 9 and row[9] == "S"):
-            state_index = 9
+    def parse_cancel_errors(self, stderrdata):
+        # ex: qdel: Unknown Job Id 1234[].hades
+        return set(line.split()[-1] for line in stderrdata.split("\n")
+                   if line.startswith("qdel:"))
 
-    return jobs
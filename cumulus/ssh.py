@@ -1,27 +1,71 @@
+import atexit
 import json
 import logging
+import Queue
+import select
+import socket
 import struct
-import subprocess
+import threading
+import time
+import zlib
 
-import numpy
 import paramiko
-import sshtunnel
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 logger = logging.getLogger(__name__)
 
 SUBMIT, MONITOR, CANCEL, CLOSE = range(4)
 
+# Sizes read from the peer are checked before the buffer is allocated, so
+# that a corrupted header cannot exhaust the memory
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+
+def _check_size(size):
+    if not 0 <= size <= MAX_FRAME_SIZE:
+        raise ValueError("Invalid frame size: %d bytes" % size)
+
+
+def _receive_exactly(channel, size):
+    # Fill a preallocated buffer instead of concatenating the chunks
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    recv_into = getattr(channel, "recv_into", None)
+    while received < size:
+        if recv_into is not None:
+            nbytes = recv_into(view[received:], size - received)
+        else:
+            chunk = channel.recv(size - received)
+            nbytes = len(chunk)
+            view[received:received + nbytes] = chunk
+        if not nbytes:
+            return None
+        received += nbytes
+
+    return data
+
 
 def receive(channel):
     try:
-        size = struct.unpack("i", channel.recv(struct.calcsize("i")))[0]
-        data = ""
-        while len(data) < size:
-            msg = channel.recv(size - len(data))
-            if not msg:
-                return None
-            data += msg
-        return json.loads(data.strip())
+        header = _receive_exactly(channel, struct.calcsize("i"))
+        if header is None:
+            return None
+        size = struct.unpack("i", bytes(header))[0]
+        _check_size(size)
+        data = _receive_exactly(channel, size)
+        if data is None:
+            return None
+        return json.loads(bytes(data).strip())
     except OSError as e:
         print e
         return False
@@ -32,75 +76,741 @@ def send(channel, **kwargs):
     channel.send(struct.pack('i', len(message)) + message)
 
 
-def open_ssh_client(hostnames, username, password):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(
-        paramiko.AutoAddPolicy())
+def read_message(buffer, offset=0):
+    """
+    Parse the message starting at offset in a buffer of received bytes
 
-    error = None
-    for hostname in hostnames:
+    Returns the message and the offset following it, or None if the message
+    is not complete yet.
+    """
+    header_size = struct.calcsize("i")
+    if len(buffer) - offset < header_size:
+        return None
+
+    size = struct.unpack_from("i", buffer, offset)[0]
+    _check_size(size)
+    end = offset + header_size + size
+    if len(buffer) < end:
+        return None
+
+    return json.loads(bytes(buffer[offset + header_size:end]).strip()), end
+
+
+# Frames of a multiplexed session. The encoding and compression of a session
+# are negotiated when it is opened, using the legacy frames above.
+#
+# header: version (uint8), flags (uint8), request id (uint32), size (uint64)
+FRAME_VERSION = 2
+FRAME_HEADER = struct.Struct("!BBIQ")
+
+FLAG_ZLIB = 0x1
+FLAG_LZ4 = 0x2
+FLAG_MSGPACK = 0x4
+
+JSON = "json"
+MSGPACK = "msgpack"
+ZLIB = "zlib"
+LZ4 = "lz4"
+
+# Small payloads are not worth compressing
+COMPRESSION_THRESHOLD = 1024
+
+
+def available_encodings():
+    """Supported encodings, by order of preference"""
+    if msgpack is not None:
+        return [MSGPACK, JSON]
+
+    return [JSON]
+
+
+def available_compressions():
+    """Supported compressions, by order of preference"""
+    if lz4 is not None:
+        return [LZ4, ZLIB]
+
+    return [ZLIB]
+
+
+def negotiate(encodings, compressions):
+    """Select the preferred encoding and compression supported on both ends"""
+    encoding = ([e for e in available_encodings() if e in encodings] +
+                [JSON])[0]
+    compression = ([c for c in available_compressions()
+                    if c in compressions] + [None])[0]
+
+    return encoding, compression
+
+
+def encode_frame(request_id, message, encoding=JSON, compression=None):
+    flags = 0
+    if encoding == MSGPACK:
+        data = msgpack.packb(message, use_bin_type=True)
+        flags |= FLAG_MSGPACK
+    else:
+        data = json.dumps(message)
+
+    if compression is not None and len(data) > COMPRESSION_THRESHOLD:
+        if compression == LZ4:
+            data = lz4.frame.compress(data)
+            flags |= FLAG_LZ4
+        else:
+            data = zlib.compress(data, 1)
+            flags |= FLAG_ZLIB
+
+    return FRAME_HEADER.pack(FRAME_VERSION, flags, request_id, len(data)), data
+
+
+def decode_frame(flags, data):
+    if flags & FLAG_LZ4:
+        data = lz4.frame.decompress(bytes(data))
+    elif flags & FLAG_ZLIB:
+        data = zlib.decompress(bytes(data))
+
+    if flags & FLAG_MSGPACK:
+        # Replies like the tasks of SUBMIT_BATCH are keyed by int
+        return msgpack.unpackb(bytes(data), raw=False, strict_map_key=False)
+
+    return json.loads(bytes(data))
+
+
+def receive_frame(channel):
+    header = _receive_exactly(channel, FRAME_HEADER.size)
+    if header is None:
+        return None, None
+
+    version, flags, request_id, size = FRAME_HEADER.unpack(bytes(header))
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported frame version: %d" % version)
+    _check_size(size)
+
+    data = _receive_exactly(channel, size)
+    if data is None:
+        return request_id, None
+
+    return request_id, decode_frame(flags, data)
+
+
+def read_frame(buffer, offset=0):
+    """
+    Parse the frame starting at offset in a buffer of received bytes
+
+    Returns the request id, the message and the offset following the frame,
+    or None if the frame is not complete yet.
+    """
+    if len(buffer) - offset < FRAME_HEADER.size:
+        return None
+
+    version, flags, request_id, size = FRAME_HEADER.unpack_from(buffer,
+                                                                offset)
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported frame version: %d" % version)
+    _check_size(size)
+
+    start = offset + FRAME_HEADER.size
+    if len(buffer) < start + size:
+        return None
+
+    return (request_id, decode_frame(flags, buffer[start:start + size]),
+            start + size)
+
+
+def send_frame(channel, request_id, message, encoding=JSON, compression=None):
+    header, data = encode_frame(request_id, message, encoding, compression)
+    channel.sendall(header + data)
+
+
+# Connections are pooled per (hostname, username), so that tunnels, exec
+# channels and sftp sessions on the same login node share a single
+# authenticated transport, like ssh's ControlMaster.
+KEEPALIVE_INTERVAL = 30
+IDLE_TIMEOUT = 5 * 60
+CONNECT_TIMEOUT = 10
+
+# Login nodes are ranked by the moving average of their connection latency.
+# A node which failed recently is ranked as if it was slower by
+# FAILURE_PENALTY seconds per consecutive failure.
+LATENCY_SMOOTHING = 0.3
+DEFAULT_LATENCY = 1.
+FAILURE_PENALTY = 30.
+FAILURE_MEMORY = 10 * 60
+
+# Delay before racing the next login node if the previous one did not answer
+RACE_DELAY = 0.5
+
+
+class HostStats(object):
+    """Latency and failure history of the login nodes"""
+
+    def __init__(self):
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get(self, hostname):
+        return self._hosts.setdefault(
+            hostname, dict(latency=None, failures=0, consecutive_failures=0,
+                           last_failure=None))
+
+    def success(self, hostname, latency):
+        with self._lock:
+            stats = self._get(hostname)
+            if stats["latency"] is None:
+                stats["latency"] = latency
+            else:
+                stats["latency"] += (
+                    LATENCY_SMOOTHING * (latency - stats["latency"]))
+            stats["consecutive_failures"] = 0
+
+    def failure(self, hostname):
+        with self._lock:
+            stats = self._get(hostname)
+            stats["failures"] += 1
+            stats["consecutive_failures"] += 1
+            stats["last_failure"] = time.time()
+
+    def score(self, hostname):
+        with self._lock:
+            stats = self._hosts.get(hostname)
+            if stats is None:
+                return DEFAULT_LATENCY
+
+            score = stats["latency"]
+            if score is None:
+                score = DEFAULT_LATENCY
+
+            if (stats["last_failure"] is not None and
+                    time.time() - stats["last_failure"] < FAILURE_MEMORY):
+                score += FAILURE_PENALTY * stats["consecutive_failures"]
+
+            return score
+
+    def rank(self, hostnames):
+        """Sort hostnames from the best to the worst, stable for ties"""
+        return sorted(hostnames, key=self.score)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((hostname, dict(stats))
+                        for hostname, stats in self._hosts.iteritems())
+
+
+host_stats = HostStats()
+
+
+class PooledTransport(object):
+
+    def __init__(self, pool, hostname, username, client):
+        self.pool = pool
+        self.hostname = hostname
+        self.username = username
+        self.client = client
+        self.transport = client.get_transport()
+        self.references = 0
+        self.last_used = time.time()
+
+    @property
+    def key(self):
+        return (self.hostname, self.username)
+
+    def is_healthy(self):
+        if not (self.transport.is_active() and
+                self.transport.is_authenticated()):
+            return False
+
+        try:
+            self.transport.send_ignore()
+        except (paramiko.SSHException, socket.error, EOFError):
+            return False
+
+        return True
+
+    def release(self):
+        self.pool.release(self)
+
+    def close(self):
+        logger.debug("Closing ssh transport to %s@%s" %
+                     (self.username, self.hostname))
+        self.client.close()
+
+
+class TransportPool(object):
+
+    def __init__(self, keepalive=KEEPALIVE_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+
+        self._connections = {}
+        self._connecting = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reaper = None
+
+    def _connect(self, hostname, username, password, ssh_pkey, timeout):
+        logger.debug("Opening ssh transport to %s@%s" % (username, hostname))
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        start = time.time()
+        try:
+            client.connect(hostname, username=username, password=password,
+                           key_filename=ssh_pkey, timeout=timeout)
+        except BaseException:
+            host_stats.failure(hostname)
+            client.close()
+            raise
+        host_stats.success(hostname, time.time() - start)
+        client.get_transport().set_keepalive(self.keepalive)
+        return PooledTransport(self, hostname, username, client)
+
+    def acquire(self, hostname, username, password=None, ssh_pkey=None,
+                timeout=CONNECT_TIMEOUT):
+        """
+        Return a healthy PooledTransport, opening it if necessary
+
+        The transport must be given back with release().
+        """
+        key = (hostname, username)
+        with self._lock:
+            # Only one handshake per key at a time
+            connecting = self._connecting.setdefault(key, threading.Lock())
+
+        with connecting:
+            # The reference is taken along with the lookup, evict_idle only
+            # removes transports without any
+            with self._lock:
+                connection = self._connections.get(key)
+                if connection is not None:
+                    connection.references += 1
+                    connection.last_used = time.time()
+
+            if connection is not None and not connection.is_healthy():
+                logger.debug("Dropping dead ssh transport to %s@%s" % key)
+                host_stats.failure(hostname)
+                self._discard(connection)
+                connection = None
+
+            if connection is None:
+                connection = self._connect(hostname, username, password,
+                                           ssh_pkey, timeout)
+                with self._lock:
+                    connection.references += 1
+                    connection.last_used = time.time()
+                    self._connections[key] = connection
+
+        self._start_reaper()
+
+        return connection
+
+    def release(self, connection):
+        with self._lock:
+            connection.references = max(connection.references - 1, 0)
+            connection.last_used = time.time()
+
+    def _discard(self, connection):
+        with self._lock:
+            if self._connections.get(connection.key) is connection:
+                del self._connections[connection.key]
+        connection.close()
+
+    def evict_idle(self):
+        now = time.time()
+        # Removed under the lock, so that acquire cannot take a reference on
+        # a transport about to be closed
+        with self._lock:
+            idle = [connection for connection in self._connections.values()
+                    if connection.references == 0 and
+                    now - connection.last_used > self.idle_timeout]
+            for connection in idle:
+                del self._connections[connection.key]
+
+        for connection in idle:
+            logger.debug("Evicting idle ssh transport to %s@%s" %
+                         connection.key)
+            connection.close()
+
+    def _reap(self):
+        while not self._stop.wait(self.idle_timeout / 2.0):
+            self.evict_idle()
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is not None:
+                return
+
+            self._reaper = threading.Thread(target=self._reap)
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            reaper, self._reaper = self._reaper, None
+            connections = self._connections.values()
+            self._connections = {}
+
+        if reaper is not None:
+            reaper.join()
+
+        for connection in connections:
+            connection.close()
+
+
+transport_pool = TransportPool()
+atexit.register(transport_pool.close)
+
+
+def connect_fastest(hostnames, username, password=None, ssh_pkey=None,
+                    timeout=CONNECT_TIMEOUT, exclude=tuple()):
+    """
+    Race the connections to the login nodes and return the first
+    PooledTransport established
+
+    The nodes are tried from the best ranked to the worst, the next one
+    being started when the previous one fails or after RACE_DELAY seconds.
+    Transports established after the winner stay in the pool.
+
+    Parameters
+    ----------
+
+    hostnames: list of str
+    exclude: list of str
+        Login nodes to avoid, unless they are the only ones.
+    """
+    if not hostnames:
+        raise ValueError("No login node to connect to")
+
+    candidates = [hostname for hostname in hostnames
+                  if hostname not in exclude]
+    if not candidates:
+        candidates = list(hostnames)
+    candidates = host_stats.rank(candidates)
+
+    results = Queue.Queue()
+    lock = threading.Lock()
+    state = dict(done=False)
+
+    def finish():
+        # Attempts finishing from now on release their transport themselves,
+        # those which finished before are released here.
+        with lock:
+            state["done"] = True
+
+        while True:
+            try:
+                _, late_connection, _ = results.get_nowait()
+            except Queue.Empty:
+                break
+            if late_connection is not None:
+                late_connection.release()
+
+    def attempt(hostname):
         try:
-            client.connect(hostname, username=username, password=password)
-            connected = True
+            connection = transport_pool.acquire(
+                hostname, username, password, ssh_pkey, timeout)
         except BaseException, e:
-            connected = False
+            results.put((hostname, None, e))
+            return
+
+        with lock:
+            if state["done"]:
+                connection.release()
+            else:
+                results.put((hostname, connection, None))
+
+    deadline = time.time() + timeout
+    running = 0
+    error = None
+    while True:
+        if candidates:
+            hostname = candidates.pop(0)
+            logger.debug("Trying login node %s" % hostname)
+            thread = threading.Thread(target=attempt, args=(hostname, ))
+            thread.daemon = True
+            thread.start()
+            running += 1
+            wait = RACE_DELAY
+        elif running:
+            wait = deadline - time.time()
+        else:
+            raise error
+
+        try:
+            hostname, connection, e = results.get(timeout=max(wait, 0))
+        except Queue.Empty:
+            if not candidates and time.time() >= deadline:
+                finish()
+                raise socket.timeout(
+                    "No login node answered within %d seconds" % timeout)
+            continue
+
+        running -= 1
+        if connection is None:
+            logger.debug("Login node %s failed: %s" % (hostname, str(e)))
             error = e
+            continue
 
-        if connected:
-            break
+        finish()
+        logger.debug("Connected to login node %s" % hostname)
+        return connection
+
+
+def open_ssh_client(hostnames, username, password, ssh_pkey=None):
+    """
+    Return the fastest hostname which accepts the connection, with a pooled
+    paramiko.SSHClient. The client is shared, use release_ssh_client instead
+    of closing it.
+    """
+    connection = connect_fastest(hostnames, username, password, ssh_pkey)
+    return connection.hostname, connection.client
 
-    # No connection work so we try again outside of To raise and error
-    if not connected:
-        raise error
 
-    return hostname, client  # .get_transport().open_session()
+def release_ssh_client(hostname, username):
+    with transport_pool._lock:
+        connection = transport_pool._connections.get((hostname, username))
+
+    if connection is not None:
+        connection.release()
+
+
+def open_sftp(hostname, username, password=None, ssh_pkey=None):
+    """
+    Open a paramiko.SFTPClient on the pooled transport. The transport is
+    released when the sftp client is closed.
+    """
+    connection = transport_pool.acquire(hostname, username, password, ssh_pkey)
+    try:
+        sftp = paramiko.SFTPClient.from_transport(connection.transport)
+    except BaseException:
+        connection.release()
+        raise
+
+    close = sftp.close
+
+    def release_on_close():
+        close()
+        connection.release()
+
+    sftp.close = release_on_close
+    return sftp
+
+
+class Tunnel(object):
+    """
+    Forward a local port to remote_addr:remote_port through direct-tcpip
+    channels of a pooled transport, like ssh -L.
+
+    If the transport dies and a reconnect callable is given, the tunnel
+    fails over to the transport it returns, keeping the same local port.
+    reconnect is called with the hostname of the dead transport to exclude.
+    """
+
+    BUFFER_SIZE = 32 * 1024
+    SELECT_TIMEOUT = 1
+
+    def __init__(self, connection, remote_addr, remote_port,
+                 local_bind_address="0.0.0.0", local_port=0, reconnect=None):
+        self.connection = connection
+        self.reconnect = reconnect
+        self.remote_address = (remote_addr, remote_port)
+        self.local_bind_address = local_bind_address
+        self.local_port = local_port
+
+        self._socket = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def _transport(self):
+        return self.connection.transport
+
+    @property
+    def hostname(self):
+        return self.connection.hostname
+
+    @property
+    def local_bind_port(self):
+        return self._socket.getsockname()[1]
+
+    @property
+    def is_active(self):
+        return (self._thread is not None and self._thread.is_alive() and
+                self._transport.is_active())
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.local_bind_address, self.local_port))
+        self._socket.listen(128)
+
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select(
+                [self._socket], [], [], self.SELECT_TIMEOUT)
+            if not readable:
+                continue
+
+            try:
+                local_socket, address = self._socket.accept()
+            except socket.error:
+                continue
+
+            try:
+                channel = self._open_channel(address)
+            except (paramiko.SSHException, socket.error, EOFError) as e:
+                logger.warning("Could not open ssh channel to %s:%d: %s" %
+                               (self.remote_address + (str(e), )))
+                local_socket.close()
+                continue
+
+            forward = threading.Thread(
+                target=self._forward, args=(local_socket, channel))
+            forward.daemon = True
+            forward.start()
+
+    def _open_channel(self, address):
+        try:
+            return self._transport.open_channel(
+                "direct-tcpip", self.remote_address, address)
+        except (paramiko.SSHException, socket.error, EOFError):
+            # The remote end refused, the transport is fine
+            if self._transport.is_active() or self.reconnect is None:
+                raise
+
+        self._failover()
+        return self._transport.open_channel(
+            "direct-tcpip", self.remote_address, address)
+
+    def _failover(self):
+        dead = self.connection
+        logger.warning("ssh transport to %s died, failing over" %
+                       dead.hostname)
+        host_stats.failure(dead.hostname)
+        self.connection = self.reconnect(dead.hostname)
+        dead.release()
+        logger.info("ssh tunnel failed over from %s to %s" %
+                    (dead.hostname, self.hostname))
+
+    def _forward(self, local_socket, channel):
+        try:
+            while not self._stop.is_set():
+                readable, _, _ = select.select(
+                    [local_socket, channel], [], [], self.SELECT_TIMEOUT)
+                if local_socket in readable:
+                    data = local_socket.recv(self.BUFFER_SIZE)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(self.BUFFER_SIZE)
+                    if not data:
+                        break
+                    local_socket.sendall(data)
+        except (socket.error, EOFError) as e:
+            logger.debug("Tunnel connection broken: %s" % str(e))
+        finally:
+            channel.close()
+            local_socket.close()
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._socket.close()
+        self.connection.release()
 
 
 def open_ssh_tunnel(
-        hostname, username, password, remote_addr, remote_port,
+        hostnames, username, password, remote_addr, remote_port,
         ssh_pkey=None, local_port=None,
         local_bind_address="0.0.0.0"):
 
     if local_port is None:
-        local_ports = list(numpy.random.random_integers(1024, 65535, size=20))
-    elif not isinstance(local_port, (list, tuple)):
-        local_ports = [local_port]
-    else:
-        local_ports = local_ports
-
-    # TODO Support many hostnames in case one is down
-    hostname = hostname[0]
-
-    for local_port_candidate in local_ports:
-        logger.debug("Probing ssh-tunnel: ssh %s@%s -L %s:%s:%s:%s" %
-                     (username, hostname, local_bind_address,
-                      local_port_candidate, remote_addr, remote_port))
-        server = sshtunnel.SSHTunnelForwarder(
-            hostname,
-            ssh_username=username,
-            ssh_password=password,
-            ssh_pkey=ssh_pkey,
-            remote_bind_address=(remote_addr, remote_port),
-            local_bind_address=("0.0.0.0", local_port_candidate)
-        )  # port))
-        server.start()
-        break
+        # Let the system pick a free port
+        local_port = 0
 
-    return hostname, local_port_candidate, server
+    def reconnect(dead_hostname):
+        return connect_fastest(hostnames, username, password, ssh_pkey,
+                               exclude=[dead_hostname])
 
+    connection = connect_fastest(hostnames, username, password, ssh_pkey)
 
-# Inspired from https://stackoverflow.com/a/33334998
-def line_buffered(f, bufsize=1):
-    line_buf = ""
-    while not f.channel.exit_status_ready():
-        new_chunk = f.read(bufsize)
-        line_buf += new_chunk
-        if '\n' in new_chunk:
-            lines = line_buf.split("\n")
-            for line in lines[:-1]:
-                yield line
+    logger.debug("Opening ssh-tunnel: ssh %s@%s -L %s:%s:%s:%s" %
+                 (username, connection.hostname, local_bind_address,
+                  local_port, remote_addr, remote_port))
+    server = Tunnel(connection, remote_addr, remote_port,
+                    local_bind_address=local_bind_address,
+                    local_port=local_port, reconnect=reconnect)
+    try:
+        server.start()
+    except BaseException:
+        connection.release()
+        raise
+
+    return connection.hostname, server.local_bind_port, server
+
+
+LINE_CHUNK_SIZE = 32 * 1024
+
+
+def iter_lines(channel, chunk_size=LINE_CHUNK_SIZE, timeout=None,
+               deadline=None):
+    """
+    Yield the lines of the stdout of a paramiko channel as they arrive,
+    without their newline. The last line is yielded even if it is not
+    terminated.
+
+    Use channel.set_combine_stderr(True) to include stderr.
+
+    Parameters
+    ----------
+
+    channel: paramiko.Channel
+    chunk_size: int
+        Maximum number of bytes read at once.
+    timeout: float or None
+        Maximum number of seconds to wait for new data. Raises socket.timeout
+        when reached.
+    deadline: float or None
+        Time (as of time.time()) at which to stop waiting. Raises
+        socket.timeout when reached.
+    """
+    parts = []
+    while True:
+        if not channel.recv_ready() and not channel.eof_received:
+            wait = timeout
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+                wait = remaining if wait is None else min(wait, remaining)
+
+            readable, _, _ = select.select([channel], [], [], wait)
+            if not readable:
+                raise socket.timeout(
+                    "No output received from remote command in time")
+
+        chunk = channel.recv(chunk_size)
+        if not chunk:
+            break
+
+        lines = chunk.split("\n")
+        if len(lines) == 1:
+            parts.append(chunk)
+            continue
 
-            line_buf = lines[-1]
+        parts.append(lines[0])
+        yield "".join(parts)
+        for line in lines[1:-1]:
+            yield line
+        parts = [lines[-1]] if lines[-1] else []
+
+    if parts:
+        yield "".join(parts)
 
 
 # From paramiko.client.SSHClient
@@ -145,52 +855,3 @@ def exec_command(
         stderr = chan.makefile_stderr('r', bufsize)
         return stdin, stdout, stderr, chan
 
-
-def remotely(fct):
-
-    def call(cluster, *args, **kwargs):
-        client = open_ssh_client(cluster)
-
-        result = fct(cluster, SSHClient(client), *args, **kwargs)
-
-        client.close()
-
-        return result
-
-    return call
-
-
-def rsync(cluster, output_dir):
-    command = (
-        ("rsync -arvu %(username)s:%(hostname)s "
-         "%(cluster_log_dir)s %(output_dir)s") %
-        dict(username=cluster.username, hostname=cluster.hostname,
-             cluster_log_dir=cluster.log_dir, output_dir=output_dir))
-
-    subprocess.check_call(command)
-    return
-
-
-def SSHClient(object):
-    def __init__(self, client):
-        self.client = client
-
-    def submit(self, *args):
-        _, stdout, stderr = self.client.exec_command(
-            "cumulus-particle submit")
-        return stdout.read(), stderr.read()
-
-    def monitor(self):
-        _, stdout, stderr = self.client.exec_command(
-            "cumulus-particle monitor")
-        return stdout.read(), stderr.read()
-
-    def cancel(self, job_ids):
-        _, stdout, stderr = self.client.exec_command(
-            "cumulus-particle cancel \"%s\"" % job_ids)
-        return stdout.read(), stderr.read()
-
-
-def start_remote_server(self):
-    _, stdout, stderr = self.client.exec_command("cumulus-socket open")
-    return stdout.read(), stderr.read()
@@ -0,0 +1,102 @@
+"""
+    Minimal binding of the Linux inotify API through ctypes, to be notified
+    when files are modified instead of polling them.
+
+    Ex:
+        inotify = Inotify()
+        wd = inotify.add_watch("job.out", IN_MODIFY)
+        for wd, mask, name in inotify.read(timeout=1):
+            ...
+        inotify.close()
+
+    Only changes made by processes of the same host are reported. Files on
+    network file systems written from other nodes must still be polled.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# wd, mask, cookie, len, followed by len bytes of name
+EVENT_HEADER = struct.Struct("iIII")
+
+READ_SIZE = 64 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+
+def available():
+    return _libc is not None
+
+
+def _check(rval):
+    if rval < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+    return rval
+
+
+class Inotify(object):
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        return _check(_libc.inotify_add_watch(self.fd, path, mask))
+
+    def rm_watch(self, wd):
+        _check(_libc.inotify_rm_watch(self.fd, wd))
+
+    def read(self, timeout=None):
+        """Return the (wd, mask, name) of the events, waiting up to timeout"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
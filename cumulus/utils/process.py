@@ -1,12 +1,169 @@
+"""
+    Process pool shared by all the parallel operations of cumulus. The pool
+    is created on first use and reused afterwards, so that repeated calls do
+    not pay the start-up of the worker processes. It is closed when the
+    interpreter exits.
+
+    Ex:
+        executor = get_executor()
+        results = executor.map(fct, [(1, 2), (3, 4)], chunksize=8)
+        for result in executor.imap_unordered(fct, args):
+            ...
+        executor.stats.mean
+
+    The functions and their arguments are sent to the workers, so they must
+    be picklable.
+"""
+
+import atexit
 import logging
 import multiprocessing
+import threading
+import time
+
+from .. import config
 
 
 logger = logging.getLogger(__name__)
 
 
+class TaskStats(object):
+    """Execution time of the tasks measured inside the workers"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def add(self, elapsed):
+        with self._lock:
+            self.count += 1
+            self.total += elapsed
+            self.min = elapsed if self.min is None else min(self.min, elapsed)
+            self.max = elapsed if self.max is None else max(self.max, elapsed)
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+
+        return self.total / self.count
+
+    def __repr__(self):
+        return ("TaskStats(count=%d, total=%s, mean=%s, min=%s, max=%s)" %
+                (self.count, self.total, self.mean, self.min, self.max))
+
+
+class _TimedCall(object):
+    """Call fct with the arguments unpacked and measure its execution time"""
+
+    def __init__(self, fct):
+        self.fct = fct
+
+    def __call__(self, args):
+        start = time.time()
+        rval = self.fct(*args)
+        return time.time() - start, rval
+
+
+class Executor(object):
+
+    def __init__(self, n_processes=None, initializer=None, initargs=()):
+        """
+        Parameters
+        ----------
+
+        n_processes: int or None
+            Number of worker processes. Defaults to the number of cpus.
+        initializer: callable or None
+            Called with initargs in each worker when it starts.
+        """
+        self.n_processes = n_processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.stats = TaskStats()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                logger.debug("Starting process pool of size %s" %
+                             str(self.n_processes))
+                self._pool = multiprocessing.Pool(
+                    self.n_processes, initializer=self.initializer,
+                    initargs=self.initargs)
+
+            return self._pool
+
+    def _collect(self, timed_results):
+        for elapsed, rval in timed_results:
+            self.stats.add(elapsed)
+            yield rval
+
+    def map(self, fct, args, chunksize=1, timeout=None):
+        """
+        Return the results of fct(*a) for a in args, in order
+
+        Parameters
+        ----------
+
+        fct: callable
+        args: iterable of tuples
+        chunksize: int
+            Number of tasks sent at once to a worker.
+        timeout: float or None
+            Maximum number of seconds to wait for all results. Raises
+            multiprocessing.TimeoutError when reached.
+        """
+        timed_results = self.pool.map_async(
+            _TimedCall(fct), args, chunksize).get(timeout)
+        return list(self._collect(timed_results))
+
+    def imap(self, fct, args, chunksize=1):
+        """Yield the results of fct(*a) for a in args, in order"""
+        return self._collect(self.pool.imap(_TimedCall(fct), args, chunksize))
+
+    def imap_unordered(self, fct, args, chunksize=1):
+        """Yield the results of fct(*a) for a in args as they complete"""
+        return self._collect(
+            self.pool.imap_unordered(_TimedCall(fct), args, chunksize))
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+
+        if pool is None:
+            return
+
+        logger.debug("Shutting down process pool")
+        if wait:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the executor shared by the process, sized by pool_size"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor(config["pool_size"] or None)
+            atexit.register(_executor.shutdown)
+
+        return _executor
+
+
 def pmap(fct, args, n_pools=None, initializer=None, initargs=None,
-         _async=True):
+         _async=True, chunksize=1):
 
     if logger.getEffectiveLevel() == logging.DEBUG:
         if _async:
@@ -14,22 +171,19 @@ def pmap(fct, args, n_pools=None, initializer=None, initargs=None,
                             "level is DEBUG")
         _async = False
 
-    results = []
-    if _async:
-        pool = multiprocessing.Pool(n_pools, initializer=initializer,
-                                    initargs=initargs)
-
-        for process_args in args:
-            results.append(pool.apply_async(fct, args=process_args))
-
-        # Get fct output and replace pool.result object
-        for i in range(len(results)):
-            results[i] = results[i].get()
-    else:
+    if not _async:
         if initializer is not None:
-            initializer(initargs)
+            initializer(*(initargs or ()))
+
+        return [fct(*process_args) for process_args in args]
 
-        for process_args in args:
-            results.append(fct(*process_args))
+    if initializer is None and n_pools is None:
+        return get_executor().map(fct, args, chunksize=chunksize)
 
-    return results
+    # The initializer sets globals in the workers, they cannot be shared
+    # with other calls.
+    executor = Executor(n_pools, initializer, initargs or ())
+    try:
+        return executor.map(fct, args, chunksize=chunksize)
+    finally:
+        executor.shutdown()
@@ -2,6 +2,7 @@ import distutils.spawn
 import logging
 import subprocess
 import sys
+import tempfile
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +32,39 @@ def command_is_available(command):
     # return not ("%s: command not found" % command) in process.stderr.read()
 
 
+class Command(subprocess.Popen):
+    """
+    Process whose stdout is read from a pipe as it runs. Its stderr goes to a
+    temporary file, a pipe read only at the end would block the process once
+    full.
+
+    Ex:
+        process = Command(["qstat", "-x"])
+        jobs = parse(process.stdout)
+        process.check()
+    """
+
+    def __init__(self, command, shell=False):
+        self.command = command
+        self.stderr_file = tempfile.TemporaryFile()
+        super(Command, self).__init__(command, stdout=subprocess.PIPE,
+                                      stderr=self.stderr_file, shell=shell)
+
+    def read_stderr(self):
+        self.stderr_file.seek(0)
+        return self.stderr_file.read()
+
+    def check(self):
+        """Wait for the process and raise RuntimeError if it failed"""
+        if self.wait() != 0:
+            command = self.command
+            if isinstance(command, (list, tuple)):
+                command = " ".join(command)
+            raise RuntimeError("%s failed with exit code %d: %s" %
+                               (command, self.returncode,
+                                self.read_stderr().strip()))
+
+
 def cure(d):
     new_d = {}
     for k, v in d.iteritems():
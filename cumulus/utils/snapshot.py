@@ -0,0 +1,77 @@
+"""
+    Deltas between two snapshots of a queue, a dict of job dicts indexed by job
+    id. Only the jobs that were added, removed or modified are part of the
+    delta. For modified jobs, only the modified attributes are included, and
+    dict attributes like job_array are themselves reduced to the entries that
+    changed, None marking a removed entry.
+
+    Ex:
+        delta = diff(old_queue, new_queue)
+        assert patch(old_queue, delta) == new_queue
+"""
+
+
+def _diff_dict(old, new):
+    changes = dict((key, value) for key, value in new.iteritems()
+                   if key not in old or old[key] != value)
+    changes.update((key, None) for key in old if key not in new)
+    return changes
+
+
+def diff_job(old_job, new_job):
+    changes = {}
+    for key, value in new_job.iteritems():
+        old_value = old_job[key]
+        if old_value == value:
+            continue
+
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            value = _diff_dict(old_value, value)
+
+        changes[key] = value
+
+    return changes
+
+
+def diff(old, new):
+    added = {}
+    changed = {}
+    for job_id, job in new.iteritems():
+        old_job = old.get(job_id)
+        if old_job is None or set(old_job) != set(job):
+            added[job_id] = job
+        elif old_job != job:
+            changed[job_id] = diff_job(old_job, job)
+
+    removed = [job_id for job_id in old if job_id not in new]
+
+    return dict(added=added, removed=removed, changed=changed)
+
+
+def is_empty(delta):
+    return not (delta["added"] or delta["removed"] or delta["changed"])
+
+
+def patch(old, delta):
+    """Apply the delta on a shallow copy of old. Modified jobs are copied."""
+    new = dict(old)
+    for job_id in delta["removed"]:
+        new.pop(job_id, None)
+
+    new.update(delta["added"])
+
+    for job_id, changes in delta["changed"].iteritems():
+        job = dict(new[job_id])
+        for key, value in changes.iteritems():
+            if isinstance(value, dict) and isinstance(job.get(key), dict):
+                nested = dict(job[key])
+                for nested_key, nested_value in value.iteritems():
+                    if nested_value is None:
+                        nested.pop(nested_key, None)
+                    else:
+                        nested[nested_key] = nested_value
+                value = nested
+            job[key] = value
+        new[job_id] = job
+
+    return new
@@ -0,0 +1,239 @@
+"""
+    Follow many log files at once and return their new lines, like tail -f.
+    Files are watched with inotify when available, so that local writes are
+    read right away. All files are also checked every `poll_interval`
+    seconds, since writes from compute nodes to a network file system do not
+    trigger inotify events on the login node.
+
+    Ex:
+        tail = Tail(["job1.out", "job2.out"], from_end=False)
+        while True:
+            lines = tail.read_lines(max_lines=1000, timeout=1)
+            for path, new_lines in lines.iteritems():
+                ...
+        tail.close()
+
+    Files which do not exist yet are followed once they are created, and
+    files which are truncated are read again from their beginning.
+"""
+
+import logging
+import os
+import time
+
+from . import inotify
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_POLL_INTERVAL = 2.
+# Maximum number of bytes read from a file at once, so that a large file does
+# not delay the others
+READ_SIZE = 64 * 1024
+
+WATCH_MASK = (inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE |
+              inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF)
+
+
+class FileTail(object):
+
+    def __init__(self, path, offset=None):
+        """
+        Parameters
+        ----------
+
+        path: str
+        offset: int or None
+            Position from which to read. Starts from the end of the file if
+            None.
+        """
+        self.path = path
+        self.offset = offset
+        self.partial = ""
+        self.wd = None
+
+    def read_lines(self, max_lines=None):
+        """
+        Return the complete lines written since the last read, and whether
+        there is more to read
+        """
+        try:
+            size = os.stat(self.path).st_size
+        except OSError:
+            return [], False
+
+        if self.offset is None:
+            self.offset = size
+        elif size < self.offset:
+            logger.debug("%s was truncated, reading it from start" %
+                         self.path)
+            self.offset = 0
+            self.partial = ""
+
+        if size == self.offset:
+            return [], False
+
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read(min(size - self.offset, READ_SIZE))
+        except IOError:
+            return [], False
+
+        self.offset += len(data)
+        lines = (self.partial + data).split("\n")
+        partial = lines.pop()
+        if max_lines is not None and len(lines) > max_lines:
+            # Read again from the first line dropped
+            dropped = lines[max_lines:]
+            lines = lines[:max_lines]
+            self.offset -= sum(len(line) + 1 for line in dropped)
+            self.offset -= len(partial)
+            partial = ""
+        elif len(partial) > READ_SIZE:
+            # Do not buffer a line without end forever
+            lines.append(partial)
+            partial = ""
+        self.partial = partial
+
+        return lines, self.offset < size
+
+
+class Tail(object):
+
+    def __init__(self, paths, from_end=True, offsets=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        """
+        Parameters
+        ----------
+
+        paths: list of str
+        from_end: bool
+            Only return lines written after the tail started, otherwise read
+            the files from their beginning.
+        offsets: dict or None
+            Position from which to read each path, overrides from_end. Used
+            to resume a tail.
+        poll_interval: float
+            Number of seconds between two checks of all files.
+        use_inotify: bool
+            Watch the files with inotify if available.
+        """
+        if offsets is None:
+            offsets = {}
+
+        self.files = dict(
+            (path, FileTail(path, offsets.get(path, None if from_end else 0)))
+            for path in paths)
+        self.poll_interval = poll_interval
+        self._last_scan = None
+        self._watches = {}
+        self._pending = {}
+
+        self.inotify = None
+        if use_inotify and inotify.available():
+            try:
+                self.inotify = inotify.Inotify()
+            except OSError as e:
+                logger.warning("Cannot use inotify, polling files: %s" %
+                               str(e))
+
+        # Set the offsets of the files followed from their end
+        for file_tail in self.files.itervalues():
+            if file_tail.offset is None:
+                file_tail.read_lines()
+
+    def _watch(self, file_tail):
+        if self.inotify is None or file_tail.wd is not None:
+            return
+
+        try:
+            file_tail.wd = self.inotify.add_watch(file_tail.path, WATCH_MASK)
+        except OSError:
+            # Not created yet, or no more watches available. Polled anyway.
+            return
+
+        self._watches[file_tail.wd] = file_tail
+
+    def _wait(self, timeout):
+        """Return the files to read, waiting at most timeout seconds"""
+        now = time.time()
+        if (self._last_scan is None or
+                now - self._last_scan >= self.poll_interval):
+            self._last_scan = now
+            for file_tail in self.files.itervalues():
+                self._watch(file_tail)
+            return self.files.values()
+
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            return pending.values()
+
+        timeout = min(timeout, self._last_scan + self.poll_interval - now)
+        if self.inotify is None:
+            time.sleep(max(timeout, 0))
+            return []
+
+        changed = {}
+        for wd, mask, _ in self.inotify.read(max(timeout, 0)):
+            file_tail = self._watches.get(wd)
+            if file_tail is None:
+                continue
+
+            if mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+                       inotify.IN_IGNORED):
+                # Watched again at the next scan if it is recreated
+                del self._watches[wd]
+                file_tail.wd = None
+
+            changed[file_tail.path] = file_tail
+
+        return changed.values()
+
+    def read_lines(self, max_lines=None, timeout=None):
+        """
+        Return the new lines by path, waiting at most timeout seconds for
+        some. Returns an empty dict if there were none.
+
+        Files with more lines than max_lines, or with more than READ_SIZE
+        bytes to read, are read first at the next call.
+        """
+        if timeout is None:
+            timeout = self.poll_interval
+
+        deadline = time.time() + timeout
+        lines = {}
+        total = 0
+        while not lines:
+            remaining = deadline - time.time()
+            for file_tail in self._wait(remaining):
+                budget = None
+                if max_lines is not None:
+                    budget = max_lines - total
+                    if budget <= 0:
+                        self._pending[file_tail.path] = file_tail
+                        continue
+
+                file_lines, more = file_tail.read_lines(budget)
+                if file_lines:
+                    lines[file_tail.path] = file_lines
+                    total += len(file_lines)
+                if more:
+                    self._pending[file_tail.path] = file_tail
+
+            if remaining <= 0:
+                break
+
+        return lines
+
+    def offsets(self):
+        """Position of the next byte to return for each file"""
+        return dict((path, file_tail.offset - len(file_tail.partial))
+                    for path, file_tail in self.files.iteritems()
+                    if file_tail.offset is not None)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
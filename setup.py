@@ -38,5 +38,6 @@ setup(
                       'virtualenv-clone', 'lockfile', 'paramiko'],
     extras_require={
         'test': ['nosetests'],
+        'protocol': ['lz4', 'msgpack>=0.6.1'],
         'doc': ['sphinx', 'sphinx-autobuild']}
 )
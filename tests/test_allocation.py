@@ -0,0 +1,76 @@
+import unittest
+
+import numpy
+
+from cumulus.cluster.allocation import allocate, quotas
+
+
+class TestQuotas(unittest.TestCase):
+
+    def test_proportional(self):
+        self.assertEqual(quotas([100, 100], [1, 3], 40).tolist(), [10, 30])
+
+    def test_capped(self):
+        # The first experiment has less rows than its share
+        self.assertEqual(quotas([5, 100], [1, 1], 40).tolist(), [5, 35])
+
+    def test_no_weight(self):
+        self.assertEqual(quotas([10, 10], [0, 1], 5).tolist(), [0, 5])
+
+    def test_largest_remainders(self):
+        shares = quotas([10, 10, 10], [1, 1, 1], 10)
+        self.assertEqual(shares.sum(), 10)
+        self.assertTrue(shares.max() - shares.min() <= 1)
+
+    def test_empty(self):
+        self.assertEqual(quotas([10, 10], [1, 1], 0).tolist(), [0, 0])
+
+
+class TestAllocate(unittest.TestCase):
+
+    def test_limits(self):
+        free_slots = [10, 5]
+        counts = [8, 8, 2]
+        matrix = allocate(free_slots, counts).matrix
+        self.assertEqual(matrix.shape, (2, 3))
+        self.assertEqual(matrix.sum(), 15)
+        self.assertTrue((matrix.sum(1) <= free_slots).all())
+        self.assertTrue((matrix.sum(0) <= counts).all())
+
+    def test_first_clusters_filled_first(self):
+        matrix = allocate([100, 50], [3, 4]).matrix
+        self.assertEqual(matrix.tolist(), [[3, 4], [0, 0]])
+
+    def test_mixed_experiments(self):
+        # Each cluster gets rows of both experiments
+        matrix = allocate([10, 10], [50, 50]).matrix
+        self.assertEqual(matrix.tolist(), [[5, 5], [5, 5]])
+
+    def test_weights(self):
+        matrix = allocate([10], [50, 50], weights=[0, 1]).matrix
+        self.assertEqual(matrix.tolist(), [[0, 10]])
+
+    def test_negative_slots(self):
+        self.assertEqual(len(allocate([-3, 0], [10])), 0)
+
+    def test_split(self):
+        row_ids = [numpy.arange(0, 8), numpy.arange(100, 108),
+                   numpy.arange(200, 202)]
+        assignment = allocate([10, 5], [8, 8, 2])
+        split_ids = assignment.split(row_ids)
+
+        self.assertEqual(len(split_ids), 2)
+        for cluster, experiments in enumerate(split_ids):
+            for experiment, ids in experiments.iteritems():
+                self.assertEqual(len(ids),
+                                 assignment.matrix[cluster, experiment])
+
+        # Each row once, in the order of the backlog of its experiment
+        for experiment, ids in enumerate(row_ids):
+            assigned = sum((experiments.get(experiment, [])
+                            for experiments in split_ids), [])
+            self.assertEqual(assigned, ids[:len(assigned)].tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import time
+import unittest
+
+from cumulus.cluster import ledger
+from cumulus.cluster.ledger import SlotLedger, count_tasks
+from cumulus.utils.snapshot import diff, patch
+
+
+QUEUE = {
+    "1": dict(job_array={"QUEUED": 10}),
+    "2": dict(job_array={"QUEUED": 5, "RUNNING": 20, "COMPLETED": 5}),
+}
+
+
+class TestCountTasks(unittest.TestCase):
+
+    def test_count(self):
+        self.assertEqual(count_tasks(QUEUE["2"]), (25, 5))
+
+    def test_unknown(self):
+        # Tasks in unknown states still hold slots
+        self.assertEqual(count_tasks(dict(job_array={"UNKNOWN": 3})), (3, 3))
+
+
+class TestSlotLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.ledger = SlotLedger(max_jobs=100, threshold=50)
+
+    def test_not_synced(self):
+        self.assertFalse(self.ledger.synced)
+        self.ledger.reset(QUEUE, time.time())
+        self.assertTrue(self.ledger.synced)
+
+    def test_reset(self):
+        self.ledger.reset(QUEUE, time.time())
+        self.assertEqual((self.ledger.submitted, self.ledger.queued),
+                         (35, 15))
+        self.assertEqual(self.ledger.free_slots(), 65)
+
+    def test_update(self):
+        self.ledger.reset(QUEUE, time.time())
+        new_queue = dict(QUEUE)
+        del new_queue["1"]
+        new_queue["2"] = dict(job_array={"RUNNING": 10, "COMPLETED": 20})
+        new_queue["3"] = dict(job_array={"HOLD": 2})
+
+        self.ledger.update(diff(QUEUE, new_queue),
+                           patch(QUEUE, diff(QUEUE, new_queue)), time.time())
+        self.assertEqual((self.ledger.submitted, self.ledger.queued), (12, 2))
+
+    def test_threshold(self):
+        self.ledger.reset(dict(a=dict(job_array={"QUEUED": 50})), time.time())
+        self.assertEqual(self.ledger.free_slots(), 0)
+
+    def test_submission(self):
+        self.ledger.reset(QUEUE, time.time())
+        self.ledger.record_submission(10)
+        self.assertEqual(self.ledger.free_slots(), 55)
+
+        # Counted until a snapshot taken after the submission is received
+        queue = dict(QUEUE, **{"3": dict(job_array={"QUEUED": 10})})
+        self.ledger.reset(queue, time.time())
+        self.assertEqual(self.ledger.summary()["pending"], 0)
+        self.assertEqual(self.ledger.free_slots(), 55)
+
+    def test_cancellation(self):
+        self.ledger.reset(QUEUE, time.time())
+        self.ledger.record_cancellation(["1", "unknown"])
+        self.assertEqual(self.ledger.free_slots(), 75)
+
+        # Still in the queue, still not counted
+        self.ledger.reset(QUEUE, time.time())
+        self.assertEqual(self.ledger.free_slots(), 75)
+
+        new_queue = dict(QUEUE)
+        del new_queue["1"]
+        self.ledger.update(diff(QUEUE, new_queue), new_queue, time.time())
+        self.assertEqual(self.ledger.summary()["cancelled"], 0)
+        self.assertEqual(self.ledger.free_slots(), 75)
+
+    def test_cancellation_expired(self):
+        self.ledger.reset(QUEUE, time.time())
+        self.ledger.record_cancellation(["1"])
+        cancel_ttl = ledger.CANCEL_TTL
+        ledger.CANCEL_TTL = -1
+        try:
+            self.assertEqual(self.ledger.free_slots(), 65)
+        finally:
+            ledger.CANCEL_TTL = cancel_ttl
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,253 @@
+import datetime
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import threading
+import time
+import unittest
+
+from cumulus import ssh
+from cumulus.cluster import Cluster, session as session_module
+from cumulus.cluster.session import Session
+
+os.environ.setdefault("CLUSTER", "test")
+try:
+    from cumulus.bin import cumulus_socket
+except ImportError:
+    # No scheduler found, cumulus_socket cannot be imported
+    cumulus_socket = None
+
+
+REPEATABLE = (Cluster.PING, Cluster.MONITOR, Cluster.CANCEL_STATUS)
+
+
+class FakeScheduler(object):
+
+    def __init__(self):
+        self.submissions = 0
+
+    def submit_batch(self, jobs, max_array_size=None, throttle=None,
+                     log_dir=None):
+        self.submissions += 1
+        tasks = dict((job["row_id"], "1234[%d].hades" % index)
+                     for index, job in enumerate(jobs))
+        return dict(arrays=["1234[].hades"], tasks=tasks, errors={})
+
+    def cancel(self, job_id, delay=0):
+        time.sleep(delay)
+        if job_id == "error":
+            raise RuntimeError("Could not cancel %s" % job_id)
+        return dict(cancelled=[job_id], failed=[])
+
+
+class FakeCache(object):
+
+    def get(self, refresh=False, **kwargs):
+        queue = dict(("%d.hades" % i, dict(job_array={"QUEUED": i}))
+                     for i in range(100))
+        return queue, dict(age=0)
+
+
+def now():
+    return str(datetime.datetime.now())
+
+
+@unittest.skipIf(cumulus_socket is None, "No scheduler available")
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.running = True
+        self.patches = dict(
+            get_lock_files=lambda: ["lock"] if self.running else [],
+            scheduler=FakeScheduler(), queue_cache=FakeCache())
+        self.originals = dict((name, getattr(cumulus_socket, name))
+                              for name in self.patches)
+        for name, value in self.patches.iteritems():
+            setattr(cumulus_socket, name, value)
+
+        serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serversocket.bind(("127.0.0.1", 0))
+        serversocket.listen(10)
+        self.address = serversocket.getsockname()
+        self.server = cumulus_socket.Server(serversocket, workers=4)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.sessions = []
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+
+        self.running = False
+        os.write(self.server.wakeup_write, "x")
+        self.thread.join(5)
+        for name, value in self.originals.iteritems():
+            setattr(cumulus_socket, name, value)
+
+    def connect(self, resilience=1):
+        return socket.create_connection(self.address, 5)
+
+    def session(self):
+        session = Session(self.connect, Cluster.SESSION, timeout=5,
+                          repeatable=REPEATABLE)
+        self.sessions.append(session)
+        return session
+
+    def test_ping(self):
+        date = now()
+        reply = self.session().request(Cluster.PING, date=date)
+        self.assertEqual(reply["returncode"], 0)
+        self.assertEqual(reply["sent"], date)
+
+    def test_concurrent(self):
+        session = self.session()
+        pool = ThreadPool(8)
+        try:
+            slow = pool.apply_async(
+                session.request, (Cluster.CANCEL, ),
+                dict(job_id="1234.hades", delay=0.5))
+            dates = [now() + str(i) for i in range(32)]
+            start = time.time()
+            replies = pool.map(
+                lambda date: session.request(Cluster.PING, date=date), dates)
+            # Not held behind the slow request on the same connection
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertEqual([reply["sent"] for reply in replies], dates)
+            self.assertEqual(slow.get(5)["cancelled"], ["1234.hades"])
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_partial_frame(self):
+        # A client stalled in the middle of a frame blocks nobody else
+        stalled = self.session()
+        stalled.request(Cluster.PING, date=now())
+        header, data = ssh.encode_frame(
+            1000, dict(command=Cluster.PING, kwargs=dict(date=now())))
+        stalled._socket.sendall(header + data[:2])
+
+        start = time.time()
+        self.session().request(Cluster.PING, date=now())
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_errors(self):
+        session = self.session()
+        reply = session.request(Cluster.CANCEL, job_id="error")
+        self.assertEqual(reply["returncode"], 1)
+        self.assertEqual(reply["message"], "Could not cancel error")
+
+        reply = session.request(-1)
+        self.assertEqual(reply["returncode"], 1)
+
+        # The session is still usable
+        reply = session.request(Cluster.PING, date=now())
+        self.assertEqual(reply["returncode"], 0)
+
+    def test_one_shot(self):
+        client_socket = self.connect()
+        try:
+            date = now()
+            ssh.send(client_socket, command=Cluster.PING)
+            ssh.send(client_socket, date=date)
+            self.assertEqual(ssh.receive(client_socket)["sent"], date)
+        finally:
+            client_socket.close()
+
+    def check_encoding(self, encoding, compression):
+        available = (session_module.available_encodings,
+                     session_module.available_compressions)
+        session_module.available_encodings = lambda: [encoding]
+        session_module.available_compressions = lambda: (
+            [compression] if compression else [])
+        try:
+            session = self.session()
+            jobs = [dict(row_id=row_id, commandline="run %d" % row_id)
+                    for row_id in range(100)]
+            reply = session.request(Cluster.SUBMIT_BATCH, jobs=jobs)
+        finally:
+            (session_module.available_encodings,
+             session_module.available_compressions) = available
+
+        self.assertEqual((session.encoding, session.compression),
+                         (encoding, compression))
+        tasks = dict((int(row_id), job_id)
+                     for row_id, job_id in reply["tasks"].iteritems())
+        self.assertEqual(tasks[99], "1234[99].hades")
+
+        reply = session.request(Cluster.MONITOR)
+        self.assertEqual(len(reply["queue"]), 100)
+
+    def test_json(self):
+        self.check_encoding(ssh.JSON, None)
+
+    def test_zlib(self):
+        self.check_encoding(ssh.JSON, ssh.ZLIB)
+
+    @unittest.skipIf(ssh.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        self.check_encoding(ssh.MSGPACK, None)
+
+    @unittest.skipIf(ssh.msgpack is None or ssh.lz4 is None,
+                     "msgpack or lz4 is not installed")
+    def test_msgpack_lz4(self):
+        self.check_encoding(ssh.MSGPACK, ssh.LZ4)
+
+
+class DroppingServer(object):
+    """Accept sessions and close each connection after its first request"""
+
+    def __init__(self):
+        self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.serversocket.bind(("127.0.0.1", 0))
+        self.serversocket.listen(10)
+        self.address = self.serversocket.getsockname()
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                client_socket, _ = self.serversocket.accept()
+            except socket.error:
+                return
+
+            ssh.receive(client_socket)
+            ssh.send(client_socket, returncode=0, encoding=ssh.JSON,
+                     compression=None)
+            _, request = ssh.receive_frame(client_socket)
+            self.requests.append(request["command"])
+            client_socket.close()
+
+    def close(self):
+        self.serversocket.close()
+
+
+class TestResend(unittest.TestCase):
+
+    def setUp(self):
+        self.server = DroppingServer()
+        self.session = Session(
+            lambda resilience: socket.create_connection(self.server.address),
+            Cluster.SESSION, timeout=5, repeatable=REPEATABLE)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.close()
+
+    def test_repeatable(self):
+        self.assertRaises(socket.error, self.session.request, Cluster.PING,
+                          resilience=1, date=now())
+        self.assertEqual(self.server.requests, [Cluster.PING] * 2)
+
+    def test_not_repeatable(self):
+        self.assertRaises(socket.error, self.session.request,
+                          Cluster.SUBMIT_BATCH, resilience=1, jobs=[])
+        self.assertEqual(self.server.requests, [Cluster.SUBMIT_BATCH])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import copy
+import unittest
+
+from cumulus.utils.snapshot import diff, is_empty, patch
+
+
+OLD = {
+    "1.hades": dict(Job_Name="a", job_array={"QUEUED": 10}),
+    "2.hades": dict(Job_Name="b", job_array={"QUEUED": 2, "RUNNING": 8}),
+    "3.hades": dict(Job_Name="c", job_array={"RUNNING": 1}),
+}
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.old = copy.deepcopy(OLD)
+        self.new = copy.deepcopy(OLD)
+
+    def test_same(self):
+        delta = diff(self.old, self.new)
+        self.assertTrue(is_empty(delta))
+        self.assertEqual(patch(self.old, delta), self.new)
+
+    def test_added_removed(self):
+        del self.new["3.hades"]
+        self.new["4.hades"] = dict(Job_Name="d", job_array={"HOLD": 1})
+
+        delta = diff(self.old, self.new)
+        self.assertEqual(delta["removed"], ["3.hades"])
+        self.assertEqual(delta["added"], {"4.hades": self.new["4.hades"]})
+        self.assertEqual(delta["changed"], {})
+        self.assertEqual(patch(self.old, delta), self.new)
+
+    def test_changed(self):
+        self.new["2.hades"]["job_array"] = {"RUNNING": 9, "COMPLETED": 1}
+
+        delta = diff(self.old, self.new)
+        self.assertFalse(is_empty(delta))
+        # Only the entries of job_array which changed, None if removed
+        self.assertEqual(
+            delta["changed"],
+            {"2.hades": dict(job_array={"QUEUED": None, "RUNNING": 9,
+                                        "COMPLETED": 1})})
+        self.assertEqual(patch(self.old, delta), self.new)
+
+    def test_new_attribute(self):
+        # A job whose attributes changed is sent whole
+        self.new["1.hades"]["queue"] = "debug"
+
+        delta = diff(self.old, self.new)
+        self.assertEqual(delta["added"], {"1.hades": self.new["1.hades"]})
+        self.assertEqual(patch(self.old, delta), self.new)
+
+    def test_patch_copies(self):
+        self.new["1.hades"]["job_array"] = {"RUNNING": 10}
+        patch(self.old, diff(self.old, self.new))
+        self.assertEqual(self.old, OLD)
+
+
+if __name__ == "__main__":
+    unittest.main()
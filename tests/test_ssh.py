@@ -0,0 +1,102 @@
+import socket
+import struct
+import unittest
+
+from cumulus import ssh
+
+
+MESSAGE = dict(
+    returncode=0, message=u"d\xe9j\xe0 soumis",
+    arrays=["1234[].hades"],
+    tasks={1: "1234[0].hades", 2: "1234[1].hades"},
+    queue=dict(("%d.hades" % i, dict(job_array={"QUEUED": i}))
+               for i in range(100)))
+
+
+class TestFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def round_trip(self, encoding, compression, message=MESSAGE):
+        ssh.send_frame(self.client, 42, message, encoding, compression)
+        return ssh.receive_frame(self.server)
+
+    def test_json(self):
+        request_id, message = self.round_trip(ssh.JSON, None)
+        self.assertEqual(request_id, 42)
+        # Keys of json objects are always strings
+        self.assertEqual(message["tasks"], {"1": "1234[0].hades",
+                                            "2": "1234[1].hades"})
+        self.assertEqual(message["message"], MESSAGE["message"])
+        self.assertEqual(message["queue"], MESSAGE["queue"])
+
+    @unittest.skipIf(ssh.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        request_id, message = self.round_trip(ssh.MSGPACK, None)
+        self.assertEqual(request_id, 42)
+        self.assertEqual(message, MESSAGE)
+
+    def test_zlib(self):
+        _, message = self.round_trip(ssh.JSON, ssh.ZLIB)
+        self.assertEqual(message["queue"], MESSAGE["queue"])
+
+    @unittest.skipIf(ssh.lz4 is None, "lz4 is not installed")
+    def test_lz4(self):
+        _, message = self.round_trip(ssh.JSON, ssh.LZ4)
+        self.assertEqual(message["queue"], MESSAGE["queue"])
+
+    @unittest.skipIf(ssh.msgpack is None or ssh.lz4 is None,
+                     "msgpack or lz4 is not installed")
+    def test_msgpack_lz4(self):
+        _, message = self.round_trip(ssh.MSGPACK, ssh.LZ4)
+        self.assertEqual(message, MESSAGE)
+
+    def test_small_frames_are_not_compressed(self):
+        header, _ = ssh.encode_frame(1, dict(returncode=0), ssh.JSON,
+                                     ssh.ZLIB)
+        _, flags, _, _ = ssh.FRAME_HEADER.unpack(header)
+        self.assertEqual(flags & ssh.FLAG_ZLIB, 0)
+
+    def test_closed(self):
+        self.client.close()
+        self.assertEqual(ssh.receive_frame(self.server), (None, None))
+
+    def test_unsupported_version(self):
+        self.client.sendall(ssh.FRAME_HEADER.pack(
+            ssh.FRAME_VERSION + 1, 0, 1, 2) + "{}")
+        self.assertRaises(ValueError, ssh.receive_frame, self.server)
+
+    def test_invalid_size(self):
+        self.client.sendall(ssh.FRAME_HEADER.pack(
+            ssh.FRAME_VERSION, 0, 1, ssh.MAX_FRAME_SIZE + 1))
+        self.assertRaises(ValueError, ssh.receive_frame, self.server)
+
+    def test_legacy(self):
+        ssh.send(self.client, command=3, date="today")
+        self.assertEqual(ssh.receive(self.server),
+                         dict(command=3, date="today"))
+        self.client.sendall(struct.pack("i", -1))
+        self.assertRaises(ValueError, ssh.receive, self.server)
+
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_fallback(self):
+        self.assertEqual(ssh.negotiate([], []), (ssh.JSON, None))
+        self.assertEqual(ssh.negotiate([ssh.JSON], [ssh.ZLIB]),
+                         (ssh.JSON, ssh.ZLIB))
+
+    def test_preferred(self):
+        encoding, compression = ssh.negotiate(
+            [ssh.JSON, ssh.MSGPACK], [ssh.ZLIB, ssh.LZ4])
+        self.assertEqual(encoding, ssh.available_encodings()[0])
+        self.assertEqual(compression, ssh.available_compressions()[0])
+
+
+if __name__ == "__main__":
+    unittest.main()